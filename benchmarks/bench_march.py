@@ -0,0 +1,248 @@
+# Accuracy and speed of the intersection routines in march.py against analytic SDFs.
+# Ground truth is found by a dense float64 scan along each ray followed by bisection.
+# For each marcher and SDF this reports hit accuracy, position error of hits, # of SDF
+# evaluations and wall time per million rays.
+#
+# Run from the root of the repository:
+#   python -m benchmarks.bench_march --out bench_march.json
+# With --check it exits with a non-zero status if any marcher is less accurate than expected,
+# so it can be used to verify rewrites of march.py.
+import copy
+import random
+import sys
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import src.march as march
+from src.accel import ( SDFGrid, RayBounds )
+from benchmarks.scenes import ( analytic_sdfs, timeit, metadata, write_json, arguments )
+
+# Counts calls to an SDF and how many points were evaluated.
+class Counting(nn.Module):
+  def __init__(self, sdf):
+    super().__init__()
+    self.sdf = sdf
+    self.reset()
+  def reset(self):
+    self.calls = 0
+    self.points = 0
+  def forward(self, p):
+    self.calls += 1
+    self.points += p.numel()//p.shape[-1]
+    return self.sdf(p)
+
+# rays from a sphere around the origin aimed at points in [-1,1]^3, so a fraction of them miss.
+def random_rays(n: int, radius: float = 3, device="cpu"):
+  r_o = F.normalize(torch.randn(n, 3, device=device), dim=-1) * radius
+  target = torch.rand(n, 3, device=device) * 2 - 1
+  r_d = F.normalize(target - r_o, dim=-1)
+  return r_o, r_d
+
+# first intersection of each ray in [near, far], found by scanning in float64.
+# Returns (hits, t), where t is only valid for hits.
+def ground_truth(sdf, r_o, r_d, near, far, samples: int = 4096, iters: int = 64, chunk: int = 256):
+  sdf = copy.deepcopy(sdf).double()
+  r_o, r_d = r_o.double(), r_d.double()
+  with torch.no_grad():
+    ts = torch.linspace(near, far, samples, dtype=torch.double, device=r_o.device)
+    first = torch.full(r_o.shape[:1], -1, dtype=torch.long, device=r_o.device)
+    for s in range(0, samples, chunk):
+      t = ts[s:s+chunk]
+      sd = sdf(r_o[:, None] + t[None, :, None] * r_d[:, None])[..., 0]
+      neg = sd < 0
+      idx = neg.float().argmax(dim=-1) + s
+      first = torch.where((first == -1) & neg.any(dim=-1), idx, first)
+    hits = first > 0
+    low = ts[(first-1).clamp(min=0)]
+    high = ts[first.clamp(min=0)]
+    for _ in range(iters):
+      mid = (low + high)/2
+      pos = sdf(r_o + mid[:, None] * r_d)[..., 0] > 0
+      low = torch.where(pos, mid, low)
+      high = torch.where(pos, high, mid)
+  return hits, ((low + high)/2).float()
+
+# each returns (pts, hits, (lower, upper) bound on t or None)
+def run_sphere(sdf, r_o, r_d, opts):
+  pts, hits, _, _ = march.sphere_march(
+    sdf, r_o, r_d, iters=opts.iters, eps=opts.eps, near=opts.near, far=opts.far,
+  )
+  return pts, hits, None
+def run_secant(sdf, r_o, r_d, opts):
+  pts, hits, _, _ = march.secant(sdf, r_o, r_d, iters=opts.iters, near=opts.near, far=opts.far)
+  return pts, hits, None
+def run_bisect(sdf, r_o, r_d, opts):
+  pts, hits, _, _ = march.bisect(sdf, r_o, r_d, iters=opts.iters, near=opts.near, far=opts.far)
+  return pts, hits, None
+def run_bisect_adaptive(sdf, r_o, r_d, opts):
+  pts, hits, _, _ = march.bisect_adaptive(sdf, r_o, r_d, iters=opts.iters, near=opts.near, far=opts.far)
+  return pts, hits, None
+def run_throughput(sdf, r_o, r_d, opts):
+  val, best_pos = march.throughput(sdf, r_o, r_d, near=opts.near, far=opts.far, batch_size=opts.iters)
+  return best_pos, val < 0, None
+def run_sign_change(sdf, r_o, r_d, opts):
+  val, best_pos, last_pos, first_neg = march.throughput_with_sign_change(
+    sdf, r_o, r_d, near=opts.near, far=opts.far, batch_size=opts.iters,
+  )
+  return best_pos, val < 0, (last_pos[..., 0], first_neg[..., 0])
+def run_sign_change_adaptive(sdf, r_o, r_d, opts):
+  val, best_pos, last_pos, first_neg = march.throughput_with_sign_change(
+    sdf, r_o, r_d, near=opts.near, far=opts.far, batch_size=opts.iters, adaptive=True,
+  )
+  return best_pos, val < 0, (last_pos[..., 0], first_neg[..., 0])
+# the grid is built once per SDF from the uncounted SDF, so only intersection is measured.
+grids = {}
+def run_grid(sdf, r_o, r_d, opts):
+  underlying = sdf.sdf if isinstance(sdf, Counting) else sdf
+  if underlying not in grids:
+    grids[underlying] = SDFGrid(opts.grid_res)
+    grids[underlying].get(underlying, r_o.device)
+  pts, hits, _, _ = grids[underlying].intersect(sdf, r_o, r_d, near=opts.near, far=opts.far)
+  return pts, hits, None
+
+marcher_kinds = {
+  "sphere": run_sphere,
+  "secant": run_secant,
+  "bisect": run_bisect,
+  "bisect_adaptive": run_bisect_adaptive,
+  "throughput": run_throughput,
+  "sign_change": run_sign_change,
+  "sign_change_adaptive": run_sign_change_adaptive,
+  "grid": run_grid,
+}
+
+# (minimum hit accuracy, maximum median position error of hits, minimum bracketed) for --check.
+# throughput returns the point with the minimum SDF along the ray rather than the surface, so its
+# position is not checked.
+thresholds = {
+  "sphere": (0.99, 1e-3, None),
+  "secant": (0.99, 1e-3, None),
+  "bisect": (0.99, 1e-4, None),
+  "bisect_adaptive": (0.99, 1e-4, None),
+  "throughput": (0.99, None, None),
+  "sign_change": (0.99, None, 0.98),
+  "sign_change_adaptive": (0.99, None, 0.98),
+  "grid": (0.99, 1e-3, None),
+}
+
+def evaluate(run, sdf, r_o, r_d, gt_hits, gt_t, opts):
+  counting = Counting(sdf)
+  pts, hits, bounds = run(counting, r_o, r_d, opts)
+  hits = hits.reshape(gt_hits.shape)
+  both = hits & gt_hits
+  err = (pts[both] - (r_o + gt_t[:, None] * r_d)[both]).norm(dim=-1)
+  out = {
+    "accuracy": (hits == gt_hits).float().mean().item(),
+    "missed": (gt_hits & ~hits).float().mean().item(),
+    "false_hits": (hits & ~gt_hits).float().mean().item(),
+    "median_error": err.median().item() if err.numel() > 0 else None,
+    "max_error": err.max().item() if err.numel() > 0 else None,
+    "sdf_calls": counting.calls,
+    "evals_per_ray": counting.points/r_o.shape[0],
+  }
+  # fraction of true hits where the returned interval contains the intersection.
+  if bounds is not None:
+    low, high = bounds
+    eps = 1e-5
+    inside = (low[gt_hits] <= gt_t[gt_hits] + eps) & (gt_t[gt_hits] <= high[gt_hits] + eps)
+    out["bracketed"] = inside.float().mean().item()
+  return out
+
+def check(entry):
+  if "error" in entry: return ["failed to run"]
+  min_acc, max_err, min_bracket = thresholds[entry["marcher"]]
+  failures = []
+  if entry["accuracy"] < min_acc: failures.append(f"accuracy {entry['accuracy']:.4f} < {min_acc}")
+  err = entry["median_error"]
+  if max_err is not None and err is not None and err > max_err:
+    failures.append(f"median error {err:.2e} > {max_err}")
+  if min_bracket is not None and entry["bracketed"] < min_bracket:
+    failures.append(f"bracketed {entry['bracketed']:.4f} < {min_bracket}")
+  return failures
+
+def main():
+  a = arguments("Benchmark accuracy and speed of SDF intersection routines")
+  a.add_argument("--rays", type=int, default=1 << 14, help="# of rays per SDF")
+  a.add_argument("--iters", type=int, default=128, help="Iterations/steps passed to each marcher")
+  a.add_argument("--eps", type=float, default=5e-5, help="Hit threshold for sphere marching")
+  a.add_argument("--near", type=float, default=1, help="Near distance along rays")
+  a.add_argument("--far", type=float, default=5, help="Far distance along rays")
+  a.add_argument("--grid-res", type=int, default=128, help="Resolution of the grid for the grid marcher")
+  a.add_argument(
+    "--ray-bounds", type=int, default=0,
+    help="If > 0, march between per ray near and far from an occupancy grid of this resolution",
+  )
+  a.add_argument(
+    "--sdfs", type=str, nargs="*", default=list(analytic_sdfs.keys()),
+    choices=list(analytic_sdfs.keys()), help="SDFs to intersect",
+  )
+  a.add_argument(
+    "--marchers", type=str, nargs="*", default=list(marcher_kinds.keys()),
+    choices=list(marcher_kinds.keys()), help="Intersection routines to run",
+  )
+  a.add_argument("--check", action="store_true", help="Exit with an error if below thresholds")
+  opts = a.parse_args()
+  if opts.threads > 0: torch.set_num_threads(opts.threads)
+
+  device = "cuda" if torch.cuda.is_available() else "cpu"
+  results = []
+  failed = False
+  for sdf_kind in opts.sdfs:
+    torch.manual_seed(opts.seed)
+    sdf = analytic_sdfs[sdf_kind]().to(device)
+    r_o, r_d = random_rays(opts.rays, device=device)
+    gt_hits, gt_t = ground_truth(sdf, r_o, r_d, opts.near, opts.far)
+    run_opts, bounds_info = opts, {}
+    if opts.ray_bounds > 0:
+      bounds = RayBounds(opts.ray_bounds)
+      bounds.from_sdf(sdf, device)
+      near, far = bounds.near_far(r_o, r_d, opts.near, opts.far)
+      run_opts = copy.copy(opts)
+      run_opts.near, run_opts.far = near[:, None], far[:, None]
+      bounds_info = {
+        "bounds_sec_per_million_rays": timeit(
+          lambda: bounds.near_far(r_o, r_d, opts.near, opts.far), repeats=opts.repeats,
+        ) * 1e6/opts.rays,
+        "mean_ray_range": (far - near).mean().item(),
+      }
+      print(
+        f"[note]: {sdf_kind:>6} occupancy {bounds.occupancy():.3f}, mean ray range "
+        f"{bounds_info['mean_ray_range']:.3f} of {opts.far - opts.near:.3f}", flush=True,
+      )
+    for kind in opts.marchers:
+      # the grid marcher already skips empty space and only takes a global near and far.
+      if opts.ray_bounds > 0 and kind == "grid": continue
+      run = marcher_kinds[kind]
+      # some marchers jitter their step size with python's random.
+      random.seed(opts.seed)
+      entry = { "sdf": sdf_kind, "marcher": kind, "gt_hit_rate": gt_hits.float().mean().item() }
+      entry.update(bounds_info)
+      try:
+        entry.update(evaluate(run, sdf, r_o, r_d, gt_hits, gt_t, run_opts))
+        sec = timeit(lambda: run(sdf, r_o, r_d, run_opts), repeats=opts.repeats)
+        entry["sec_per_million_rays"] = sec * 1e6/opts.rays
+      except Exception as e: entry["error"] = f"{type(e).__name__}: {e}"
+      results.append(entry)
+      if "error" in entry: print(f"[warn]: {sdf_kind}/{kind} {entry['error']}", flush=True)
+      else:
+        print(
+          f"[note]: {sdf_kind:>6}/{kind:<11} acc {entry['accuracy']:.4f} "
+          f"err {entry['median_error'] or 0:.2e} evals/ray {entry['evals_per_ray']:7.1f} "
+          f"{entry['sec_per_million_rays']:.3f}s/Mray", flush=True,
+        )
+      if opts.check:
+        failures = check(entry)
+        entry["failures"] = failures
+        for f in failures: print(f"[warn]: {sdf_kind}/{kind} {f}")
+        failed = failed or len(failures) > 0
+
+  write_json({
+    "meta": metadata(),
+    "settings": vars(opts),
+    "results": results,
+  }, opts.out)
+  if failed: sys.exit(1)
+
+if __name__ == "__main__": main()
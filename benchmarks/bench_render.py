@@ -0,0 +1,139 @@
+# Rendering and training throughput for each model kind, SDF intersection kind, occlusion kind
+# and reflectance kind, on synthetic cameras with untrained models.
+# Outputs JSON, so results can be compared across commits.
+#
+# Cases which fail are recorded with their error instead of timings.
+#
+# Run from the root of the repository:
+#   python -m benchmarks.bench_render --out bench_render.json
+# With --check it exits with a non-zero status if any case fails, e.g. to check that the path
+# integrators work with every occlusion kind:
+#   python -m benchmarks.bench_render --only path --repeats 1 --check
+import math
+import random
+import sys
+
+import numpy as np
+import torch
+
+import runner
+import src.nerf as nerf
+import src.refl as refl
+import src.renderers as renderers
+from benchmarks.scenes import ( default_args, random_cameras, timeit, metadata, write_json, arguments )
+
+def parser_choices(dest):
+  for action in runner.parser()._actions:
+    if action.dest == dest: return list(action.choices)
+  raise KeyError(dest)
+
+def is_lit(overrides):
+  args = default_args(**overrides)
+  try: inst = refl.load(args, args.refl_kind, args.space_kind, 0)
+  except Exception: return False
+  return isinstance(inst, refl.LightAndRefl)
+
+# (group, kind, overrides of runner's arguments)
+def cases(opts):
+  common = { "steps": opts.steps, "sdf_kind": opts.sdf_kind }
+  lit = { **common, "model": "volsdf", "light_kind": "point", "point_light_position": [0, 0, 4] }
+  out = []
+  for kind in nerf.model_kinds:
+    out.append(("model", kind, { **common, "model": kind }))
+  # untrained SDFs do not have unit normals, so use a reflectance model which ignores them.
+  for kind in parser_choices("sdf_isect_kind"):
+    out.append(("sdf_isect", kind, { **common, "model": "sdf", "sdf_isect_kind": kind, "refl_kind": "view" }))
+  for kind in renderers.occ_kinds:
+    # without occlusion there is no integrator, and only unlit reflectance works.
+    if kind is None: continue
+    out.append(("occ", kind, {
+      **lit, "refl_kind": "diffuse", "occ_kind": kind, "integrator_kind": "direct",
+    }))
+  # the path integrators shade every vertex with a mask of which paths are still active.
+  for kind in renderers.occ_kinds:
+    if kind is None: continue
+    path = { **lit, "refl_kind": "diffuse", "occ_kind": kind, "integrator_kind": "path" }
+    out.append(("path", f"volsdf/{kind}", path))
+    # untrained SDFs do not have unit normals, which diffuse checks, so use a learned reflectance.
+    out.append(("path", f"sdf/{kind}", { **path, "model": "sdf", "refl_kind": "basic" }))
+  for kind in refl.refl_kinds:
+    overrides = { **lit, "refl_kind": kind, "weighted_subrefl_kinds": ["diffuse", "rusin"] }
+    # lit reflectance models need an integrator, use the cheapest one.
+    if is_lit(overrides): overrides.update(occ_kind="all-learned", integrator_kind="direct")
+    else: overrides["light_kind"] = None
+    out.append(("refl", kind, overrides))
+  return out
+
+def bench(args, opts):
+  device = runner.device
+  model = runner.load_model(args, light=None)
+  cs, size = opts.crop_size, opts.size
+  cam = random_cameras(opts.batch_size, size, device=device)
+  crop = (0, 0, cs, cs)
+
+  def forward():
+    model.train()
+    with torch.no_grad(): runner.render(model, cam, crop, size=size, args=args)
+  def forward_backward():
+    model.train()
+    model.zero_grad(set_to_none=True)
+    out, _ = runner.render(model, cam, crop, size=size, args=args)
+    out.square().mean().backward()
+  # renders an entire image in tiles, identical to runner.test.
+  def test():
+    model.eval()
+    with torch.no_grad():
+      N = math.ceil(size/args.test_crop_size)
+      tcs = args.test_crop_size
+      for x in range(N):
+        for y in range(N):
+          runner.render(model, cam[:1], (x*tcs, y*tcs, tcs, tcs), size=size, args=args, with_noise=False)
+
+  train_rays = opts.batch_size * cs * cs
+  out = { "parameters": sum(p.numel() for p in model.parameters()) }
+  for name, fn, rays in [
+    ("forward", forward, train_rays),
+    ("forward_backward", forward_backward, train_rays),
+    ("test", test, size * size),
+  ]:
+    sec = timeit(fn, repeats=opts.repeats)
+    out[name] = { "sec": sec, "rays_per_sec": rays/sec }
+  return out
+
+def main():
+  a = arguments("Benchmark rendering throughput across model kinds")
+  a.add_argument("--size", type=int, default=32, help="Size of rendered images")
+  a.add_argument("--crop-size", type=int, default=16, help="Crop size for training steps")
+  a.add_argument("--batch-size", type=int, default=2, help="# of views per training step")
+  a.add_argument("--steps", type=int, default=32, help="# of depth steps for volumetric models")
+  a.add_argument("--sdf-kind", type=str, default="spheres", help="SDF to use for SDF based models")
+  a.add_argument("--only", type=str, nargs="*", default=[], help="Only run these groups")
+  a.add_argument("--check", action="store_true", help="Exit with an error if any case fails")
+  opts = a.parse_args()
+  if opts.threads > 0: torch.set_num_threads(opts.threads)
+
+  results = []
+  for group, kind, overrides in cases(opts):
+    if len(opts.only) > 0 and group not in opts.only: continue
+    torch.manual_seed(opts.seed)
+    random.seed(opts.seed)
+    np.random.seed(opts.seed)
+    args = default_args(
+      size=opts.size, crop_size=opts.crop_size, test_crop_size=opts.crop_size,
+      batch_size=opts.batch_size, **overrides,
+    )
+    args.num_labels = opts.batch_size
+    entry = { "group": group, "kind": kind }
+    try: entry.update(bench(args, opts))
+    except Exception as e: entry["error"] = f"{type(e).__name__}: {e}"
+    print(f"[note]: {group}/{kind} {entry.get('error', 'ok')}", flush=True)
+    results.append(entry)
+
+  write_json({
+    "meta": metadata(),
+    "settings": vars(opts),
+    "results": results,
+  }, opts.out)
+  if opts.check and any("error" in entry for entry in results): sys.exit(1)
+
+if __name__ == "__main__": main()
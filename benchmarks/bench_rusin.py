@@ -0,0 +1,127 @@
+# Parity and speed of refl.fused_rusin_params against the reference parameterization, which
+# builds a frame around the normal, moves view and light into it, and rotates into the frame of
+# the half vector. For several distributions of (normal, view, light) this reports the max
+# difference of the two in float64, which should be at rounding level since they are the same
+# function, the max and mean error of each parameter of both in float32 against float64, and
+# the time of both with and without gradients.
+#
+# Run from the root of the repository:
+#   python -m benchmarks.bench_rusin --out bench_rusin.json
+# With --check it exits with a non-zero status if the fused parameters differ from the reference
+# in float64, or are less accurate than --tol in float32. When the half vector is close to the
+# normal or to wi, phi_d is poorly conditioned in float32 for both implementations, so the
+# tolerance is looser than the typical error.
+import sys
+
+import torch
+import torch.nn.functional as F
+
+import src.refl as refl
+from benchmarks.scenes import ( timeit, metadata, write_json, arguments )
+
+def reference(normal, view, light):
+  frame = refl.coordinate_system(normal)
+  wo = refl.to_local(frame, F.normalize(view, dim=-1))
+  wi = refl.to_local(frame, light)
+  return refl.rusin_params(wo, wi)
+
+def unit(n, device): return F.normalize(torch.randn(n, 3, device=device), dim=-1)
+# flips v into the hemisphere around n.
+def upper(v, n): return torch.where((v * n).sum(dim=-1, keepdim=True) < 0, -v, v)
+def mirror(v, n): return 2 * (v * n).sum(dim=-1, keepdim=True) * n - v
+def jitter(v, scale): return F.normalize(v + scale * torch.randn_like(v), dim=-1)
+
+# each returns (normal, view, light), view points away from the surface like rays do.
+def uniform(n, device):
+  return unit(n, device), unit(n, device), unit(n, device)
+def hemisphere(n, device):
+  normal = unit(n, device)
+  return normal, -upper(unit(n, device), normal), upper(unit(n, device), normal)
+# light near the mirror direction of the view, so the half vector is near the normal.
+def specular(n, device):
+  normal = unit(n, device)
+  wo = upper(unit(n, device), normal)
+  return normal, -wo, upper(jitter(mirror(wo, normal), 1e-3), normal)
+def grazing(n, device):
+  normal = unit(n, device)
+  tangent = F.normalize(torch.cross(normal, unit(n, device), dim=-1), dim=-1)
+  return normal, -upper(unit(n, device), normal), upper(jitter(tangent, 1e-3), normal)
+# normals along the axes, where the frame construction switches branches.
+def axis_aligned(n, device):
+  normal = torch.eye(3, device=device).repeat(n//3 + 1, 1)[:n]
+  normal = normal * torch.where(torch.rand(n, 1, device=device) < 0.5, -1., 1.)
+  return normal, -upper(unit(n, device), normal), upper(unit(n, device), normal)
+
+case_kinds = {
+  "uniform": uniform,
+  "hemisphere": hemisphere,
+  "specular": specular,
+  "grazing": grazing,
+  "axis_aligned": axis_aligned,
+}
+
+param_names = ["cos_phi_d", "cos_theta_h", "cos_theta_d"]
+
+def with_grad(fn, normal, view, light):
+  view, light = view.clone().requires_grad_(), light.clone().requires_grad_()
+  fn(normal, view, light).sum().backward()
+
+def main():
+  a = arguments("Benchmark parity and speed of the fused Rusinkiewicz parameterization")
+  a.add_argument("--samples", type=int, default=1 << 18, help="# of (normal, view, light) per case")
+  a.add_argument("--tol", type=float, default=1e-3, help="Max absolute error in float32 allowed with --check")
+  a.add_argument(
+    "--cases", type=str, nargs="*", default=list(case_kinds.keys()),
+    choices=list(case_kinds.keys()), help="Distributions of directions to compare on",
+  )
+  a.add_argument("--check", action="store_true", help="Exit with an error if above tolerance")
+  opts = a.parse_args()
+  if opts.threads > 0: torch.set_num_threads(opts.threads)
+
+  device = "cuda" if torch.cuda.is_available() else "cpu"
+  results = []
+  failed = False
+  for case in opts.cases:
+    torch.manual_seed(opts.seed)
+    normal, view, light = case_kinds[case](opts.samples, device)
+    with torch.no_grad():
+      exact = reference(normal.double(), view.double(), light.double())
+      parity = (refl.fused_rusin_params(normal.double(), view.double(), light.double()) - exact).abs().max().item()
+      ref_err = (reference(normal, view, light).double() - exact).abs()
+      err = (refl.fused_rusin_params(normal, view, light).double() - exact).abs()
+    entry = { "case": case, "float64_max_difference": parity }
+    for i, name in enumerate(param_names):
+      entry[f"{name}_max_error"] = err[..., i].max().item()
+      entry[f"{name}_mean_error"] = err[..., i].mean().item()
+      entry[f"{name}_reference_max_error"] = ref_err[..., i].max().item()
+      entry[f"{name}_reference_mean_error"] = ref_err[..., i].mean().item()
+    for name, fn in [("reference", reference), ("fused", refl.fused_rusin_params)]:
+      with torch.no_grad():
+        sec = timeit(lambda: fn(normal, view, light), repeats=opts.repeats)
+      entry[f"{name}_sec_per_million"] = sec * 1e6/opts.samples
+      sec = timeit(lambda: with_grad(fn, normal, view, light), repeats=opts.repeats)
+      entry[f"{name}_grad_sec_per_million"] = sec * 1e6/opts.samples
+    results.append(entry)
+    print(
+      f"[note]: {case:>12} float64 diff {parity:.1e}, max err fused " +
+      " ".join(f"{entry[f'{n}_max_error']:.1e}" for n in param_names) + " reference " +
+      " ".join(f"{entry[f'{n}_reference_max_error']:.1e}" for n in param_names) +
+      f", {entry['reference_sec_per_million']:.3f}s/M -> {entry['fused_sec_per_million']:.3f}s/M"
+      f" (grad {entry['reference_grad_sec_per_million']:.3f}s/M -> {entry['fused_grad_sec_per_million']:.3f}s/M)",
+      flush=True,
+    )
+    if opts.check and parity > 1e-9:
+      print(f"[warn]: {case} fused and reference differ by {parity:.2e} in float64")
+      failed = True
+    if opts.check and err.max().item() > opts.tol:
+      print(f"[warn]: {case} max error {err.max().item():.2e} above {opts.tol:.2e}")
+      failed = True
+
+  write_json({
+    "meta": metadata(),
+    "settings": vars(opts),
+    "results": results,
+  }, opts.out)
+  if failed: sys.exit(1)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,114 @@
+# Synthetic scenes and helpers shared by the benchmarks, so that they can run on CPU without
+# any datasets or trained models.
+import argparse
+import json
+import math
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+import torch
+
+import runner
+from src.cameras import NeRFCamera
+from src.camera_paths import look_at
+from src.sdf import SDFModel
+
+# Analytic SDFs, all have no latent so they can be used in place of a learned SDF.
+class Sphere(SDFModel):
+  def __init__(self, center=[0,0,0], rad: float = 0.75):
+    super().__init__(latent_size=0)
+    self.register_buffer("center", torch.tensor(center, dtype=torch.float))
+    self.rad = rad
+  def forward(self, p): return (p - self.center).norm(dim=-1, keepdim=True) - self.rad
+
+# axis aligned box centered at the origin
+class Box(SDFModel):
+  def __init__(self, size=[0.5, 0.4, 0.6]):
+    super().__init__(latent_size=0)
+    self.register_buffer("size", torch.tensor(size, dtype=torch.float))
+  def forward(self, p):
+    q = p.abs() - self.size
+    outside = q.clamp(min=0).norm(dim=-1, keepdim=True)
+    inside = q.max(dim=-1, keepdim=True)[0].clamp(max=0)
+    return outside + inside
+
+# torus around the z-axis, same as gan_sdf.rand_torus but with fixed radii.
+class Torus(SDFModel):
+  def __init__(self, major: float = 0.6, minor: float = 0.2):
+    super().__init__(latent_size=0)
+    self.major = major
+    self.minor = minor
+  def forward(self, p):
+    x, y, z = p.split([1,1,1], dim=-1)
+    q = torch.cat([torch.cat([x, y], dim=-1).norm(dim=-1, keepdim=True) - self.major, z], dim=-1)
+    return q.norm(dim=-1, keepdim=True) - self.minor
+
+analytic_sdfs = {
+  "sphere": Sphere,
+  "box": Box,
+  "torus": Torus,
+}
+
+# random cameras on a sphere around the origin, all looking at the origin.
+def random_cameras(n: int, size: int, radius: float = 4, device="cpu", fov: float = 0.69):
+  cam = NeRFCamera.identity(n, device=device)
+  eye = torch.nn.functional.normalize(torch.randn(n, 3, device=device), dim=-1) * radius
+  cam.cam_to_world = look_at(eye)
+  cam.focal = 0.5 * size/math.tan(0.5 * fov)
+  return cam
+
+# arguments with the defaults of runner.py, overridden by kwargs.
+def default_args(**kwargs):
+  args = runner.parser().parse_args(["--data", ""])
+  args.render_size = args.size
+  args.feature_space = 3
+  args.num_labels = 1
+  for k, v in kwargs.items():
+    assert(hasattr(args, k)), f"Unknown argument {k}"
+    setattr(args, k, v)
+  if args.test_crop_size <= 0: args.test_crop_size = args.crop_size
+  return args
+
+# median seconds per call of fn after warmup.
+def timeit(fn, repeats: int = 5, warmup: int = 1):
+  for _ in range(warmup): fn()
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  times.sort()
+  return times[len(times)//2]
+
+def metadata():
+  try:
+    commit = subprocess.run(
+      ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+    ).stdout.strip()
+  except Exception: commit = None
+  return {
+    "time": datetime.today().strftime('%Y-%m-%d-%H:%M:%S'),
+    "commit": commit,
+    "torch": torch.__version__,
+    "python": platform.python_version(),
+    "machine": platform.machine(),
+    "threads": torch.get_num_threads(),
+  }
+
+def write_json(results, path=None):
+  out = json.dumps(results, indent=2)
+  if path is None: print(out)
+  else:
+    with open(path, "w") as f: f.write(out)
+
+def arguments(description):
+  a = argparse.ArgumentParser(
+    description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+  )
+  a.add_argument("--out", type=str, default=None, help="Where to write JSON results, default stdout")
+  a.add_argument("--repeats", type=int, default=5, help="Number of timed repeats for each case")
+  a.add_argument("--seed", type=int, default=1337, help="Random seed")
+  a.add_argument("--threads", type=int, default=0, help="Number of CPU threads, 0 is torch default")
+  return a
@@ -3,6 +3,7 @@ import torch.optim as optim
 import argparse
 from src.utils import ( save_image )
 import src.refl as refl
+from runner import load_from
 from tqdm import trange
 
 def arguments():
@@ -25,7 +26,7 @@ if torch.cuda.is_available():
 def main():
   args = arguments()
   with torch.no_grad():
-    model = torch.load(args.refl_model)
+    model, _ = load_from(args.refl_model)
     assert(hasattr(model, "refl")), "The provided model must have a refl"
     r = model.refl
     if isinstance(r, refl.LightAndRefl): r = r.refl
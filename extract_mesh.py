@@ -0,0 +1,52 @@
+# Extracts a mesh from a trained SDF or VolSDF model with marching cubes, and writes it as a
+# PLY or OBJ (chosen by extension), optionally with vertex colors from the reflectance:
+#   python extract_mesh.py --model models/lego_volsdf.pt --out lego.ply --resolution 512 --colors
+import argparse
+import time
+
+import torch
+
+import src.mesh as mesh
+from runner import ( load_from, device )
+
+def arguments():
+  a = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  a.add_argument("--model", required=True, type=str, help="Trained model with an SDF")
+  a.add_argument("--out", required=True, type=str, help="Where to save the mesh (.ply or .obj)")
+  a.add_argument("--resolution", type=int, default=256, help="# of grid cells per side")
+  a.add_argument(
+    "--coarse", type=int, default=32,
+    help="# of cells per side of the coarsest grid, resolution must be this times a power of 2",
+  )
+  a.add_argument("--bound", type=float, default=1.5, help="Extract within [-bound, bound]^3")
+  a.add_argument(
+    "--margin", type=float, default=1.5,
+    help="Refine cells where |sdf| < margin * cell diagonal, increase if learned SDF is not Lipschitz",
+  )
+  a.add_argument("--chunk", type=int, default=1 << 18, help="# of points to evaluate at once")
+  a.add_argument("--colors", action="store_true", help="Color vertices with the reflectance")
+  return a.parse_args()
+
+def main():
+  args = arguments()
+  model, _ = load_from(args.model)
+  model = model.eval()
+  sdf, refl = mesh.find_sdf(model)
+
+  start = time.time()
+  vals, evaluated = mesh.sparse_grid(
+    sdf, args.resolution, bound=args.bound, coarse=args.coarse, margin=args.margin,
+    chunk=args.chunk, device=device,
+  )
+  dense = (args.resolution + 1) ** 3
+  print(f"[note]: evaluated {evaluated} of {dense} points ({100 * evaluated/dense:.1f}%)")
+  verts, faces = mesh.marching_cubes(vals, args.bound)
+  if len(faces) == 0: print("[warn]: SDF has no zero level set within bounds, mesh is empty")
+  colors = None
+  if args.colors:
+    if refl is None: print("[warn]: Model has no reflectance, not coloring vertices")
+    else: colors = mesh.vertex_colors(sdf, refl, verts, chunk=args.chunk//4, device=device)
+  mesh.save(args.out, verts, faces, colors)
+  print(f"[note]: wrote {len(verts)} vertices, {len(faces)} faces to {args.out} in {time.time()-start:.1f}s")
+
+if __name__ == "__main__": main()
@@ -11,6 +11,7 @@ from src.neural_blocks import ( SkipConnMLP, FourierEncoder, PointNet )
 from src.cameras import ( OrthogonalCamera )
 from src.march import ( bisect )
 from src.nerf import VolSDF
+from runner import load_from
 import src.refl as refl
 from tqdm import trange
 import matplotlib.pyplot as plt
@@ -586,7 +587,7 @@ def load_model(args):
 def load_targets(args):
   if args.target == "sphere": return [sphere]
   elif args.target == "volsdf":
-    volsdf = torch.load(args.volsdf_model)
+    volsdf, _ = load_from(args.volsdf_model)
     assert(isinstance(volsdf, VolSDF)), "Can only pass VolSDF model"
     sdf = volsdf.sdf
     if args.refl_kind is not None: return [SDFAndRefl(sdf=VolSDFWrapper(sdf), refl=sdf.refl)]
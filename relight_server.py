@@ -0,0 +1,228 @@
+# Long-lived render server for relighting a trained VolSDF or SDF model (with a point light and
+# the direct integrator), so that changing lights does not reload the dataset or model.
+#
+# Requests are JSON objects, either one per line on stdin with responses written one per line to
+# stdout, or POSTed to http://host:port/render when passing --port:
+#   python relight_server.py --model models/lego_volsdf.pt --port 8000
+#   curl -d '{"id": 0, "pose": {"elev": 30, "azim": 45, "rad": 4}, "focal": 1111,
+#     "lights": [{"center": [0, 0, 4], "intensity": 40}], "out": "relit.png"}' localhost:8000/render
+#
+# The camera is either "cam_to_world", a 3x4 or 4x4 matrix, or "pose" as in utils.spherical_pose.
+# "focal" may be omitted if --focal is passed. Each request has a list of point lights which are
+# all rendered together. Responses have the same "id" and either "out" if the image was written
+# there, "image" as a base64 encoded png, or "error".
+#
+# Requests which arrive within --batch-window of each other and share a camera are rendered
+# together: geometry (samples, densities, normals, surface intersections) is computed once per
+# tile, and only occlusion and reflectance are computed for each request's lights.
+import argparse
+import base64
+import io
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import torch
+from PIL import Image
+
+import src.nerf as nerf
+import src.lights as lights
+import src.utils as utils
+from src.cameras import NeRFCamera
+from runner import ( load_from, device )
+
+def arguments():
+  a = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  a.add_argument("--model", required=True, type=str, help="Trained VolSDF or SDF model to load")
+  a.add_argument("--size", type=int, default=None, help="Size of rendered images, default is trained size")
+  a.add_argument("--crop-size", type=int, default=None, help="Size of tiles rendered at once")
+  a.add_argument("--focal", type=float, default=None, help="Focal length if not in the request")
+  a.add_argument("--port", type=int, default=None, help="Serve over HTTP on this port instead of stdin")
+  a.add_argument("--host", type=str, default="127.0.0.1", help="Host to serve HTTP on")
+  a.add_argument(
+    "--batch-window", type=float, default=20, help="Milliseconds to wait for requests to batch",
+  )
+  a.add_argument("--max-batch", type=int, default=16, help="Maximum # of requests to render at once")
+  return a.parse_args()
+
+# Renders a model under sets of lights, each is a Point with one or more lights.
+class Relighter:
+  def __init__(self, model, size: int, crop_size: int, distance_decay: bool = True):
+    if isinstance(model, nerf.AlternatingVolSDF): model = model.volsdf
+    if not hasattr(model, "relight"):
+      raise NotImplementedError(f"Relighting {type(model).__name__}, must be VolSDF or SDF w/ direct")
+    self.model = model.eval()
+    self.size = size
+    self.crop_size = crop_size
+    self.distance_decay = distance_decay
+
+  def light(self, spec):
+    centers, intensities = [], []
+    for l in spec:
+      centers.append([float(v) for v in l["center"]])
+      intn = l.get("intensity", 1)
+      intensities.append([float(intn)] * 3 if np.isscalar(intn) else [float(v) for v in intn])
+    assert(len(centers) > 0), "Must pass at least one light"
+    return lights.Point(
+      center=torch.tensor([centers], device=device),
+      intensity=torch.tensor([intensities], device=device),
+      distance_decay=self.distance_decay,
+    )
+
+  # returns one [H, W, 3] image per set of lights.
+  def render(self, cam, light_sets):
+    size, cs = self.size, self.crop_size
+    ii, jj = torch.meshgrid(
+      torch.arange(size, device=device, dtype=torch.float),
+      torch.arange(size, device=device, dtype=torch.float),
+      indexing="ij",
+    )
+    positions = torch.stack([ii.transpose(-1, -2), jj.transpose(-1, -2)], dim=-1)
+    outs = [torch.zeros(size, size, 3, device=device) for _ in light_sets]
+    with torch.no_grad():
+      for c0 in range(0, size, cs):
+        for c1 in range(0, size, cs):
+          rays = cam.sample_positions(positions[c0:c0+cs, c1:c1+cs], size=size, with_noise=False)
+          for out, got in zip(outs, self.model.relight(rays, light_sets)):
+            out[c0:c0+cs, c1:c1+cs] = got[0]
+    return outs
+
+def parse_camera(req, focal):
+  if "cam_to_world" in req: c2w = torch.tensor(req["cam_to_world"], dtype=torch.float)
+  elif "pose" in req:
+    pose = req["pose"]
+    c2w = utils.spherical_pose(pose["elev"], pose["azim"], pose["rad"])
+  else: raise ValueError("Request must have a camera in cam_to_world or pose")
+  assert(c2w.shape in [(3, 4), (4, 4)]), f"cam_to_world must be 3x4 or 4x4, got {list(c2w.shape)}"
+  focal = req.get("focal", focal)
+  if focal is None: raise ValueError("Request must have a focal length, or pass --focal")
+  c2w = c2w[:3].to(device)
+  # requests with the same camera are batched together.
+  key = (tuple(c2w.flatten().tolist()), float(focal))
+  return NeRFCamera(cam_to_world=c2w[None], focal=float(focal), device=device), key
+
+def encode_png(img):
+  img = (img.clamp(0, 1) * 255).round().byte().cpu().numpy()
+  buf = io.BytesIO()
+  Image.fromarray(img).save(buf, format="PNG")
+  return base64.b64encode(buf.getvalue()).decode("ascii")
+
+# Collects requests on a background thread, grouping those with the same camera so geometry is
+# only computed once for all of their lights.
+class Batcher:
+  def __init__(self, relighter, focal=None, window: float = 0.02, max_batch: int = 16):
+    self.relighter = relighter
+    self.focal = focal
+    self.window = window
+    self.max_batch = max_batch
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  # parses a request on the caller's thread, so invalid requests fail immediately.
+  def submit(self, req) -> Future:
+    future = Future()
+    try:
+      cam, key = parse_camera(req, self.focal)
+      light = self.relighter.light(req["lights"])
+    except Exception as e:
+      future.set_exception(e)
+      return future
+    self.queue.put((key, cam, light, req, future))
+    return future
+
+  def run(self):
+    while True:
+      batch = [self.queue.get()]
+      deadline = time.monotonic() + self.window
+      while len(batch) < self.max_batch:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: break
+        try: batch.append(self.queue.get(timeout=remaining))
+        except queue.Empty: break
+      groups = {}
+      for item in batch: groups.setdefault(item[0], []).append(item)
+      for group in groups.values(): self.render(group)
+
+  def render(self, group):
+    try:
+      imgs = self.relighter.render(group[0][1], [light for _, _, light, _, _ in group])
+      for (_, _, _, req, future), img in zip(group, imgs):
+        out = { "id": req.get("id", None) }
+        if "out" in req:
+          utils.save_image(req["out"], img)
+          out["out"] = req["out"]
+        else: out["image"] = encode_png(img)
+        future.set_result(out)
+    except Exception as e:
+      for *_, future in group:
+        if not future.done(): future.set_exception(e)
+
+def respond(batcher, req):
+  try: return batcher.submit(req).result()
+  except Exception as e: return { "id": req.get("id", None), "error": f"{type(e).__name__}: {e}" }
+
+def serve_http(batcher, host: str, port: int):
+  class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+      if self.path != "/render": return self.send_error(404)
+      try: req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+      except Exception as e: return self.send_error(400, f"Invalid JSON: {e}")
+      body = json.dumps(respond(batcher, req)).encode()
+      self.send_response(200)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+    def log_message(self, *_args): pass
+  server = ThreadingHTTPServer((host, port), Handler)
+  print(f"[note]: serving on http://{host}:{server.server_address[1]}/render", file=sys.stderr, flush=True)
+  try: server.serve_forever()
+  except KeyboardInterrupt: pass
+  finally: server.server_close()
+
+# reads requests from stdin without waiting for earlier ones to finish, so that consecutive
+# requests can be batched, and writes responses in the order requests were received.
+def serve_stdin(batcher):
+  pending = queue.Queue()
+  def write():
+    while True:
+      item = pending.get()
+      if item is None: return
+      req, future = item
+      if isinstance(future, dict): out = future
+      else:
+        try: out = future.result()
+        except Exception as e: out = { "id": req.get("id", None), "error": f"{type(e).__name__}: {e}" }
+      print(json.dumps(out), flush=True)
+  writer = threading.Thread(target=write)
+  writer.start()
+  for line in sys.stdin:
+    if line.strip() == "": continue
+    try: req = json.loads(line)
+    except Exception as e:
+      pending.put(({}, { "id": None, "error": f"Invalid JSON: {e}" }))
+      continue
+    pending.put((req, batcher.submit(req)))
+  pending.put(None)
+  writer.join()
+
+def main():
+  args = arguments()
+  model, ckpt = load_from(args.model)
+  config = {} if ckpt is None else ckpt["config"]
+  size = args.size or config.get("render_size", None) or config.get("size", 128)
+  crop_size = args.crop_size or config.get("test_crop_size", 0) or config.get("crop_size", 0) or 128
+  light = getattr(model.refl, "light", None)
+  distance_decay = getattr(light, "distance_decay", True)
+  relighter = Relighter(model, size=size, crop_size=crop_size, distance_decay=distance_decay)
+  batcher = Batcher(relighter, focal=args.focal, window=args.batch_window/1000, max_batch=args.max_batch)
+  if args.port is not None: serve_http(batcher, args.host, args.port)
+  else: serve_stdin(batcher)
+
+if __name__ == "__main__": main()
@@ -15,7 +15,7 @@ import torch.nn as nn
 import matplotlib.pyplot as plt
 
 from datetime import datetime
-from tqdm import trange, tqdm
+from tqdm import trange
 from itertools import chain
 
 import src.loaders as loaders
@@ -27,13 +27,20 @@ import src.lights as lights
 import src.cameras as cameras
 import src.hyper_config as hyper_config
 import src.renderers as renderers
+import src.checkpoint as checkpoint
+import src.writers as writers
+import src.profiling as profiling
+import src.distributed as distributed
+import src.camera_paths as camera_paths
+import src.accel as accel
+import src.sampling as sampling
 from src.lights import light_kinds
-from src.utils import ( save_image, save_plot, load_image, dir_to_elev_azim )
+from src.utils import ( load_image, dir_to_elev_azim )
 from src.neural_blocks import ( Upsampler, SpatialEncoder, StyleTransfer, FourierEncoder )
 
 import os
 
-def arguments():
+def parser():
   a = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   ST="store_true"
   a.add_argument("-d", "--data", help="path to data", required=True)
@@ -91,9 +98,17 @@ def arguments():
   # this default for LR seems to work pretty well?
   a.add_argument("-lr", "--learning-rate", help="learning rate", type=float, default=5e-4)
   a.add_argument("--seed", help="Random seed to use, -1 is no seed", type=int, default=1337)
+  a.add_argument(
+    "--sampler", help="Samples for depth jitter, crops and sampled directions",
+    choices=list(sampling.sampler_kinds.keys()), default="random",
+  )
   a.add_argument("--decay", help="Weight decay value", type=float, default=0)
   a.add_argument("--notest", help="Do not run test set", action=ST)
   a.add_argument("--data-parallel", help="Use data parallel for the model", action=ST)
+  a.add_argument(
+    "--distributed", action=ST,
+    help="Use DistributedDataParallel, must be launched with torchrun. Batch size is per process",
+  )
   a.add_argument(
     "--omit-bg", action=ST, help="Omit black bg with some probability. Only used for faster training",
   )
@@ -176,6 +191,10 @@ def arguments():
     "--refl-bidirectional", action="store_true",
     help="Allow normals to be flipped for the reflectance (just Diffuse for now)",
   )
+  refla.add_argument(
+    "--rusin-lut", type=int, default=0,
+    help="Tabulate Rusin reflectance with this many samples per angle when rendering, 0 uses the MLP",
+  )
 
   rdra = a.add_argument_group("integrator")
   rdra.add_argument(
@@ -186,6 +205,18 @@ def arguments():
     "--occ-kind", choices=list(renderers.occ_kinds.keys()), default=None,
     help="Occlusion method for shadows to use in integration.",
   )
+  rdra.add_argument(
+    "--path-bounces", type=int, default=1, help="# of indirect bounces when path tracing",
+  )
+  rdra.add_argument(
+    "--path-weight-eps", type=float, default=1e-3,
+    help="Only volume samples with weight above this spawn secondary rays when path tracing",
+  )
+  rdra.add_argument(
+    "--path-roulette", type=int, default=1,
+    help="# of bounces before paths may be terminated by Russian roulette when path tracing SDFs",
+  )
+  rdra.add_argument("--path-samples", type=int, default=1, help="# of paths per pixel when path tracing SDFs")
 
   rdra.add_argument("--smooth-occ", default=0, type=float, help="Weight to smooth occlusion by.")
   rdra.add_argument(
@@ -222,6 +253,18 @@ def arguments():
   sdfa.add_argument(
     "--smooth-eps-rng", action=ST, help="Smooth by random amount instead of smoothing by a fixed distance",
   )
+  sdfa.add_argument(
+    "--reg-freq", type=str, nargs="*", default=[],
+    help=f"Apply a regularizer every N steps with its weight scaled by N, as NAME=N for NAME in {reg_kinds}",
+  )
+  sdfa.add_argument(
+    "--reg-warmup", type=str, nargs="*", default=[],
+    help="Apply a regularizer every step for the first N steps before using its frequency, as NAME=N",
+  )
+  sdfa.add_argument(
+    "--reg-from-render", type=int, default=0,
+    help="If > 0, # of VolSDF render samples to reuse for eikonal and smooth normals, instead of sampling 10240 new points. With --smooth-eps 0 normals are smoothed between adjacent samples along rays, which depends on --steps",
+  )
   sdfa.add_argument(
     "--smooth-n-ord", nargs="+", default=[2], choices=[1,2], type=int,
     help="Order of vector to use when smoothing normals",
@@ -236,9 +279,20 @@ def arguments():
     help="Intersect the learned SDF with a bounding sphere at the origin, < 0 is no sphere",
   )
   sdfa.add_argument(
-    "--sdf-isect-kind", choices=["sphere", "secant", "bisect"], default="bisect",
+    "--sdf-isect-kind", choices=["sphere", "secant", "bisect", "bisect-adaptive"], default="bisect",
     help="Marching kind to use when computing SDF intersection.",
   )
+  sdfa.add_argument(
+    "--sdf-accel", type=int, default=0,
+    help="If > 0, when rendering intersect rays with a voxel grid of the SDF at this resolution",
+  )
+  sdfa.add_argument(
+    "--sdf-accel-bound", type=float, default=1.5, help="Extent of the SDF acceleration grid",
+  )
+  sdfa.add_argument(
+    "--sdf-accel-refine", type=int, default=8,
+    help="# of bisection steps on the true SDF after intersecting the acceleration grid",
+  )
 
   sdfa.add_argument("--volsdf-scale-decay", type=float, default=0, help="Decay weight for volsdf scale")
   dnerfa = a.add_argument_group("dnerf")
@@ -252,11 +306,53 @@ def arguments():
     "--render-over-time", default=-1, type=int,
     help="Fix camera to i, and render over a time frame. < 0 is no camera",
   )
+  dnerfa.add_argument(
+    "--time-schedule", choices=list(time_schedules.keys()), default="sin-sq",
+    help="Times to render at when rendering over time",
+  )
+  dnerfa.add_argument("--render-frames", type=int, default=200, help="# of frames to render over time")
+  dnerfa.add_argument(
+    "--render-video", type=str, default=None,
+    help="Stream frames rendered over time into this video (i.e. .mp4 or .gif) instead of pngs",
+  )
+  dnerfa.add_argument("--video-fps", type=int, default=30, help="Frame rate of rendered videos")
+  dnerfa.add_argument(
+    "--deform-cache", type=int, default=0,
+    help="If > 0, when rendering cache deformations at each time on a grid of this resolution",
+  )
+  dnerfa.add_argument(
+    "--deform-cache-bound", type=float, default=1.5,
+    help="Extent of the deformation cache grid, points outside are evaluated exactly",
+  )
+  dnerfa.add_argument("--deform-cache-size", type=int, default=4, help="# of times to cache")
 
   cama = a.add_argument_group("camera parameters")
   cama.add_argument("--near", help="near plane for camera", type=float, default=2)
   cama.add_argument("--far", help="far plane for camera", type=float, default=6)
   cama.add_argument("--cam-save-load", help="Location to save/load camera to", default=None)
+  cama.add_argument(
+    "--ray-bounds", type=int, default=0,
+    help="If > 0, when rendering clip each ray's near and far to an occupancy grid of this resolution",
+  )
+  cama.add_argument(
+    "--ray-bounds-bound", type=float, default=1.5, help="Extent of the ray bounds occupancy grid",
+  )
+  cama.add_argument(
+    "--ray-bounds-threshold", type=float, default=1e-2,
+    help="Density above which a NeRF's ray bounds cell is occupied",
+  )
+  cama.add_argument(
+    "--novel-views", type=int, default=0,
+    help="After testing, render this many novel views along --camera-path fit to the test cameras",
+  )
+  cama.add_argument(
+    "--camera-path", choices=list(camera_paths.path_kinds.keys()), default="orbit",
+    help="Path of cameras for novel views, interp interpolates between test cameras",
+  )
+  cama.add_argument(
+    "--views-per-batch", type=int, default=1,
+    help="# of views to render in each forward pass when rendering novel views or over time",
+  )
 
   vida = a.add_argument_group("Video parameters")
   vida.add_argument("--start-sec", type=float, default=0, help="Start load time of video")
@@ -286,6 +382,11 @@ def arguments():
   )
   rprt.add_argument("--nosave", help="do not save", action="store_true")
   rprt.add_argument("--load", help="model to load from", type=str)
+  rprt.add_argument(
+    "--resume", action="store_true",
+    help="Resume training from the checkpoint at --save (or --load if it does not exist yet), \
+    including the optimizer, scheduler, RNG state and step",
+  )
   rprt.add_argument("--loss-window", help="# epochs to smooth loss over", type=int, default=250)
   rprt.add_argument("--notraintest", help="Do not test on training set", action="store_true")
   rprt.add_argument(
@@ -306,6 +407,13 @@ def arguments():
   rprt.add_argument("--exp-bg", action="store_true", help="Use mask of labels while rendering. For vis only.")
   rprt.add_argument("--flow-map", action=ST, help="Render a flow map for a dynamic nerf scene")
   rprt.add_argument("--rigidity-map", action=ST, help="Render a flow map for a dynamic nerf scene")
+  rprt.add_argument(
+    "--profile", type=int, default=0,
+    help="Profile the first N training steps and print the time spent in each stage, 0 is off",
+  )
+  rprt.add_argument(
+    "--profile-trace", type=str, default=None, help="Write a Chrome trace of the profiled steps here",
+  )
 
   meta = a.add_argument_group("meta runner parameters")
   meta.add_argument("--torchjit", help="Use torch jit for model", action="store_true")
@@ -316,21 +424,37 @@ def arguments():
     help="Combine a model with an analytic BRDF with a learned BRDF for alternating optimization",
   )
   meta.add_argument("--clip-gradients", type=float, default=0, help="If > 0, clip gradients")
+  meta.add_argument(
+    "--accumulate-steps", type=int, default=1,
+    help="Split each batch into this many micro-batches and accumulate their gradients, to save memory",
+  )
   meta.add_argument("--versioned-save", action="store_true", help="Save with versions")
 
   ae = a.add_argument_group("auto encoder parameters")
   ae.add_argument("--latent-l2-weight", help="L2 regularize latent codes", type=float, default=0)
   ae.add_argument("--normalize-latent", help="L2 normalize latent space", action="store_true")
   ae.add_argument("--encoding-size",help="Intermediate encoding size for AE",type=int,default=32)
+  return a
 
-  args = a.parse_args()
+def arguments():
+  args = parser().parse_args()
 
   # runtime checks
   hyper_config.load(args)
   if args.timed_outdir:
     now = datetime.today().strftime('%Y-%m-%d-%H:%M:%S')
     args.outdir = os.path.join(args.outdir, f"{args.name}{'@' if args.name != '' else ''}{now}")
-  if not os.path.exists(args.outdir): os.mkdir(args.outdir)
+  if args.distributed:
+    assert(not args.data_parallel), "Cannot use both --data-parallel and --distributed"
+    global device
+    device = distributed.init()
+    # ranks may disagree on the time, so use the main rank's outdir.
+    args.outdir = distributed.broadcast(args.outdir)
+    if args.omit_bg:
+      print("[warn]: --omit-bg skips steps independently on each rank, ignoring it")
+      args.omit_bg = False
+  if distributed.is_main() and not os.path.exists(args.outdir): os.mkdir(args.outdir)
+  distributed.barrier()
 
   if not args.neural_upsample:
     args.render_size = args.size
@@ -339,6 +463,11 @@ def arguments():
   if not args.not_magma: plt.magma()
 
   assert(args.valid_freq > 0), "Must pass a valid frequency > 0"
+  assert(args.views_per_batch > 0), "Must render at least 1 view per batch"
+  if args.reg_from_render > 0:
+    assert(args.model == "volsdf"), "--reg-from-render reuses VolSDF render samples, must use --model volsdf"
+  if args.render_video is not None and args.novel_views > 0 and args.render_over_time >= 0:
+    raise NotImplementedError("Can only render one of --novel-views or --render-over-time to a video")
   if (args.test_crop_size <= 0): args.test_crop_size = args.crop_size
   return args
 
@@ -387,14 +516,16 @@ def render(
   t,l,h,w = crop
   positions = positions[t:t+h,l:l+w,:]
 
-  rays = cam.sample_positions(positions, size=size, with_noise=with_noise)
+  with profiling.stage("rays"): rays = cam.sample_positions(positions, size=size, with_noise=with_noise)
 
-  if times is not None: return model((rays, times)), rays
-  elif args.data_kind == "pixel-single": return model((rays, positions)), rays
-  return model(rays), rays
+  with profiling.stage("forward"):
+    if times is not None: return model((rays, times)), rays
+    elif args.data_kind == "pixel-single": return model((rays, positions)), rays
+    return model(rays), rays
 
 
 def save_losses(args, losses):
+  if not distributed.is_main(): return
   outdir = args.outdir
   window = args.loss_window
 
@@ -452,171 +583,293 @@ def load_loss_fn(args, model):
 
 def sqr(x): return x * x
 
+# stops profiling, reporting the summary and writing the trace if one was recorded.
+def finish_profile(args, prof=None):
+  profiling.disable()
+  summary = profiling.summary()
+  print(summary)
+  with open(os.path.join(args.outdir, "profile.txt"), "w") as f: f.write(summary)
+  if prof is None: return
+  prof.stop()
+  prof.export_chrome_trace(args.profile_trace)
+  print(f"[note]: wrote trace to {args.profile_trace}")
+
+# Regularizers which can be scheduled with --reg-freq and --reg-warmup, or in a param file:
+# { "regularizers": { "eikonal": { "freq": 4, "warmup": 1000 } } }
+reg_kinds = ["eikonal", "smooth_normals", "smooth_surface", "smooth_occ"]
+
+# returns {regularizer: [freq, warmup]}, command line arguments override the param file.
+def load_reg_schedule(args):
+  schedule = { name: [1, 0] for name in reg_kinds }
+  if "regularizers" in hyper_config.current.params:
+    for name in reg_kinds:
+      schedule[name][0] = hyper_config.current.get(f"regularizers:{name}:freq", "uint", 1)
+      schedule[name][1] = hyper_config.current.get(f"regularizers:{name}:warmup", "int", 0)
+  for i, items in enumerate([args.reg_freq, args.reg_warmup]):
+    for item in items:
+      name, val = item.split("=")
+      assert(name in reg_kinds), f"Unknown regularizer {name}, must be one of {reg_kinds}"
+      schedule[name][i] = int(val)
+  for name, (freq, warmup) in schedule.items():
+    assert(freq > 0 and warmup >= 0), f"Invalid schedule for {name}: freq {freq}, warmup {warmup}"
+  return schedule
+
+# Multiplier on the weight of each regularizer at step i, 0 if it is skipped on this step.
+# Regularizers are applied every step during warmup, and afterwards every freq steps with their
+# weight scaled by freq so that they have the same total weight.
+def reg_weights(schedule, i: int):
+  out = {}
+  for name, (freq, warmup) in schedule.items():
+    if i < warmup: out[name] = 1
+    elif (i - warmup) % freq == 0: out[name] = freq
+    else: out[name] = 0
+  return out
+
+# Regularizers which depend on the most recent render, such as the points or weights it
+# computed. `share` is the fraction of the batch that was rendered, so that accumulating over
+# micro-batches is equivalent to regularizing the entire batch at once.
+def regularize_render(model, args, rays, display, share: float = 1, weights=None):
+  loss = 0
+  # multiplier on the smooth surface weights from its schedule
+  ws = 1 if weights is None else weights["smooth_surface"]
+  if args.latent_l2_weight > 0:
+    loss = loss + share * args.latent_l2_weight * model.nerf.latent_l2_loss
+
+  # E[div(change in x)] = 0, enforcing the change in motion does not compress space.
+  if args.dyn_diverge_decay > 0:
+    loss=loss+share*args.dyn_diverge_decay*utils.divergence(model.pts, model.dp).mean()
+
+  # smooth_both occlusion and the normals on the surface
+  if args.smooth_surface > 0 and ws > 0:
+    model_ts = nerf.integrable_ts(model.nerf.ts)
+    depth_region = nerf.volumetric_integrate(model.nerf.weights, model_ts)[0,...]
+    r_o, r_d = rays.split([3,3], dim=-1)
+    isect = r_o + r_d * depth_region
+    perturb = F.normalize(torch.randn_like(isect), dim=-1) * 1e-3
+    surface_normals = model.sdf.normals(isect)
+    delta_n = surface_normals - model.sdf.normals(isect + perturb)
+    smoothness = 0
+    for o in args.smooth_n_ord:
+      smoothness = smoothness + torch.linalg.norm(delta_n, ord=o, dim=-1).sum()
+    if args.display_smoothness: display["n-s"] = smoothness.item()
+    # summed over rays, so the sum over micro-batches is already equivalent.
+    loss = loss + ws * args.smooth_surface * smoothness
+    if args.surface_eikonal > 0:
+      loss = loss + share * ws * args.surface_eikonal * utils.eikonal_loss(surface_normals)
+    # smooth occ on the surface
+    if args.smooth_occ > 0:
+      noise = torch.randn([*isect.shape[:-1], model.total_latent_size()], device=device)
+      elaz = dir_to_elev_azim(torch.randn_like(isect, requires_grad=False))
+      isect_elaz = torch.cat([isect, elaz], dim=-1)
+      att = model.occ.attenuation(isect_elaz, noise).sigmoid()
+      perturb = F.normalize(torch.randn_like(isect_elaz), dim=-1) * 5e-2
+      att_shifted = model.occ.attenuation(isect_elaz + perturb, noise)
+      loss = loss + share * ws * args.smooth_surface * (att - att_shifted).abs().mean()
+
+  if args.decay_all_learned_occ > 0:
+    loss = loss + share * args.decay_all_learned_occ * model.occ.all_learned_occ.raw_att.neg().mean()
+
+  if args.delta_x_decay > 0:
+    loss = loss + share * args.delta_x_decay * model.dp.norm(dim=-1).mean()
+  return loss
+
+# Samples points and their (unnormalized) normals from those computed while rendering VolSDF.
+# Also returns the difference in normals between adjacent samples along each ray, or None if the
+# normals were not computed while rendering.
+def render_samples(model, count: int):
+  volsdf = model.nerf
+  pts = volsdf.pts.reshape(-1, 3)
+  if volsdf.raw_n is None:
+    idxs = torch.randint(pts.shape[0], (min(count, pts.shape[0]),), device=pts.device)
+    return pts[idxs].detach(), None, None
+  n = volsdf.raw_n.reshape(-1, 3)
+  # samples are ordered along each ray in the first dimension, so flat index i of the first
+  # (steps-1)*rays samples is followed along its ray by i+rays, and delta_n[i] is between them.
+  delta_n = (volsdf.raw_n[1:] - volsdf.raw_n[:-1]).reshape(-1, 3)
+  idxs = torch.randint(delta_n.shape[0], (min(count, delta_n.shape[0]),), device=pts.device)
+  return pts[idxs], n[idxs], delta_n[idxs]
+
+# Regularizers which are independent of the batch, they are only computed once per step.
+def regularize_samples(model, args, display, weights=None):
+  w = lambda name: 1 if weights is None else weights[name]
+  eikonal = args.sdf_eikonal * w("eikonal")
+  smooth_normals = args.smooth_normals * w("smooth_normals")
+  smooth_occ = args.smooth_occ * w("smooth_occ")
+  loss = 0
+  pts = None
+  delta_n = None
+  # prepare one set of points for either smoothing normals or eikonal.
+  if (eikonal > 0 or smooth_normals > 0) and args.reg_from_render > 0:
+    pts, n, delta_n = render_samples(model, args.reg_from_render)
+    if n is None: n = model.sdf.normals(pts)
+  elif eikonal > 0 or smooth_normals > 0:
+    # NOTE the number of points just fits in memory, can modify it at will
+    pts = 5*(torch.randn(((1<<13) * 5)//4 , 3, device=device))
+    n = model.sdf.normals(pts)
+
+  # E[d sdf(x)/dx] = 1, enforces that the SDF is valid.
+  if eikonal > 0: loss = loss + eikonal * utils.eikonal_loss(n)
+
+  # automatically apply eikonal loss for DynamicNeRF
+  if eikonal > 0 and isinstance(model, nerf.DynamicNeRF):
+    t = torch.rand(*pts.shape[:-1], 1, device=device)
+    dp = model.time_estim(pts, t)
+    n_dyn = model.sdf.normals(pts + dp)
+    loss = loss + eikonal * utils.eikonal_loss(n_dyn)
+
+  if args.volsdf_scale_decay > 0: loss = loss + args.volsdf_scale_decay * model.scale_post_act
+
+  # dn/dx -> 0, hopefully smoothes out the local normals of the surface.
+  if smooth_normals > 0:
+    s_eps = args.smooth_eps
+    if s_eps > 0:
+      if args.smooth_eps_rng: s_eps = random.random() * s_eps
+      # epsilon-perturbation implementation from unisurf
+      perturb = F.normalize(torch.randn_like(pts), dim=-1) * s_eps
+      delta_n = n - model.sdf.normals(pts + perturb)
+    # if reusing samples from rendering, delta_n is already between adjacent samples along rays.
+    elif delta_n is None:
+      delta_n = torch.autograd.grad(
+        inputs=pts, outputs=F.normalize(n, dim=-1), create_graph=True,
+        grad_outputs=torch.ones_like(n),
+      )[0]
+    smoothness = 0
+    for o in args.smooth_n_ord:
+      smoothness = smoothness + torch.linalg.norm(delta_n, ord=o, dim=-1).sum()
+    if args.display_smoothness: display["n-*"] = smoothness.item()
+    loss = loss + smooth_normals * smoothness
+
+  # smoothing the shadow, randomly over points and directions.
+  if smooth_occ > 0:
+    if pts is None:
+      pts = 5*(torch.randn(((1<<13) * 5)//4 , 3, device=device, requires_grad=True))
+    elaz = dir_to_elev_azim(torch.randn_like(pts, requires_grad=True))
+    pts_elaz = torch.cat([pts, elaz], dim=-1)
+    noise = torch.randn(pts.shape[0], model.total_latent_size(),device=device)
+    att = model.occ.attenuation(pts_elaz, noise).sigmoid()
+    perturb = F.normalize(torch.randn_like(pts_elaz), dim=-1) * 1e-2
+    att_shifted = model.occ.attenuation(pts_elaz + perturb, noise)
+    loss = loss + smooth_occ * (att - att_shifted).abs().mean()
+  return loss
+
 # train the model with a given camera and some labels (imgs or imgs+times)
 # light is a per instance light.
-def train(model, cam, labels, opt, args, sched=None):
+# `forward` computes the forward pass if the model is wrapped (i.e. for distributed training),
+# `model` is always used to access its attributes.
+def train(
+  model, cam, labels, opt, args, sched=None, start: int = 0, writer=None, forward=None,
+):
   if args.epochs == 0: return
+  if writer is None: writer = writers.ImageWriter(background=False)
+  if forward is None: forward = model
 
   loss_fn = load_loss_fn(args, model)
 
-  iters = range(args.epochs) if args.quiet else trange(args.epochs)
+  quiet = args.quiet or not distributed.is_main()
+  iters = range(start, args.epochs) if quiet else trange(start, args.epochs)
   update = lambda kwargs: iters.set_postfix(**kwargs)
-  if args.quiet: update = lambda _: None
+  if quiet: update = lambda _: None
   times=None
   if type(labels) is tuple:
     times = labels[-1]
     labels = labels[0]
   batch_size = min(args.batch_size, labels.shape[0])
+  accumulate = args.accumulate_steps
+  reg_schedule = load_reg_schedule(args)
+  assert(batch_size >= accumulate), "Cannot split the batch into more micro-batches than views"
 
   get_crop = lambda: (0,0, args.size, args.size)
   cs = args.crop_size
   if cs != 0:
-    get_crop = lambda: (
-      random.randint(0, args.render_size-cs), random.randint(0, args.render_size-cs), cs, cs,
-    )
+    def get_crop():
+      x, y = (sampling.uniform(1, 2, stream="crop")[0] * (args.render_size-cs+1)).long().tolist()
+      return x, y, cs, cs
 
   next_idxs = lambda _: random.sample(range(labels.shape[0]), batch_size)
   if args.serial_idxs: next_idxs = lambda i: [i%len(cam)] * batch_size
   #next_idxs = lambda i: [i%10] * batch_size # DEBUG
 
   losses = []
-  start = time.time()
+  start_time = time.time()
   should_end = lambda: False
-  if args.duration_sec > 0: should_end = lambda: time.time() - start > args.duration_sec
-
+  if args.duration_sec > 0:
+    should_end = lambda: distributed.any(time.time() - start_time > args.duration_sec)
+
+  prof = None
+  if args.profile > 0 and distributed.is_main():
+    profiling.enable()
+    if args.profile_trace is not None:
+      activities = [torch.profiler.ProfilerActivity.CPU]
+      if torch.cuda.is_available(): activities.append(torch.profiler.ProfilerActivity.CUDA)
+      prof = torch.profiler.profile(activities=activities)
+      prof.start()
+
+  # the next step to take, used when saving for resumption
+  step = start
   for i in iters:
     if should_end():
       print("Training timed out")
       break
+    step = i + 1
+    profiling.begin_step()
 
     opt.zero_grad()
 
     idxs = next_idxs(i)
-
-    ts = None if times is None else times[idxs]
     c0,c1,c2,c3 = crop = get_crop()
     ref = labels[idxs][:, c0:c0+c2,c1:c1+c3, :3]
 
-    if getattr(model.refl, "light", None) is not None:
-      model.refl.light.set_idx(torch.tensor(idxs, device=device))
-
     # omit items which are all darker with some likelihood. This is mainly used when
     # attempting to focus on learning the refl and not the shape.
     if args.omit_bg and (i % args.save_freq) != 0 and (i % args.valid_freq) != 0 and \
       ref.mean() + 0.3 < sqr(random.random()): continue
 
-    out, rays = render(model, cam[idxs], crop, size=args.render_size, times=ts, args=args)
-    loss = loss_fn(out, ref)
-    assert(loss.isfinite()), f"Got {loss.item()} loss"
-    l2_loss = loss.item()
-    display = {
-      "l2": f"{l2_loss:.04f}",
-      "refresh": False,
-    }
+    display = { "refresh": False }
     if sched is not None: display["lr"] = f"{sched.get_last_lr()[0]:.1e}"
-
-    if args.latent_l2_weight > 0: loss = loss + model.nerf.latent_l2_loss * latent_l2_weight
-
-    pts = None
-    # prepare one set of points for either smoothing normals or eikonal.
-    if args.sdf_eikonal > 0 or args.smooth_normals > 0:
-      # NOTE the number of points just fits in memory, can modify it at will
-      pts = 5*(torch.randn(((1<<13) * 5)//4 , 3, device=device))
-      n = model.sdf.normals(pts)
-
-    # E[d sdf(x)/dx] = 1, enforces that the SDF is valid.
-    if args.sdf_eikonal > 0: loss = loss + args.sdf_eikonal * utils.eikonal_loss(n)
-    # E[div(change in x)] = 0, enforcing the change in motion does not compress space.
-    if args.dyn_diverge_decay > 0:
-      loss=loss+args.dyn_diverge_decay*utils.divergence(model.pts, model.dp).mean()
-
-    # automatically apply eikonal loss for DynamicNeRF
-    if args.sdf_eikonal > 0 and isinstance(model, nerf.DynamicNeRF):
-      t = torch.rand(*pts.shape[:-1], 1, device=device)
-      dp = model.time_estim(pts, t)
-      n_dyn = model.sdf.normals(pts + dp)
-      loss = loss + args.sdf_eikonal * utils.eikonal_loss(n_dyn)
-
-    if args.volsdf_scale_decay > 0: loss = loss + args.volsdf_scale_decay * model.scale_post_act
-
-
-    # dn/dx -> 0, hopefully smoothes out the local normals of the surface.
-    if args.smooth_normals > 0:
-      s_eps = args.smooth_eps
-      if s_eps > 0:
-        if args.smooth_eps_rng: s_eps = random.random() * s_eps
-        # epsilon-perturbation implementation from unisurf
-        perturb = F.normalize(torch.randn_like(pts), dim=-1) * s_eps
-        delta_n = n - model.sdf.normals(pts + perturb)
-      else:
-        delta_n = torch.autograd.grad(
-          inputs=pts, outputs=F.normalize(n, dim=-1), create_graph=True,
-          grad_outputs=torch.ones_like(n),
-        )[0]
-      smoothness = 0
-      for o in args.smooth_n_ord:
-        smoothness = smoothness + torch.linalg.norm(delta_n, ord=o, dim=-1).sum()
-      if args.display_smoothness: display["n-*"] = smoothness.item()
-      loss = loss + args.smooth_normals * smoothness
-
-    # smooth_both occlusion and the normals on the surface
-    if args.smooth_surface > 0:
-      model_ts = model.nerf.ts[:, None, None, None, None]
-      depth_region = nerf.volumetric_integrate(model.nerf.weights, model_ts)[0,...]
-      r_o, r_d = rays.split([3,3], dim=-1)
-      isect = r_o + r_d * depth_region
-      perturb = F.normalize(torch.randn_like(isect), dim=-1) * 1e-3
-      surface_normals = model.sdf.normals(isect)
-      delta_n = surface_normals - model.sdf.normals(isect + perturb)
-      smoothness = 0
-      for o in args.smooth_n_ord:
-        smoothness = smoothness + torch.linalg.norm(delta_n, ord=o, dim=-1).sum()
-      if args.display_smoothness: display["n-s"] = smoothness.item()
-      loss = loss + args.smooth_surface * smoothness
-      if args.surface_eikonal > 0: loss = loss + args.surface_eikonal * utils.eikonal_loss(surface_normals)
-      # smooth occ on the surface
-    if args.smooth_occ > 0 and args.smooth_surface > 0:
-      noise = torch.randn([*isect.shape[:-1], model.total_latent_size()], device=device)
-      elaz = dir_to_elev_azim(torch.randn_like(isect, requires_grad=False))
-      isect_elaz = torch.cat([isect, elaz], dim=-1)
-      att = model.occ.attenuation(isect_elaz, noise).sigmoid()
-      perturb = F.normalize(torch.randn_like(isect_elaz), dim=-1) * 5e-2
-      att_shifted = model.occ.attenuation(isect_elaz + perturb, noise)
-      loss = loss + args.smooth_surface * (att - att_shifted).abs().mean()
-
-    # smoothing the shadow, randomly over points and directions.
-    if args.smooth_occ > 0:
-      if pts is None:
-        pts = 5*(torch.randn(((1<<13) * 5)//4 , 3, device=device, requires_grad=True))
-      elaz = dir_to_elev_azim(torch.randn_like(pts, requires_grad=True))
-      pts_elaz = torch.cat([pts, elaz], dim=-1)
-      noise = torch.randn(pts.shape[0], model.total_latent_size(),device=device)
-      att = model.occ.attenuation(pts_elaz, noise).sigmoid()
-      perturb = F.normalize(torch.randn_like(pts_elaz), dim=-1) * 1e-2
-      att_shifted = model.occ.attenuation(pts_elaz + perturb, noise)
-      loss = loss + args.smooth_occ * (att - att_shifted).abs().mean()
-
-    if args.decay_all_learned_occ > 0:
-      loss = loss + args.decay_all_learned_occ * model.occ.all_learned_occ.raw_att.neg().mean()
-
-    if args.delta_x_decay > 0:
-      loss = loss + args.delta_x_decay * model.dp.norm(dim=-1).mean()
-
+    # split the batch into micro-batches of views, accumulating gradients over them.
+    n = len(idxs)
+    chunks = [idxs[k*n//accumulate:(k+1)*n//accumulate] for k in range(accumulate)]
+    l2_loss = 0
+    weights = reg_weights(reg_schedule, i)
+    for k, chunk in enumerate(chunks):
+      last = k == len(chunks) - 1
+      share = len(chunk)/n
+      ts = None if times is None else times[chunk]
+      ref = labels[chunk][:, c0:c0+c2,c1:c1+c3, :3]
+
+      if getattr(model.refl, "light", None) is not None:
+        model.refl.light.set_idx(torch.tensor(chunk, device=device))
+
+      # only synchronize gradients across ranks once they are fully accumulated.
+      with distributed.no_sync(forward, not last):
+        out, rays = render(forward, cam[chunk], crop, size=args.render_size, times=ts, args=args)
+        with profiling.stage("loss"): loss = loss_fn(out, ref)
+        assert(loss.isfinite()), f"Got {loss.item()} loss"
+        l2_loss += share * loss.item()
+
+        loss = share * loss + regularize_render(model, args, rays, display, share, weights)
+        if last: loss = loss + regularize_samples(model, args, display, weights)
+
+        assert(loss.isfinite().item()), "Got NaN loss"
+        with profiling.stage("backward"): loss.backward()
+
+    display["l2"] = f"{l2_loss:.04f}"
     update(display)
     losses.append(l2_loss)
 
-    assert(loss.isfinite().item()), "Got NaN loss"
-    loss.backward()
-    if args.clip_gradients > 0: nn.utils.clip_grad_norm_(model.parameters(), args.clip_gradients)
-    opt.step()
+    with profiling.stage("optimizer"):
+      if args.clip_gradients > 0: nn.utils.clip_grad_norm_(model.parameters(), args.clip_gradients)
+      opt.step()
     if sched is not None: sched.step()
     if args.inc_fourier_freqs:
       for module in model.modules():
         if not isinstance(module, FourierEncoder): continue
         module.scale_freqs()
+    profiling.end_step()
+    if profiling.enabled and profiling.steps >= args.profile: finish_profile(args, prof)
 
     # Save outputs within the cropped region.
-    if i % args.valid_freq == 0:
+    if i % args.valid_freq == 0 and distributed.is_main():
       with torch.no_grad():
         ref0 = ref[0,...,:3]
         items = [ref0, out[0,...,:3].clamp(min=0, max=1)]
@@ -626,7 +879,7 @@ def train(model, cam, labels, opt, args, sched=None):
 
         if args.depth_images and hasattr(model, "nerf"):
           raw_depth = nerf.volumetric_integrate(
-            model.nerf.weights, model.nerf.ts[:, None, None, None, None]
+            model.nerf.weights, nerf.integrable_ts(model.nerf.ts)
           )
           depth = (raw_depth[0]-args.near)/(args.far - args.near)
           items.append(depth.clamp(min=0, max=1))
@@ -640,29 +893,33 @@ def train(model, cam, labels, opt, args, sched=None):
         if args.rigidity_map and hasattr(model, "rigidity"):
           rigidity_map = nerf.volumetric_integrate(model.nerf.weights, model.rigidity)[0]
           items.append(rigidity_map)
-        save_plot(os.path.join(args.outdir, f"valid_{i:05}.png"), *items)
+        writer.plot(os.path.join(args.outdir, f"valid_{i:05}.png"), *items)
 
     if i % args.save_freq == 0 and i != 0:
       version = (i // args.save_freq) if args.versioned_save else None
-      save(model, cam, args, version)
+      save(model, cam, args, version, opt=opt, sched=sched, step=step)
       save_losses(args, losses)
+  if profiling.enabled: finish_profile(args, prof)
   # final save does not have a version and will write to original file
-  save(model, cam, args)
+  save(model, cam, args, opt=opt, sched=sched, step=step)
   save_losses(args, losses)
 
-def test(model, cam, labels, args, training: bool = True):
+def test(model, cam, labels, args, training: bool = True, writer=None):
+  if writer is None: writer = writers.ImageWriter(background=False)
   times = None
   model = model.eval()
   if type(labels) == tuple:
     times = labels[-1]
     labels = labels[0]
 
-  ls = []
-  gots = []
+  # when distributed, views are sharded across ranks and the results are gathered on the main
+  # rank. Each entry is ((offset, view), line to print, psnr, rendered image).
+  rank, world = distributed.rank(), distributed.world_size()
+  results = []
 
   def render_test_set(model, cam, labels, offset=0):
     with torch.no_grad():
-      for i in range(labels.shape[0]):
+      for i in range(rank, labels.shape[0], world):
         ts = None if times is None else times[i:i+1, ...]
         exp = labels[i,...,:3]
         got = torch.zeros_like(exp)
@@ -691,7 +948,7 @@ def test(model, cam, labels, args, training: bool = True):
             got[c0:c0+cs, c1:c1+cs, :] = out
 
             if hasattr(model, "nerf") and args.depth_images:
-              model_ts = model.nerf.ts[:, None, None, None, None]
+              model_ts = nerf.integrable_ts(model.nerf.ts)
               depth[c0:c0+cs, c1:c1+cs, :] = \
                 nerf.volumetric_integrate(model.nerf.weights, model_ts)[0,...]
             if hasattr(model, "n") and hasattr(model, "nerf") :
@@ -713,12 +970,16 @@ def test(model, cam, labels, args, training: bool = True):
               rigidity_map[c0:c0+cs,c1:c1+cs] = \
                 nerf.volumetric_integrate(model.nerf.weights, model.rigidity)
 
-        gots.append(got)
         loss = F.mse_loss(got, exp)
         psnr = utils.mse2psnr(loss).item()
         ts = "" if ts is None else f",t={ts.item():.02f}"
         o = i + offset
-        print(f"[{o:03}{ts}]: L2 {loss.item():.03f} PSNR {psnr:.03f}")
+        line = f"[{o:03}{ts}]: L2 {loss.item():.03f} PSNR {psnr:.03f}"
+        if world == 1: print(line)
+        # only needed for ms-ssim, and have to be sent to the main rank on the cpu.
+        kept = None
+        if args.msssim_loss: kept = got if world == 1 else got.cpu()
+        results.append(((offset, i), line, psnr, kept))
         name = f"train_{o:03}.png" if training else f"test_{o:03}.png"
         if args.gamma_correct:
           exp = exp.clamp(min=1e-10)**(1/2.2)
@@ -746,8 +1007,7 @@ def test(model, cam, labels, args, training: bool = True):
             elif item.shape[-1] == 1: new_items.append(item * labels[i,...,3:])
             else: new_items.append(torch.cat([item, labels[i,...,3:]], dim=-1))
           items = new_items
-        save_plot(os.path.join(args.outdir, name), *items)
-        ls.append(psnr)
+        writer.plot(os.path.join(args.outdir, name), *items)
 
   rf = args.render_frame
   if args.render_frame >= 0:
@@ -766,6 +1026,13 @@ def test(model, cam, labels, args, training: bool = True):
     render_test_set(model, multi_cams, multi_labels, offset=100)
     labels =  torch.cat([labels, multi_labels], dim=0)
 
+  if world > 1:
+    results = [r for rank_results in distributed.all_gather(results) for r in rank_results]
+    if not distributed.is_main(): return
+    results.sort(key=lambda r: r[0])
+    for r in results: print(r[1])
+  ls = [r[2] for r in results]
+
   summary_string = f"""[Summary ({"training" if training else "test"})]:
 \tmean {np.mean(ls):.03f}
 \tmin {min(ls):.03f}
@@ -773,35 +1040,130 @@ def test(model, cam, labels, args, training: bool = True):
 \tvar {np.var(ls):.03f}"""
   if args.msssim_loss:
     with torch.no_grad():
+      gots = [r[3].to(device) for r in results]
       msssim = utils.msssim_loss(gots, labels)
       summary_string += f"\nms-ssim {msssim:.03f}"
   print(summary_string)
   with open(os.path.join(args.outdir, "results.txt"), 'w') as f:
     f.write(summary_string)
 
+# renders entire images from a batch of cameras, in tiles of test_crop_size.
+# All views in the batch are rendered in the same forward pass, returns [B, H, W, 3].
+def render_full(model, cam, args, times=None):
+  got = torch.zeros(len(cam), args.render_size, args.render_size, 3, device=device)
+  cs = args.test_crop_size
+  N = math.ceil(args.render_size/cs)
+  for x in range(N):
+    for y in range(N):
+      c0 = x * cs
+      c1 = y * cs
+      out, _rays = render(
+        model, cam, (c0,c1,cs,cs), size=args.render_size,
+        with_noise=False, times=times, args=args,
+      )
+      got[:, c0:c0+cs, c1:c1+cs, :] = out
+  return got
+
+# schedules of times for rendering over time, from # of frames to times in [0, 1].
+def sin_sq_times(n: int):
+  ts = torch.linspace(0, math.pi, steps=n, device=device)
+  ts = ts * ts
+  return ((ts.sin()+1)/2)
+
+time_schedules = {
+  "sin-sq": sin_sq_times,
+  "linear": lambda n: torch.linspace(0, 1, steps=n, device=device),
+  "pingpong": lambda n: 1 - (torch.linspace(-1, 1, steps=n, device=device)).abs(),
+}
+
+# Renders frame i from cams[i % len(cams)] at times[i] (if given), either streaming into a
+# video at args.render_video or writing each frame as a png with the given prefix.
+# args.views_per_batch frames are rendered together.
+def render_frames(args, model, cams, times=None, frames: int = None, prefix="frame"):
+  if frames is None: frames = len(cams) if times is None else len(times)
+  if args.render_video is not None:
+    writer = writers.VideoWriter(args.render_video, fps=args.video_fps)
+  else: writer = writers.ImageWriter()
+  V = args.views_per_batch
+  try:
+    with torch.no_grad():
+      for i in trange(0, frames, V):
+        idxs = torch.arange(i, min(i+V, frames), device=device)
+        t = None if times is None else times[idxs]
+        got = render_full(model, cams[idxs % len(cams)], args, times=t)
+        for j, img in zip(idxs.tolist(), got):
+          if args.render_video is not None: writer.frame(img)
+          else: writer.image(os.path.join(args.outdir, f"{prefix}_{j:03}.png"), img)
+  finally: writer.close()
+  if args.render_video is not None: print(f"[note]: wrote video to {args.render_video}")
+
 def render_over_time(args, model, cam):
   cam = cam[args.render_over_time:args.render_over_time+1]
-  ts = torch.linspace(0, math.pi, steps=200, device=device)
-  ts = ts * ts
-  ts = ((ts.sin()+1)/2)
-  with torch.no_grad():
-    for i, t in enumerate(tqdm(ts)):
-      got = torch.zeros(args.render_size, args.render_size, 3, device=device)
-      cs = args.test_crop_size
-      N = math.ceil(args.render_size/cs)
-      for x in range(N):
-        for y in range(N):
-          c0 = x * cs
-          c1 = y * cs
-          out, _rays = render(
-            model, cam, (c0,c1,cs,cs), size=args.render_size,
-            with_noise=False, times=t.unsqueeze(0), args=args,
-          )
-          got[c0:c0+cs, c1:c1+cs, :] = out.squeeze(0)
-      save_image(os.path.join(args.outdir, f"time_{i:03}.png"), got)
+  ts = time_schedules[args.time_schedule](args.render_frames)
+  render_frames(args, model, cam, ts, prefix="time")
+
+# renders novel views along a camera path fit to cam, dynamic models are also rendered over time.
+def render_novel_views(args, model, cam):
+  path = camera_paths.load(args.camera_path, cam, args.novel_views)
+  ts = None
+  if args.is_dyn: ts = time_schedules[args.time_schedule](args.novel_views)
+  render_frames(args, model, path, ts, prefix="novel")
+
+def set_ray_bounds(model, args):
+  bounds = accel.RayBounds(
+    args.ray_bounds, bound=args.ray_bounds_bound, threshold=args.ray_bounds_threshold,
+  )
+  if not isinstance(model, (nerf.CommonNeRF, nerf.AlternatingVolSDF)):
+    if isinstance(getattr(model, "sdf", None), sdf.SDF): return model.sdf.set_bounds(bounds)
+    return print("[warn]: Model is not a static NeRF or SDF, ignoring `--ray-bounds`.")
+  model = model.nerf
+  if type(model).density is nerf.CommonNeRF.density:
+    return print(f"[warn]: Bounds for {type(model).__name__} are not supported, ignoring `--ray-bounds`.")
+  if model.total_latent_size() != 0:
+    return print("[warn]: Models with latent vectors are not supported, ignoring `--ray-bounds`.")
+  model.set_bounds(bounds)
+
+def set_path_options(model, args):
+  if isinstance(model, renderers.Path):
+    assert(args.path_samples > 0), "Must have at least one path per pixel"
+    model.bounces = args.path_bounces
+    model.roulette = args.path_roulette
+    model.samples = args.path_samples
+  if not isinstance(model, nerf.VolSDF) or model.secondary != model.path: return
+  assert(args.path_bounces > 0), "Must have at least one bounce when path tracing"
+  model.path_bounces = args.path_bounces
+  model.path_eps = args.path_weight_eps
+
+def set_rusin_lut(model, args):
+  r = getattr(model, "refl", None)
+  if r is None: r = getattr(getattr(model, "sdf", None), "refl", None)
+  if isinstance(r, refl.LightAndRefl): r = r.refl
+  if not isinstance(r, refl.Rusin):
+    return print("[warn]: Model does not have a Rusin reflectance, ignoring `--rusin-lut`.")
+  if r.space.dims != 0 or r.latent_size != 0:
+    return print("[warn]: Rusin reflectance depends on position or latent, ignoring `--rusin-lut`.")
+  r.set_lut(refl.RusinLUT(args.rusin_lut))
 
 # Sets these parameters on the model on each run, regardless if loaded from previous state.
 def set_per_run(model, args):
+  # only affects rendering, so also applies when not training.
+  if args.deform_cache > 0:
+    if isinstance(model, nerf.DynamicNeRF):
+      model.set_deform_cache(nerf.DeformationCache(
+        args.deform_cache, bound=args.deform_cache_bound, size=args.deform_cache_size,
+      ))
+    else: print("[warn]: Model is not an instance of dynamic nerf, ignoring `--deform-cache`.")
+  if args.sdf_accel > 0:
+    if isinstance(getattr(model, "sdf", None), sdf.SDF):
+      model.sdf.set_accel(accel.SDFGrid(
+        args.sdf_accel, bound=args.sdf_accel_bound, refine=args.sdf_accel_refine,
+      ))
+    else: print("[warn]: Model does not have an SDF, ignoring `--sdf-accel`.")
+  if args.ray_bounds > 0: set_ray_bounds(model, args)
+  set_path_options(model, args)
+  if args.rusin_lut > 0: set_rusin_lut(model, args)
+  # each process scrambles its sequences differently.
+  sampling.set_sampler(args.sampler, seed=max(args.seed, 0) + distributed.rank())
   if args.epochs == 0: return
   if isinstance(model, nerf.CommonNeRF): model.steps = args.steps
   if not isinstance(model, nerf.VolSDF): args.volsdf_scale_decay = 0
@@ -844,6 +1206,7 @@ def set_per_run(model, args):
     assert(isinstance(model, nerf.VolSDF)), "--volsdf-direct-to-path only applies to VolSDF"
     if model.convert_to_path(): model = model.to(device)
     else: print("[note]: Model already uses pathtracing, nothing changed.")
+    set_path_options(model, args)
 
   if args.all_learned_to_joint:
     assert(hasattr(model, "occ")), "Model must have occlusion parameter for converstion to join"
@@ -899,13 +1262,17 @@ def load_model(args, light, is_dyn=False):
   model = nerf.load_nerf(args).to(device)
 
   # set reflectance kind for new models (but volsdf handles it differently)
-  if args.refl_kind != "curr":
+  if args.refl_kind != "curr" and model.refl is None:
+    print(f"[warn]: {type(model).__name__} does not have a reflectance model, ignoring `--refl-kind`.")
+  elif args.refl_kind != "curr":
     ls = model.refl.latent_size
     refl_inst = refl.load(args, args.refl_kind, args.space_kind, ls).to(device)
     model.set_refl(refl_inst)
 
   if args.mpi: model = nerf.MPI(canonical=model).to(device)
-  if is_dyn: model = nerf.load_dyn(args, model, device).to(device)
+  if is_dyn:
+    load_canon = lambda path: load_from(path, args, light)[0]
+    model = nerf.load_dyn(args, model, device, load=load_canon).to(device)
 
   if args.data_kind == "pixel-single":
     encoder = SpatialEncoder().to(device)
@@ -938,12 +1305,12 @@ def load_model(args, light, is_dyn=False):
   if args.torchjit: model = torch.jit.script(model)
   return model
 
-def save(model, cam, args, version=None):
-  if args.nosave: return
+def save(model, cam, args, version=None, opt=None, sched=None, step: int = 0):
+  if args.nosave or not distributed.is_main(): return
   save = args.save if version is None else f"{args.save}_{version}.pt"
   print(f"Saved to {save}")
   if args.torchjit: raise NotImplementedError()
-  else: torch.save(model, save)
+  else: checkpoint.save(save, model, args.__dict__, opt=opt, sched=sched, step=step)
 
   if args.log is not None:
     setattr(args, "curr_time", datetime.today().strftime('%Y-%m-%d-%H:%M:%S'))
@@ -951,6 +1318,25 @@ def save(model, cam, args, version=None):
       json.dump(args.__dict__, f, indent=2)
   if args.cam_save_load is not None: torch.save(cam, args.cam_save_load)
 
+# Loads a model from either a checkpoint or an entire pickled module (older format).
+# Checkpoints are rebuilt from the arguments they were saved with, and missing arguments
+# are filled in from `args` or the defaults. Returns the model and checkpoint (or None).
+def load_from(path, args=None, light=None):
+  loaded = checkpoint.load(path, map_location=device)
+  if not checkpoint.is_checkpoint(loaded): return loaded, None
+
+  config = vars(args).copy() if args is not None else \
+    vars(parser().parse_args(["--data", loaded["config"]["data"]]))
+  config.update(loaded["config"])
+  config = argparse.Namespace(**config)
+  # weights come from the checkpoint, do not load the canonical model again
+  config.with_canon = None
+  model = load_model(config, light, getattr(config, "is_dyn", False))
+  # reapply conversions that were made to the model before it was saved
+  set_per_run(model, config)
+  checkpoint.load_state(model, loaded)
+  return model, loaded
+
 def seed(s):
   if s == -1: return
   torch.manual_seed(s)
@@ -964,13 +1350,20 @@ def main():
 
   labels, cam, light = loaders.load(args, training=True, device=device)
   is_dyn = type(labels) == tuple
+  setattr(args, "is_dyn", is_dyn)
+  setattr(args, "num_labels", len(labels))
 
-  model = load_model(args, light, is_dyn) if args.load is None else torch.load(args.load, map_location=device)
+  load = args.load
+  if args.resume:
+    if os.path.exists(args.save): load = args.save
+    elif load is None: print(f"[note]: no checkpoint at {args.save} to resume from, starting new run")
+  ckpt = None
+  if load is None: model = load_model(args, light, is_dyn)
+  else: model, ckpt = load_from(load, args, light)
   if args.cam_save_load is not None:
     try: cam = torch.load(args.cam_save_load, map_location=device)
     except Exception as e: print(f"[warn]: Failed to load camera: {e}")
 
-  setattr(args, "num_labels", len(labels))
   if args.train_imgs > 0:
     if is_dyn: labels = tuple(l[:args.train_imgs, ...] for l in labels)
     else: labels = labels[:args.train_imgs, ...]
@@ -1002,15 +1395,36 @@ def main():
 
   sched = optim.lr_scheduler.CosineAnnealingLR(opt, T_max=args.epochs, eta_min=args.sched_min)
   if args.no_sched: sched = None
-  train(model, cam, labels, opt, args, sched=sched)
-
-  if not args.notraintest: test(model, cam, labels, args, training=True)
-
-  test_labels, test_cam, test_light = loaders.load(args, training=False, device=device)
-  if test_light is not None: model.refl.light = test_light
-  if not args.notest: test(model, test_cam, test_labels, args, training=False)
 
-  if args.render_over_time >= 0: render_over_time(args, model, test_cam)
+  start = 0
+  if args.resume and ckpt is not None:
+    start = checkpoint.restore(ckpt, opt, sched)
+    print(f"[note]: resuming from step {start}")
+  elif args.resume and load is not None:
+    print("[warn]: loaded model has no optimizer state to resume, only loading weights")
+
+  # parameters are broadcast from the main rank when wrapping, so all ranks start identically.
+  forward = distributed.wrap(model, device)
+  # each rank samples different views and crops.
+  if distributed.world_size() > 1 and args.seed != -1:
+    seed(args.seed + start * distributed.world_size() + distributed.rank())
+  # images are written in the background, close it at the end to wait for them.
+  writer = writers.ImageWriter()
+  try:
+    train(model, cam, labels, opt, args, sched=sched, start=start, writer=writer, forward=forward)
+
+    # test views are sharded across ranks
+    if not args.notraintest: test(model, cam, labels, args, training=True, writer=writer)
+
+    test_labels, test_cam, test_light = loaders.load(args, training=False, device=device)
+    if test_light is not None: model.refl.light = test_light
+    if not args.notest: test(model, test_cam, test_labels, args, training=False, writer=writer)
+
+    if args.render_over_time >= 0 and distributed.is_main(): render_over_time(args, model, test_cam)
+    if args.novel_views > 0 and distributed.is_main(): render_novel_views(args, model, test_cam)
+  finally:
+    writer.close()
+    distributed.cleanup()
 
 if __name__ == "__main__": main()
 
@@ -0,0 +1,187 @@
+# Accelerated ray intersection with a trained SDF for rendering.
+# The SDF is baked once into a voxel grid, and rays are sphere traced through the grid (trilinear
+# lookups, no MLP queries) until the grid changes sign. The bracket around the sign change is
+# then refined with a few bisection steps on the true SDF, so each ray which hits costs
+# 2 + refine MLP queries instead of hundreds of marching steps.
+#
+# The grid is only an approximation of the SDF, so features thinner than half a voxel may be
+# missed, and hits which the true SDF does not confirm at the end of the bracket are discarded.
+#
+# RayBounds is a coarse occupancy grid of where an SDF's surface or a NeRF's density may be, used
+# to tighten the near and far planes of each ray to the occupied part of the scene.
+import math
+
+import torch
+import torch.nn.functional as F
+
+from .mesh import ( sparse_grid, chunked, grid_points )
+
+# near and far distance of each ray within [-bound, bound]^3, clamped to [near, far].
+def clip_aabb(r_o, r_d, bound: float, near, far):
+  inv = 1/torch.where(r_d.abs() < 1e-9, torch.full_like(r_d, 1e-9), r_d)
+  t0 = (-bound - r_o) * inv
+  t1 = (bound - r_o) * inv
+  enter = torch.maximum(torch.minimum(t0, t1).max(dim=-1)[0], torch.as_tensor(near).to(r_o))
+  exit = torch.minimum(torch.maximum(t0, t1).min(dim=-1)[0], torch.as_tensor(far).to(r_o))
+  return enter, exit
+
+class SDFGrid:
+  def __init__(self, resolution: int = 128, bound: float = 1.5, refine: int = 8, chunk: int = 1 << 18):
+    assert(resolution > 1), "Must have at least 2 grid cells along each axis"
+    self.resolution = resolution
+    self.bound = bound
+    self.refine = refine
+    self.chunk = chunk
+    self.grid = None
+    self.lipschitz = 1
+  # must be called if the SDF changes.
+  def clear(self): self.grid = None
+  def get(self, sdf, device="cpu"):
+    if self.grid is None:
+      vals, _ = sparse_grid(
+        sdf, self.resolution, bound=self.bound, coarse=self.resolution, chunk=self.chunk,
+        device=device,
+      )
+      self.grid = vals[None, None]
+      # learned SDFs are not necessarily distances, so bound how fast they change from the grid
+      # and take proportionally smaller steps.
+      h = 2 * self.bound/self.resolution
+      dx = (vals[1:, :-1, :-1] - vals[:-1, :-1, :-1])/h
+      dy = (vals[:-1, 1:, :-1] - vals[:-1, :-1, :-1])/h
+      dz = (vals[:-1, :-1, 1:] - vals[:-1, :-1, :-1])/h
+      self.lipschitz = max(1, torch.stack([dx, dy, dz], dim=-1).norm(dim=-1).max().item())
+    return self.grid
+  def lookup(self, grid, pts):
+    # grid is laid out as [x,y,z] but grid_sample expects coordinates in (z,y,x) order.
+    coords = (pts/self.bound).flip(-1)[None, :, None, None, :]
+    return F.grid_sample(grid, coords, mode="bilinear", align_corners=True).reshape(-1)
+
+  # near and far distance of each ray within the grid.
+  def clip(self, r_o, r_d, near: float, far: float): return clip_aabb(r_o, r_d, self.bound, near, far)
+
+  # Returns the first intersection of each ray in [near, far]: (pts, hits, t, sdf value at pts).
+  def intersect(self, sdf, r_o, r_d, near: float, far: float):
+    shape = r_o.shape[:-1]
+    r_o, r_d = r_o.reshape(-1, 3), r_d.reshape(-1, 3)
+    with torch.no_grad():
+      grid = self.get(sdf, r_o.device)
+      h = 2 * self.bound/self.resolution
+      # trilinear interpolation may overestimate the distance by up to a voxel diagonal, and
+      # steps are at least half a voxel.
+      L = self.lipschitz
+      slack = math.sqrt(3) * h
+      min_step = h/2
+
+      t, end = self.clip(r_o, r_d, near, far)
+      lo, hi = t.clone(), t.clone()
+      hits = torch.zeros_like(t, dtype=torch.bool)
+      alive = (t < end).nonzero().squeeze(-1)
+      for _ in range(math.ceil((far - near)/min_step) + 1):
+        if alive.numel() == 0: break
+        ta = t[alive]
+        g = self.lookup(grid, r_o[alive] + ta[:, None] * r_d[alive])
+        crossed = g < 0
+        done = alive[crossed]
+        hits[done] = True
+        hi[done] = ta[crossed]
+        ta_next = ta + (g/L - slack).clamp(min=min_step)
+        lo[alive[~crossed]] = ta[~crossed]
+        t[alive] = torch.where(crossed, ta, ta_next)
+        alive = alive[~crossed & (ta_next < end[alive])]
+
+      # refine the bracket [lo, hi] on the true SDF.
+      idx = hits.nonzero().squeeze(-1)
+      o, d = r_o[idx], r_d[idx]
+      a, b = lo[idx], hi[idx]
+      at = lambda t: o + t[:, None] * d
+      fn = lambda t: sdf(at(t))[..., 0]
+      ends = sdf(torch.cat([at(a), at(b)]))[..., 0]
+      va, vb = ends[:idx.shape[0]], ends[idx.shape[0]:]
+      confirmed = vb < 0
+      # the grid missed an earlier crossing, so lo is already inside.
+      inside = va <= 0
+      b = torch.where(inside, a, b)
+      for _ in range(self.refine):
+        mid = (a + b)/2
+        pos = (fn(mid) > 0) | inside
+        a = torch.where(pos, mid, a)
+        b = torch.where(pos, b, mid)
+      hits[idx] = confirmed | inside
+      t[idx] = b
+      vals = torch.full_like(t, float("inf"))
+      vals[idx] = fn(b)
+      t = torch.where(hits, t, end.clamp(min=near))
+    pts = r_o + t[:, None] * r_d
+    return pts.reshape(*shape, 3), hits.reshape(shape), t.reshape(shape), vals.reshape(shape)
+
+# Conservative per ray near and far planes from a coarse occupancy grid over [-bound, bound]^3.
+# A cell is occupied if the SDF may be zero within it (|sdf| at some corner is less than the
+# Lipschitz constant times the cell's diagonal), or if the density at some corner is above the
+# threshold. Occupied cells are dilated by one cell, so each ray's [near, far] contains every
+# occupied cell it passes through. Rays which miss have near = far = the global far plane.
+class RayBounds:
+  def __init__(
+    self, resolution: int = 64, bound: float = 1.5, threshold: float = 1e-2, chunk: int = 1 << 18,
+  ):
+    assert(resolution > 1), "Must have at least 2 grid cells along each axis"
+    self.resolution = resolution
+    self.bound = bound
+    self.threshold = threshold
+    self.chunk = chunk
+    self.grid = None
+  # must be called if the model changes.
+  def clear(self): self.grid = None
+  def set_cells(self, cells):
+    self.grid = F.max_pool3d(cells[None, None].float(), kernel_size=3, stride=1, padding=1)[0, 0] > 0
+  def from_sdf(self, sdf, device="cpu"):
+    res = self.resolution
+    with torch.no_grad():
+      vals, _ = sparse_grid(sdf, res, bound=self.bound, coarse=res, chunk=self.chunk, device=device)
+    h = 2 * self.bound/res
+    dx = (vals[1:, :-1, :-1] - vals[:-1, :-1, :-1])/h
+    dy = (vals[:-1, 1:, :-1] - vals[:-1, :-1, :-1])/h
+    dz = (vals[:-1, :-1, 1:] - vals[:-1, :-1, :-1])/h
+    L = max(1, torch.stack([dx, dy, dz], dim=-1).norm(dim=-1).max().item())
+    corners = -F.max_pool3d(-vals.abs()[None, None], kernel_size=2, stride=1)[0, 0]
+    self.set_cells(corners <= L * math.sqrt(3) * h)
+  # density maps points [N, 3] to densities [N].
+  def from_density(self, density, device="cpu"):
+    res = self.resolution
+    axis = torch.arange(res + 1, device=device)
+    idxs = torch.stack(torch.meshgrid(axis, axis, axis, indexing="ij"), dim=-1).reshape(-1, 3)
+    with torch.no_grad():
+      vals = chunked(density, grid_points(idxs, res, self.bound), self.chunk).reshape((res + 1,) * 3)
+    corners = F.max_pool3d(vals[None, None], kernel_size=2, stride=1)[0, 0]
+    self.set_cells(corners > self.threshold)
+  # fraction of occupied cells.
+  def occupancy(self): return self.grid.float().mean().item()
+
+  # returns per ray near and far of shape r_o.shape[:-1] from the global near and far.
+  def near_far(self, r_o, r_d, near: float, far: float, rays_per_chunk: int = 1 << 14):
+    assert(self.grid is not None), "Must build the occupancy grid before querying it"
+    shape = r_o.shape[:-1]
+    r_o, r_d = r_o.reshape(-1, 3), r_d.reshape(-1, 3)
+    res = self.resolution
+    # half cell steps along each ray always land inside the dilated cells around an occupied cell.
+    step = self.bound/res
+    ray_near, ray_far = torch.full_like(r_o[:, 0], far), torch.full_like(r_o[:, 0], far)
+    with torch.no_grad():
+      for s in range(0, r_o.shape[0], rays_per_chunk):
+        o, d = r_o[s:s+rays_per_chunk], r_d[s:s+rays_per_chunk]
+        enter, exit = clip_aabb(o, d, self.bound, near, far)
+        length = (exit - enter).max().item()
+        if length <= 0: continue
+        steps = math.ceil(length/step) + 1
+        ts = enter[:, None] + step * (torch.arange(steps, device=o.device, dtype=o.dtype) + 0.5)
+        valid = ts < exit[:, None]
+        pts = o[:, None] + ts[..., None] * d[:, None]
+        idx = ((pts + self.bound)/(2 * self.bound) * res).floor().long().clamp(min=0, max=res-1)
+        occ = self.grid[idx[..., 0], idx[..., 1], idx[..., 2]] & valid
+        hit = occ.any(dim=-1)
+        first = occ.float().argmax(dim=-1)
+        last = steps - 1 - occ.flip(-1).float().argmax(dim=-1)
+        t0 = ts.gather(-1, first[:, None]).squeeze(-1) - step
+        t1 = ts.gather(-1, last[:, None]).squeeze(-1) + step
+        ray_near[s:s+rays_per_chunk][hit] = t0[hit].clamp(min=near, max=far)
+        ray_far[s:s+rays_per_chunk][hit] = t1[hit].clamp(min=near, max=far)
+    return ray_near.reshape(shape), ray_far.reshape(shape)
@@ -0,0 +1,130 @@
+# Camera paths for rendering novel views: orbits, spirals and interpolation between poses.
+# Each path returns a NeRFCamera with one view per frame, using the NeRF convention of
+# cam_to_world [B, 3, 4] looking down -z. Paths are fit to an existing set of cameras (i.e. the
+# training or test cameras) which are assumed to look at the origin.
+import math
+
+import torch
+import torch.nn.functional as F
+
+from .cameras import NeRFCamera
+
+# camera to world matrices looking from eye to at.
+def look_at(eye, at=None, up=None):
+  if at is None: at = torch.zeros_like(eye)
+  if up is None: up = torch.tensor([0., 0., 1.], device=eye.device)
+  up = up.to(eye.dtype).expand_as(eye)
+  fwd = F.normalize(at - eye, dim=-1)
+  right = F.normalize(torch.cross(fwd, up, dim=-1), dim=-1)
+  cam_up = torch.cross(right, fwd, dim=-1)
+  return torch.stack([right, cam_up, -fwd, eye], dim=-1)
+
+# rotation matrices [..., 3, 3] to unit quaternions [..., 4] as (w, x, y, z).
+def rot_to_quat(R):
+  m00, m01, m02 = R[..., 0, 0], R[..., 0, 1], R[..., 0, 2]
+  m10, m11, m12 = R[..., 1, 0], R[..., 1, 1], R[..., 1, 2]
+  m20, m21, m22 = R[..., 2, 0], R[..., 2, 1], R[..., 2, 2]
+  # each row is the quaternion scaled by 4 * one of its components, pick the row with the
+  # largest component for numerical stability.
+  cands = torch.stack([
+    torch.stack([1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01], dim=-1),
+    torch.stack([m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20], dim=-1),
+    torch.stack([m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21], dim=-1),
+    torch.stack([m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22], dim=-1),
+  ], dim=-2)
+  best = cands.diagonal(dim1=-2, dim2=-1).argmax(dim=-1)
+  q = cands.gather(-2, best[..., None, None].expand(*best.shape, 1, 4)).squeeze(-2)
+  return F.normalize(q, dim=-1)
+
+def quat_to_rot(q):
+  w, x, y, z = F.normalize(q, dim=-1).unbind(-1)
+  return torch.stack([
+    torch.stack([1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)], dim=-1),
+    torch.stack([2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)], dim=-1),
+    torch.stack([2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)], dim=-1),
+  ], dim=-2)
+
+# spherical interpolation between unit quaternions, t in [0, 1] broadcasts with q0[..., :1].
+def slerp(q0, q1, t):
+  dot = (q0 * q1).sum(dim=-1, keepdim=True)
+  # take the shorter path
+  q1 = torch.where(dot < 0, -q1, q1)
+  dot = dot.abs().clamp(max=1)
+  theta = dot.acos()
+  sin = theta.sin()
+  close = sin < 1e-6
+  safe_sin = torch.where(close, torch.ones_like(sin), sin)
+  w0 = torch.where(close, 1 - t, ((1 - t) * theta).sin()/safe_sin)
+  w1 = torch.where(close, t, (t * theta).sin()/safe_sin)
+  return F.normalize(w0 * q0 + w1 * q1, dim=-1)
+
+# radius, elevation (radians) and up vector of a set of cameras around the origin.
+def fit(cam):
+  c2w = cam.cam_to_world
+  eyes = c2w[..., :3, 3]
+  up = F.normalize(c2w[..., :3, 1].mean(dim=0), dim=-1)
+  radius = eyes.norm(dim=-1).mean()
+  elev = (F.normalize(eyes, dim=-1) * up).sum(dim=-1).clamp(-1, 1).asin().mean()
+  return radius, elev, up
+
+# orthonormal vectors perpendicular to up.
+def tangent_basis(up):
+  other = torch.tensor([1., 0., 0.], device=up.device, dtype=up.dtype)
+  if up[0].abs() > 0.9: other = torch.tensor([0., 1., 0.], device=up.device, dtype=up.dtype)
+  e1 = F.normalize(torch.cross(up, other, dim=-1), dim=-1)
+  e2 = torch.cross(up, e1, dim=-1)
+  return e1, e2
+
+def circle(n: int, radius, elev, up, rotations: float = 1):
+  e1, e2 = tangent_basis(up)
+  theta = torch.linspace(0, 2 * math.pi * rotations, n + 1, device=up.device)[:-1, None]
+  elev = elev if torch.is_tensor(elev) and elev.dim() > 0 else torch.full_like(theta, float(elev))
+  elev = elev.reshape(-1, 1)
+  radius = radius if torch.is_tensor(radius) and radius.dim() > 0 else torch.full_like(theta, float(radius))
+  radius = radius.reshape(-1, 1)
+  flat = theta.cos() * e1 + theta.sin() * e2
+  return radius * (elev.cos() * flat + elev.sin() * up)
+
+# a circle around the up axis at the average radius and elevation of the cameras.
+def orbit(cam, n: int):
+  radius, elev, up = fit(cam)
+  eyes = circle(n, radius, elev, up)
+  return NeRFCamera(cam_to_world=look_at(eyes, up=up), focal=cam.focal, device=cam.device)
+
+# two rotations around the up axis, moving up and down in elevation and in and out in radius.
+def spiral(cam, n: int, rotations: float = 2, elev_amp: float = math.radians(15), rad_amp: float = 0.1):
+  radius, elev, up = fit(cam)
+  phase = torch.linspace(0, 2 * math.pi, n + 1, device=up.device)[:-1]
+  elevs = (elev + elev_amp * phase.sin()).clamp(-math.pi/2 + 1e-2, math.pi/2 - 1e-2)
+  radii = radius * (1 + rad_amp * (2 * phase).sin())
+  eyes = circle(n, radii, elevs, up, rotations=rotations)
+  return NeRFCamera(cam_to_world=look_at(eyes, up=up), focal=cam.focal, device=cam.device)
+
+# interpolates between consecutive poses of the cameras (looping back to the first), slerping
+# rotations and linearly interpolating positions.
+def interpolate(cam, n: int):
+  c2w = cam.cam_to_world
+  K = c2w.shape[0]
+  assert(K > 1), "Must have at least 2 cameras to interpolate between"
+  s = torch.linspace(0, K, n + 1, device=c2w.device)[:-1]
+  i = s.floor().long().clamp(max=K-1)
+  t = (s - i)[:, None]
+  j = (i + 1) % K
+  q = rot_to_quat(c2w[..., :3, :3])
+  R = quat_to_rot(slerp(q[i], q[j], t))
+  pos = (1 - t) * c2w[i, :3, 3] + t * c2w[j, :3, 3]
+  return NeRFCamera(
+    cam_to_world=torch.cat([R, pos[..., None]], dim=-1), focal=cam.focal, device=cam.device,
+  )
+
+path_kinds = {
+  "orbit": orbit,
+  "spiral": spiral,
+  "interp": interpolate,
+}
+
+def load(kind: str, cam, n: int):
+  fn = path_kinds.get(kind, None)
+  if fn is None: raise NotImplementedError(f"Unknown camera path: {kind}")
+  if not isinstance(cam, NeRFCamera): raise NotImplementedError(f"Camera paths for {type(cam)}")
+  return fn(cam, n)
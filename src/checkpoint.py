@@ -0,0 +1,91 @@
+# Structured checkpoints, which contain everything needed to rebuild a model and resume
+# training: the config (arguments) it was built with, its state_dict, the optimizer and
+# scheduler state, RNG states and the step count.
+# Older checkpoints were entire pickled modules, callers should check `is_checkpoint`.
+import os
+import pickle
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import src.sampling as sampling
+
+# increment if the layout of the checkpoint changes
+VERSION = 1
+
+# returns the underlying module of a (possibly) parallel model.
+def unwrap(model):
+  while isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+    model = model.module
+  return model
+
+def is_checkpoint(loaded) -> bool:
+  return isinstance(loaded, dict) and "version" in loaded and "state_dict" in loaded
+
+def rng_state():
+  name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+  state = {
+    "torch": torch.get_rng_state(),
+    "random": random.getstate(),
+    # stored as a tensor so the checkpoint does not contain numpy arrays
+    "numpy": (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+    "sampler": sampling.state(),
+  }
+  if torch.cuda.is_available(): state["cuda"] = torch.cuda.get_rng_state_all()
+  return state
+
+def set_rng_state(state):
+  torch.set_rng_state(state["torch"].cpu())
+  random.setstate(state["random"])
+  name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+  np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+  # older checkpoints did not store the position of the sampler's sequences.
+  if "sampler" in state: sampling.set_state(state["sampler"])
+  if "cuda" in state and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+def save(path, model, config, opt=None, sched=None, step: int = 0):
+  ckpt = {
+    "version": VERSION,
+    "config": dict(config),
+    "state_dict": unwrap(model).state_dict(),
+    "opt": None if opt is None else opt.state_dict(),
+    "sched": None if sched is None else sched.state_dict(),
+    "rng": rng_state(),
+    "step": step,
+  }
+  # write to a temporary file first, so being preempted mid-save does not lose the checkpoint.
+  tmp = f"{path}.tmp"
+  torch.save(ckpt, tmp)
+  os.replace(tmp, path)
+
+# Loads a file written by torch.save. Checkpoints only contain tensors and plain data, so they
+# are loaded with weights_only. Older files are entire pickled modules, which can run arbitrary
+# code when unpickled, so they are only loaded in full after a warning.
+def load(path, map_location=None):
+  try: return torch.load(path, map_location=map_location, weights_only=True)
+  except pickle.UnpicklingError:
+    print(f"[warn]: {path} is not a checkpoint, unpickling it as a whole module, only load trusted files")
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+# loads the weights of a checkpoint into an already constructed model.
+def load_state(model, ckpt):
+  missing, unexpected = unwrap(model).load_state_dict(ckpt["state_dict"], strict=False)
+  if len(missing) > 0:
+    print(f"[warn]: {len(missing)} parameters missing from checkpoint, e.g. {missing[0]}")
+  if len(unexpected) > 0:
+    print(f"[warn]: {len(unexpected)} unexpected parameters in checkpoint, e.g. {unexpected[0]}")
+  return model
+
+# restores optimizer, scheduler and RNG state, returning the step to resume from.
+def restore(ckpt, opt=None, sched=None) -> int:
+  if opt is not None:
+    if ckpt["opt"] is None: print("[warn]: checkpoint has no optimizer state, starting fresh")
+    else: opt.load_state_dict(ckpt["opt"])
+  if sched is not None:
+    if ckpt["sched"] is None: print("[warn]: checkpoint has no scheduler state, starting fresh")
+    else: sched.load_state_dict(ckpt["sched"])
+  set_rng_state(ckpt["rng"])
+  return ckpt["step"]
@@ -0,0 +1,72 @@
+# Multi-process training with DistributedDataParallel, launched with torchrun:
+#   torchrun --nproc_per_node=2 runner.py --distributed ...
+# Uses NCCL when CUDA is available, otherwise gloo so it also runs on CPU.
+# When not initialized every function behaves as if there is a single process.
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+def launched() -> bool: return "RANK" in os.environ and "WORLD_SIZE" in os.environ
+
+def initialized() -> bool: return dist.is_available() and dist.is_initialized()
+
+# initializes the process group, returns the device this rank should use.
+def init(backend=None):
+  assert(launched()), "Distributed training must be launched with torchrun"
+  cuda = torch.cuda.is_available()
+  if backend is None: backend = "nccl" if cuda else "gloo"
+  device = "cpu"
+  if cuda:
+    device = torch.device(f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}")
+    torch.cuda.set_device(device)
+  dist.init_process_group(backend=backend)
+  return device
+
+def cleanup():
+  if initialized(): dist.destroy_process_group()
+
+def rank() -> int: return dist.get_rank() if initialized() else 0
+def world_size() -> int: return dist.get_world_size() if initialized() else 1
+def is_main() -> bool: return rank() == 0
+
+def barrier():
+  if initialized(): dist.barrier()
+
+# True on all ranks if it is True on any rank, so that all ranks take the same branch.
+def any(cond: bool) -> bool:
+  if not initialized(): return cond
+  t = torch.tensor([int(cond)], device="cuda" if dist.get_backend() == "nccl" else "cpu")
+  dist.all_reduce(t, op=dist.ReduceOp.MAX)
+  return bool(t.item())
+
+# Wraps a model for computing the forward pass, gradients are averaged across ranks in backward.
+# The unwrapped model should still be used for accessing attributes (nerf, refl, occ, etc).
+# Parameters are not necessarily used each step (i.e. lights, alternating optimization).
+def wrap(model, device):
+  if not initialized(): return model
+  device_ids = None if device == "cpu" else [device]
+  return nn.parallel.DistributedDataParallel(
+    model, device_ids=device_ids, find_unused_parameters=True,
+  )
+
+# returns the object from src on all ranks.
+def broadcast(obj, src: int = 0):
+  if not initialized(): return obj
+  objs = [obj]
+  dist.broadcast_object_list(objs, src=src)
+  return objs[0]
+
+# returns a list of the object from each rank, in rank order.
+def all_gather(obj):
+  if not initialized(): return [obj]
+  objs = [None] * world_size()
+  dist.all_gather_object(objs, obj)
+  return objs
+
+# skips synchronizing gradients in backward if `skip`, so they can be accumulated locally.
+def no_sync(model, skip: bool = True):
+  if skip and isinstance(model, nn.parallel.DistributedDataParallel): return model.no_sync()
+  return contextlib.nullcontext()
@@ -37,7 +37,7 @@ class HyperParameters():
     if not self.empty:
       curr = self.params;
       for arg in key.split(":"):
-        if hasattr(curr, arg): curr = curr[arg]
+        if isinstance(curr, dict) and arg in curr: curr = curr[arg]
         else:
           print(f"[warning]: missing {arg} from {self.name} in path {key} of kind {kind}.")
           curr = default
@@ -49,6 +49,7 @@ class HyperParameters():
     elif kind == "uint":
      val = int(val)
      assert(val > 0)
+    elif kind == "int": val = int(val)
     elif kind == "float": val = float(val)
     return val
 
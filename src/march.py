@@ -9,10 +9,13 @@ import torch.nn.functional as F
 import torch.optim as optim
 import random
 
+import src.profiling as profiling
+
 def load_intersection_kind(kind):
   if kind == "sphere": return sphere_march
   if kind == "secant": return secant
   if kind == "bisect": return bisect
+  if kind == "bisect-adaptive": return bisect_adaptive
   # TODO first intersect with sphere marching using small # of iters,
   # then intersect with bisection/secant. Seems to work for IDR (and PhySG which took from IDR)
   if kind == "march": raise NotImplementedError("")
@@ -24,6 +27,7 @@ def load_intersection_kind(kind):
 #
 # note that this implementation is efficient in that it only will compute distance
 # for pts that are still candidates.
+@profiling.timed("march/sphere")
 def sphere_march(
   self,
   r_o, r_d,
@@ -35,11 +39,13 @@ def sphere_march(
   with torch.no_grad():
     hits = torch.zeros(r_o.shape[:-1] + (1,), dtype=torch.bool, device=device)
     rem = torch.ones_like(hits).squeeze(-1)
-    curr_dist = torch.full_like(hits, near, dtype=torch.float)
+    # near and far may be per ray [..., 1]
+    curr_dist = torch.zeros_like(hits, dtype=torch.float) + near
+    far = torch.zeros_like(curr_dist) + far
     for i in range(iters):
       curr = r_o[rem] + r_d[rem] * curr_dist[rem]
       dist = self(curr)[...,0].reshape_as(curr_dist[rem])
-      hits[rem] |= ((dist < eps) & (curr_dist[rem] <= far))
+      hits[rem] |= ((dist < eps) & (curr_dist[rem] <= far[rem]))
       # anything that was hit or is past range no longer need to compute
       curr_dist[rem] += dist
       rem[hits.squeeze(-1) | (curr_dist > far).squeeze(-1)] = False
@@ -47,6 +53,7 @@ def sphere_march(
   return curr, hits.squeeze(-1), curr_dist, None
 
 # finds an intersection with secant intersection
+@profiling.timed("march/secant")
 def secant(
   self,
   r_o, r_d,
@@ -57,9 +64,10 @@ def secant(
   tput, best_pos, last_pos, first_neg = throughput_with_sign_change(self, r_o, r_d, near, far, batch_size=iters)
   pts = secant_find(self, r_o, r_d, near=last_pos, far = first_neg, iters=iters)
   hits = tput < 0
-  return pts, hits, best_pos, tput
+  return pts, hits, best_pos, tput.unsqueeze(-1)
 
 # finds an intersection with secant intersection
+@profiling.timed("march/bisect")
 def bisect(
   self,
   r_o, r_d,
@@ -74,19 +82,39 @@ def bisect(
   hits = tput < 0
   return pts, hits, best_pos, tput.unsqueeze(-1)
 
+# bisection after searching for the sign change with sphere tracing sized steps.
+@profiling.timed("march/bisect_adaptive")
+def bisect_adaptive(
+  self,
+  r_o, r_d,
+  iters: int = 128,
+  eps: float = 0,
+  near: float = 0, far: float = 1,
+):
+  tput, best_pos, last_pos, first_neg = throughput_with_sign_change(
+    self, r_o, r_d, near=near, far=far, batch_size=iters, adaptive=True,
+  )
+  pts = bisection(self, r_o, r_d, near=last_pos, far = first_neg, iters=min(32, iters))
+  hits = tput < 0
+  return pts, hits, best_pos, tput.unsqueeze(-1)
+
 # computes throughput as well positions where the signs change
+@profiling.timed("march/sign_change")
 def throughput_with_sign_change(
   self,
   r_o, r_d,
   near: float,
   far: float,
   batch_size:int = 128,
+  adaptive: bool = False,
+  safety: float = 0.9,
 ):
   # some random jitter I guess?
   max_t = far-near+random.random()*(2/batch_size)
   step = max_t/batch_size
+  if adaptive: return adaptive_sign_change(self, r_o, r_d, near, far, step, batch_size, safety)
   with torch.no_grad():
-    sd = self(r_o + near)[...,0]
+    sd = self(r_o + near * r_d)[...,0]
     curr_min = sd
     idxs = torch.zeros_like(sd, dtype=torch.long)
     # pos and neg indeces
@@ -104,11 +132,46 @@ def throughput_with_sign_change(
     # TODO return best distances.
     # convert from indeces to t
     best_pos = r_o  + (near + idxs * step) * r_d
-    first_neg = first_neg.unsqueeze(-1) * step
-    last_pos = last_pos.unsqueeze(-1) * step
+    first_neg = near + first_neg.unsqueeze(-1) * step
+    last_pos = near + last_pos.unsqueeze(-1) * step
   val = self(best_pos)
   return val[...,0], best_pos, last_pos, first_neg
 
+# Same as throughput_with_sign_change, but steps by max(min_step, sdf * safety) so rays far from
+# the surface take few steps, and only rays which have not finished are evaluated. Near the
+# surface steps are min_step, the same as uniform stepping. Rays stop at the first sign change,
+# so for hits the throughput is the first negative value rather than the minimum along the ray.
+def adaptive_sign_change(self, r_o, r_d, near, far, min_step, max_steps: int, safety: float):
+  shape = r_o.shape[:-1]
+  o, d = r_o.reshape(-1, 3), r_d.reshape(-1, 3)
+  as_rays = lambda v: (torch.zeros(shape + (1,), device=o.device) + v).reshape(-1)
+  near, far, min_step = as_rays(near), as_rays(far), as_rays(min_step)
+  with torch.no_grad():
+    t = near.clone()
+    sd = self(o + t[:, None] * d)[..., 0]
+    curr_min, best_t = sd.clone(), t.clone()
+    # rays without a sign change have an empty bracket at near.
+    last_pos, first_neg = near.clone(), near.clone()
+    alive = (sd >= 0).nonzero().squeeze(-1)
+    for _ in range(max_steps):
+      if alive.numel() == 0: break
+      ta = t[alive]
+      step = torch.maximum(min_step[alive], sd[alive] * safety)
+      # always evaluate exactly at far before stopping.
+      tn = torch.minimum(ta + step, far[alive])
+      sdn = self(o[alive] + tn[:, None] * d[alive])[..., 0]
+      better = sdn < curr_min[alive]
+      curr_min[alive] = torch.where(better, sdn, curr_min[alive])
+      best_t[alive] = torch.where(better, tn, best_t[alive])
+      crossed = sdn < 0
+      last_pos[alive[crossed]] = ta[crossed]
+      first_neg[alive[crossed]] = tn[crossed]
+      t[alive], sd[alive] = tn, sdn
+      alive = alive[~crossed & (tn < far[alive])]
+    best_pos = (o + best_t[:, None] * d).reshape(shape + (3,))
+  val = self(best_pos)
+  return val[..., 0], best_pos, last_pos.reshape(shape + (1,)), first_neg.reshape(shape + (1,))
+
 # secant marching as implemented in IDR. It seems kind of broken, no idea how it works in their
 # implementation.
 def secant_find(
@@ -117,28 +180,33 @@ def secant_find(
   near, far,
   iters: int = 32,
 ):
-  device = r_o.device
   with torch.no_grad():
-    low = near
-    high = far
+    low = near.clone()
+    high = far.clone()
     sdf_low = self(r_o + low * r_d)[..., 0, None]
     sdf_high = self(r_o + high * r_d)[..., 0, None]
-    z_pred = -sdf_low * (high - low) / (sdf_high - sdf_low).clamp(min=1) + low
-    assert(z_pred.isfinite().all()), z_pred[~z_pred.isfinite()]
+    # only rays which bracket a sign change are refined, the rest take the midpoint.
+    todo = (sdf_low > 0) & (sdf_high < 0) & (high > low)
+    # where the line through (low, sdf_low) and (high, sdf_high) crosses 0.
+    def step():
+      z = low + sdf_low * (high - low)/(sdf_low - sdf_high).clamp(min=1e-10)
+      return torch.where(todo, z, (low + high)/2)
+    z_pred = step()
     for i in range(iters):
+      if not todo.any(): break
       mid = r_o + z_pred * r_d
       sdf_mid = self(mid)[..., 0, None]
       ...
-      low_mask = sdf_mid > 0
+      low_mask = (sdf_mid > 0) & todo
       low[low_mask] = z_pred[low_mask]
       sdf_low[low_mask] = sdf_mid[low_mask]
       ...
-      high_mask = sdf_mid < 0
+      high_mask = (sdf_mid < 0) & todo
       high[high_mask] = z_pred[high_mask]
       sdf_high[high_mask] = sdf_mid[high_mask]
       ...
 
-      z_pred = -sdf_low * (high - low) / (sdf_high - sdf_low).clamp(min=1) + low
+      z_pred = step()
   assert(z_pred.isfinite().all()), z_pred[~z_pred.isfinite()]
   return r_o + z_pred * r_d
 
@@ -179,13 +247,14 @@ def bisection(
       todo = todo & ((high - low) > eps) & (sdf_low > 0) & (sdf_high < 0) & (high > low)
   return r_o + z_pred * r_d
 
+@profiling.timed("march/throughput")
 def throughput(
   self,
   r_o, r_d,
   near: float, far: float,
   batch_size:int = 128,
 ):
-  assert(far > near)
+  assert(torch.all(torch.as_tensor(far - near) >= 0))
   # some random jitter I guess?
   max_t = far-near+random.random()*(2/batch_size)
   step = max_t/batch_size
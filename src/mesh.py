@@ -0,0 +1,137 @@
+# Mesh extraction from SDFs with marching cubes.
+# The SDF is evaluated on a grid in chunks, coarse to fine: cells of the coarse grid which are
+# far from the surface (|sdf| larger than the cell's diagonal at all corners) are not subdivided,
+# so only a thin shell around the zero level set is evaluated at the final resolution.
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .sdf import SDFModel
+from .refl import LightAndRefl
+
+# returns the underlying SDFModel and the reflectance (or None) of a model with an SDF.
+def find_sdf(model):
+  if isinstance(model, SDFModel): return model, None
+  if not hasattr(model, "sdf"): raise NotImplementedError(f"{type(model).__name__} has no SDF")
+  sdf = model.sdf
+  refl = getattr(model, "refl", None) or getattr(sdf, "refl", None)
+  if hasattr(sdf, "underlying"): sdf = sdf.underlying
+  assert(isinstance(sdf, SDFModel)), f"Expected an SDFModel, got {type(sdf).__name__}"
+  return sdf, refl
+
+# evaluates fn on pts [N, 3] in chunks, returning [N, ...].
+def chunked(fn, pts, chunk: int = 1 << 18):
+  return torch.cat([fn(p) for p in pts.split(chunk, dim=0)], dim=0)
+
+# positions of the vertices of a grid with res cells per side covering [-bound, bound]^3.
+def grid_points(idxs, res: int, bound: float):
+  return idxs.float() * (2 * bound/res) - bound
+
+# Returns SDF values at the (res+1)^3 vertices of a grid over [-bound, bound]^3, and the # of
+# points evaluated. Vertices which are not evaluated are trilinearly upsampled from the coarser
+# levels, and since they are far from the surface, they have the same sign as the true SDF.
+def sparse_grid(
+  sdf, res: int, bound: float = 1.5, coarse: int = 32, margin: float = 1.5, chunk: int = 1 << 18,
+  device="cpu",
+):
+  assert(res >= coarse), "Final resolution must be at least the coarse resolution"
+  levels = int(round(math.log2(res/coarse)))
+  assert(coarse * (1 << levels) == res), "Resolution must be the coarse resolution times a power of 2"
+  fn = lambda p: sdf(p)[..., 0]
+
+  r = coarse
+  axis = torch.arange(r + 1, device=device)
+  idxs = torch.stack(torch.meshgrid(axis, axis, axis, indexing="ij"), dim=-1).reshape(-1, 3)
+  with torch.no_grad():
+    vals = chunked(fn, grid_points(idxs, r, bound), chunk).reshape(r + 1, r + 1, r + 1)
+  evaluated = idxs.shape[0]
+  active = None
+  for _ in range(levels):
+    # cells which may contain the surface if the SDF is (roughly) 1-Lipschitz.
+    diag = math.sqrt(3) * 2 * bound/r
+    corners = -F.max_pool3d(-vals.abs()[None, None], kernel_size=2, stride=1)[0, 0]
+    near = corners <= margin * diag
+    active = near if active is None else (near & active)
+
+    r *= 2
+    vals = F.interpolate(
+      vals[None, None], size=(r + 1,) * 3, mode="trilinear", align_corners=True,
+    )[0, 0]
+    active = active.repeat_interleave(2, 0).repeat_interleave(2, 1).repeat_interleave(2, 2)
+    # vertices which are a corner of any active cell.
+    verts = F.max_pool3d(
+      F.pad(active[None, None].float(), (1, 1, 1, 1, 1, 1)), kernel_size=2, stride=1,
+    )[0, 0] > 0
+    idxs = verts.nonzero()
+    if idxs.shape[0] == 0: break
+    with torch.no_grad(): got = chunked(fn, grid_points(idxs, r, bound), chunk)
+    vals[idxs[:, 0], idxs[:, 1], idxs[:, 2]] = got
+    evaluated += idxs.shape[0]
+  if r != res:
+    vals = F.interpolate(vals[None, None], size=(res + 1,) * 3, mode="trilinear", align_corners=True)[0, 0]
+  return vals, evaluated
+
+# marching cubes over a grid of SDF values, returns vertices in world space and faces.
+def marching_cubes(vals, bound: float):
+  try: from skimage.measure import marching_cubes as mc
+  except ImportError: raise NotImplementedError("Marching cubes requires scikit-image")
+  res = vals.shape[0] - 1
+  vals = vals.detach().cpu().numpy()
+  if vals.min() > 0 or vals.max() < 0: return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int64)
+  h = 2 * bound/res
+  verts, faces, _, _ = mc(vals, level=0, spacing=(h, h, h))
+  return (verts - bound).astype(np.float32), faces.astype(np.int64)
+
+# Colors at vertices from the reflectance, as seen and lit head on along the normal.
+def vertex_colors(sdf, refl, verts, chunk: int = 1 << 16, device="cpu"):
+  if isinstance(refl, LightAndRefl): refl = refl.refl
+  def color(p):
+    n = F.normalize(sdf.normals(p), dim=-1)
+    with torch.no_grad():
+      raw = sdf(p)
+      latent = raw[..., 1:] if raw.shape[-1] > 1 else None
+      return refl(x=p, view=-n, normal=n, light=n, latent=latent).clamp(0, 1).detach()
+  pts = torch.from_numpy(verts).to(device)
+  return chunked(color, pts, chunk).cpu().numpy()
+
+def write_ply(path, verts, faces, colors=None):
+  vdtype = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+  if colors is not None: vdtype += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+  v = np.empty(verts.shape[0], dtype=vdtype)
+  v["x"], v["y"], v["z"] = verts[:, 0], verts[:, 1], verts[:, 2]
+  if colors is not None:
+    c = (colors * 255).round().astype(np.uint8)
+    v["red"], v["green"], v["blue"] = c[:, 0], c[:, 1], c[:, 2]
+  f = np.empty(faces.shape[0], dtype=[("n", "u1"), ("idx", "<i4", (3,))])
+  f["n"] = 3
+  f["idx"] = faces
+  header = [
+    "ply", "format binary_little_endian 1.0", f"element vertex {verts.shape[0]}",
+    *[f"property {'float' if t == '<f4' else 'uchar'} {name}" for name, t in vdtype],
+    f"element face {faces.shape[0]}", "property list uchar int vertex_indices", "end_header",
+  ]
+  with open(path, "wb") as out:
+    out.write(("\n".join(header) + "\n").encode("ascii"))
+    out.write(v.tobytes())
+    out.write(f.tobytes())
+
+# vertex colors are written after positions, which most readers support.
+def write_obj(path, verts, faces, colors=None):
+  with open(path, "w") as out:
+    vs = verts if colors is None else np.concatenate([verts, colors], axis=-1)
+    fmt = "v %.6f %.6f %.6f" + ("" if colors is None else " %.4f %.4f %.4f")
+    np.savetxt(out, vs, fmt=fmt)
+    np.savetxt(out, faces + 1, fmt="f %d %d %d")
+
+mesh_writers = {
+  ".ply": write_ply,
+  ".obj": write_obj,
+}
+
+def save(path, verts, faces, colors=None):
+  ext = path[path.rfind("."):].lower() if "." in path else ""
+  writer = mesh_writers.get(ext, None)
+  if writer is None: raise NotImplementedError(f"Unknown mesh format {ext}, must be one of {list(mesh_writers)}")
+  writer(path, verts, faces, colors)
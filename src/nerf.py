@@ -3,18 +3,22 @@ import torch.nn as nn
 import torch.nn.functional as F
 import random
 import math
+from collections import OrderedDict
 
 from .neural_blocks import (
   SkipConnMLP, UpdateOperator, FourierEncoder, PositionalEncoder, NNEncoder, EncodedGRU,
 )
 from .utils import (
   dir_to_elev_azim, autograd, laplace_cdf, load_sigmoid,
-  sample_random_hemisphere, sample_random_sphere, upshifted_sigmoid,
+  upshifted_sigmoid,
   load_mip, to_spherical
 )
 import src.refl as refl
-from .renderers import ( load_occlusion_kind, direct )
+from .renderers import ( load_occlusion_kind, direct, masked_direct )
 import src.march as march
+import src.profiling as profiling
+import src.sampling as sampling
+import src.checkpoint as checkpoint
 
 @torch.jit.script
 def cumuprod_exclusive(t):
@@ -24,12 +28,21 @@ def cumuprod_exclusive(t):
   return cp
 
 #@torch.jit.script # cannot jit script cause of tensordot :)
+@profiling.timed("sample_pts")
 def compute_pts_ts(
   rays, near, far, steps, lindisp=False, perturb: float = 0,
 ):
   r_o, r_d = rays.split([3,3], dim=-1)
   device = r_o.device
-  if lindisp:
+  # near and far may also be per ray, in which case ts are [steps, *rays.shape[:-1]].
+  per_ray = torch.is_tensor(near) or torch.is_tensor(far)
+  if per_ray:
+    t_vals = torch.linspace(0, 1, steps, device=device, dtype=r_o.dtype)
+    t_vals = t_vals.reshape(-1, *[1] * (len(rays.shape) - 1))
+    if lindisp: ts = 1/(1/torch.as_tensor(near).clamp(min=1e-10) * (1-t_vals) + 1/far * t_vals)
+    else: ts = near + (far - near) * t_vals
+    ts = ts.expand(steps, *rays.shape[:-1])
+  elif lindisp:
     t_vals = torch.linspace(0, 1, steps, device=device, dtype=r_o.dtype)
     ts = 1/(1/max(near, 1e-10) * (1-t_vals) + 1/far * (t_vals))
   else:
@@ -39,14 +52,24 @@ def compute_pts_ts(
     mids = 0.5 * (ts[:-1] + ts[1:])
     lower = torch.cat([mids, ts[-1:]])
     upper = torch.cat([ts[:1], mids])
-    rand = torch.rand_like(lower) * perturb
+    # one sample per step for each ray, drawn as a point in [0, 1)^steps.
+    rand = sampling.uniform(lower[0].numel(), lower.shape[0], device, stream="depth")
+    rand = rand.T.reshape(lower.shape).to(lower.dtype) * perturb
     ts = lower + (upper - lower) * rand
-  pts = r_o.unsqueeze(0) + torch.tensordot(ts, r_d, dims = 0)
+  if per_ray: pts = r_o.unsqueeze(0) + ts[..., None] * r_d.unsqueeze(0)
+  else: pts = r_o.unsqueeze(0) + torch.tensordot(ts, r_d, dims = 0)
   return pts, ts, r_o, r_d
 
+# ts are either shared by all rays [T], or per ray [T, ...], returns them such that they
+# broadcast with values [T, B, H, W, C] being integrated.
+def integrable_ts(ts):
+  if len(ts.shape) == 1: return ts[:, None, None, None, None]
+  return ts[..., None]
+
 # given a set of densities, and distances between the densities,
 # compute alphas from them.
 #@torch.jit.script
+@profiling.timed("integrate")
 def alpha_from_density(
   density, ts, r_d,
   softplus: bool = True,
@@ -54,9 +77,14 @@ def alpha_from_density(
   if softplus: sigma_a = F.softplus(density-1)
   else: sigma_a = F.relu(density)
 
-  end_val = torch.full_like(ts[..., :1], 1e10)
-  dists = torch.cat([ts[..., 1:] - ts[..., :-1], end_val], dim=-1)
-  while len(dists.shape) < 4: dists = dists[..., None]
+  # per ray ts are bounded to where there is density, so the last sample is not extended to
+  # infinity, otherwise it would pick up the small density just outside the bounds.
+  if len(ts.shape) > 1:
+    dists = torch.cat([ts[1:] - ts[:-1], ts[-1:] - ts[-2:-1]], dim=0)
+  else:
+    end_val = torch.full_like(ts[..., :1], 1e10)
+    dists = torch.cat([ts[..., 1:] - ts[..., :-1], end_val], dim=-1)
+    while len(dists.shape) < 4: dists = dists[..., None]
   dists = dists * torch.linalg.norm(r_d, dim=-1)
   alpha = 1-torch.exp(-sigma_a * dists)
   weights = alpha * cumuprod_exclusive(1.0 - alpha + 1e-10)
@@ -117,6 +145,8 @@ def load_nerf(args):
     kwargs["normalize_latent"] = args.normalize_latent
     kwargs["encoding_size"] = args.encoding_size
   elif args.model == "volsdf":
+    # imported here since sdf.py imports this file
+    import src.sdf as sdf
     kwargs["sdf"] = sdf.load(args, with_integrator=False)
     kwargs["occ_kind"] = args.occ_kind
     kwargs["integrator_kind"] = args.integrator_kind or "direct"
@@ -173,12 +203,27 @@ class CommonNeRF(nn.Module):
 
     self.alpha = None
     self.noise_std = 0.2
+    self.bounds = None
 
     self.set_bg(bg)
     if r is not None: self.refl = r(self.total_latent_size())
     self.set_sigmoid(sigmoid_kind)
 
   def forward(self, _x): raise NotImplementedError()
+  # density at points [..., 3] without any latent, used to bound where rays must be sampled.
+  def density(self, _pts): raise NotImplementedError()
+  # tighten near and far per ray with an occupancy grid (i.e. accel.RayBounds) when not training.
+  def set_bounds(self, bounds): self.bounds = bounds
+  def train(self, mode: bool = True):
+    # density may change while training, so bounds must be recomputed.
+    if mode and getattr(self, "bounds", None) is not None: self.bounds.clear()
+    return super().train(mode)
+  def near_far(self, rays):
+    bounds = getattr(self, "bounds", None)
+    if bounds is None or self.training: return self.t_near, self.t_far
+    r_o, r_d = rays.split([3,3], dim=-1)
+    if bounds.grid is None: bounds.from_density(self.density, r_o.device)
+    return bounds.near_far(r_o, r_d, self.t_near, self.t_far)
   def set_bg(self, bg="black"):
     sky_color_fn = sky_kinds.get(bg, None)
     if sky_color_fn is None: raise NotImplementedError(bg)
@@ -194,6 +239,7 @@ class CommonNeRF(nn.Module):
   def set_sigmoid(self, kind="thin"):
     act = load_sigmoid(kind)
     self.feat_act = act
+    if self.refl is None: return
     if isinstance(self.refl, refl.LightAndRefl): self.refl.refl.act = act
     else: self.refl.act = act
   def sky_from_mlp(self, elaz_r_d, weights):
@@ -255,6 +301,8 @@ class CommonNeRF(nn.Module):
 
 class TinyNeRF(CommonNeRF):
   # No frills, single MLP NeRF
+  # outputs color directly, without a reflectance model.
+  refl = None
   def __init__(
     self,
     out_features: int = 3,
@@ -268,8 +316,9 @@ class TinyNeRF(CommonNeRF):
     )
 
   def forward(self, rays):
+    near, far = self.near_far(rays)
     pts, self.ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
+      rays, near, far, self.steps, perturb = 1 if self.training else 0,
     )
     return self.from_pts(pts, self.ts, r_o, r_d)
 
@@ -278,9 +327,10 @@ class TinyNeRF(CommonNeRF):
     mip_enc = self.mip_encoding(r_o, r_d, ts)
     if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
 
-    density, feats = self.estim(pts, latent).split([1, 3], dim=-1)
+    with profiling.stage("density"):
+      density, feats = self.estim(pts, latent).split([1, 3], dim=-1)
 
-    self.alpha, self.weights = alpha_from_density(density, ts, r_d)
+    self.alpha, self.weights = alpha_from_density(density.squeeze(-1), ts, r_d)
     return volumetric_integrate(self.weights, self.feat_act(feats)) + \
       self.sky_color(None, self.weights)
 
@@ -306,8 +356,9 @@ class PlainNeRF(CommonNeRF):
     )
 
   def forward(self, rays):
+    near, far = self.near_far(rays)
     pts, self.ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
+      rays, near, far, self.steps, perturb = 1 if self.training else 0,
     )
     return self.from_pts(pts, self.ts, r_o, r_d)
 
@@ -318,7 +369,7 @@ class PlainNeRF(CommonNeRF):
     mip_enc = self.mip_encoding(r_o, r_d, ts)
     if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
 
-    first_out = self.first(pts, latent)
+    with profiling.stage("density"): first_out = self.first(pts, latent)
 
     density = first_out[..., 0]
     if self.training and self.noise_std > 0:
@@ -327,10 +378,12 @@ class PlainNeRF(CommonNeRF):
     intermediate = first_out[..., 1:]
 
     view = r_d[None, ...].expand_as(pts)
-    rgb = self.refl(x=pts, view=view, latent=torch.cat([latent, intermediate], dim=-1))
+    with profiling.stage("bsdf"):
+      rgb = self.refl(x=pts, view=view, latent=torch.cat([latent, intermediate], dim=-1))
 
     self.alpha, self.weights = alpha_from_density(density, ts, r_d)
     return volumetric_integrate(self.weights, rgb) + self.sky_color(view, self.weights)
+  def density(self, pts): return F.softplus(self.first(pts)[..., 0]-1)
 
 def histogram_pts_ts(
   rays, near, far, rq,
@@ -339,8 +392,8 @@ def histogram_pts_ts(
   device = r_o.device
   elaz = dir_to_elev_azim(r_d)
   hist = F.softplus(rq(torch.cat([r_o, elaz], dim=-1))).add(1e-2).cumsum(dim=-1)
-  ts = (near + (far - near) * hist/hist.max(keepdim=True, dim=-1)).reshape(-1, *r_d.shape[:-1])
-  pts = r_o.unsqueeze(0) + ts * r_d
+  ts = (near + (far - near) * hist/hist.max(keepdim=True, dim=-1)[0]).movedim(-1, 0)
+  pts = r_o.unsqueeze(0) + ts[..., None] * r_d.unsqueeze(0)
   return pts, ts, r_o, r_d
 
 # NeRF which uses a spline to compute ray query points
@@ -359,7 +412,7 @@ class HistogramNeRF(CommonNeRF):
     )
 
     self.ray_query = SkipConnMLP(
-      in_size=5, out=self.step_size, enc=FourierEncoder(input_dims=3),
+      in_size=5, out=self.steps, enc=FourierEncoder(input_dims=5),
       num_layers = 6, hidden_size = 128, init="xavier",
     )
 
@@ -410,8 +463,9 @@ class SplineNeRF(CommonNeRF):
       num_layers = 5, hidden_size = 256, init="xavier",
     )
   def forward(self, rays):
+    near, far = self.near_far(rays)
     pts, self.ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
+      rays, near, far, self.steps, perturb = 1 if self.training else 0,
     )
     return self.from_pts(pts, self.ts, r_o, r_d)
   def compute_density_intermediate(self, x):
@@ -479,8 +533,9 @@ class NeRFAE(CommonNeRF):
     self.regularize_latent = True
     self.latent_l2_loss = 0
   def forward(self, rays):
+    near, far = self.near_far(rays)
     pts, self.ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
+      rays, near, far, self.steps, perturb = 1 if self.training else 0,
     )
     return self.from_pts(pts, self.ts, r_o, r_d)
 
@@ -548,6 +603,9 @@ class VolSDF(CommonNeRF):
     if self.secondary == self.path: return False
     self.secondary = self.path
     self.path_n = N = 3
+    self.path_bounces = 1
+    # samples with smaller weights do not spawn secondary rays.
+    self.path_eps = 1e-3
     missing_cmpts = 3 * (N + 1) + 6
 
     # transfer_fn := G(x1, x2) -> [0,1]
@@ -558,71 +616,86 @@ class VolSDF(CommonNeRF):
       hidden_size=512,
     )
     return True
-  def direct(self, r_o, weights, pts, view, n, latent):
+  def direct(self, r_o, weights, pts, view, n, latent, lights=None):
     out = torch.zeros_like(pts)
-    for light in self.sdf.refl.light.iter():
-      light_dir, light_val = self.occ(pts, light, self.sdf.intersect_mask, latent=latent)
+    if lights is None: lights = self.sdf.refl.light
+    for light in lights.iter():
+      with profiling.stage("occlusion"):
+        light_dir, light_val = self.occ(pts, light, self.sdf.intersect_mask, latent=latent)
       bsdf_val = self.sdf.refl(x=pts, view=view, normal=n, light=light_dir, latent=latent)
       out = out + bsdf_val * light_val
     return out
-  # Single bounce path tracing. In theory could be extended to an arbitrary # of bounces.
+  # Path tracing, only from samples whose weight is above path_eps so that samples which do not
+  # contribute to the image do not spawn secondary rays. All secondary rays of a bounce are
+  # intersected together, and each bounce only continues from rays which hit the surface.
   def path(self, r_o, weights, pts, view, n, latent):
-    out = torch.zeros_like(pts)
+    out = self.direct(r_o, weights, pts, view, n, latent)
+    mask = weights.detach() > getattr(self, "path_eps", 1e-3)
+    if not mask.any(): return out
 
-    # number of samples for 1st order bounces
+    # number of samples for 1st order bounces, later bounces take one sample each.
     N = self.path_n if self.training else max(10, self.path_n*2)
-
-    # for each point sample some number of directions
-    dirs = sample_random_sphere(n, num_samples=N)
-    # compute intersection of random directions with surface
-    ext_pts, ext_hits, dists, _ = march.bisect(
-      self.sdf.underlying, pts[None,...].expand_as(dirs), dirs, iters=64, near=5e-3, far=6,
+    indirect = self.bounce(
+      pts[mask], view[mask], n[mask], None if latent is None else latent[mask], mask, N,
+      getattr(self, "path_bounces", 1),
     )
+    return out + torch.zeros_like(out).masked_scatter(mask[..., None], indirect)
+  # Returns indirect light at points [K, 3], which are where mask is true in some larger shape.
+  def bounce(self, pts, view, n, latent, mask, N: int, bounces: int):
+    # for each point sample some number of directions in the hemisphere around the normal
+    dirs, pdf = self.sdf.refl.sample(x=pts, view=view, normal=n, latent=latent, num_samples=N)
+    # compute intersection of random directions with surface
+    with profiling.stage("secondary_isect"):
+      ext_pts, hits, _, _ = march.bisect_adaptive(
+        self.sdf.underlying, pts[None].expand_as(dirs), dirs, iters=64, near=5e-3, far=6,
+      )
+    ext_mask = torch.zeros((N,) + mask.shape, dtype=torch.bool, device=mask.device)
+    ext_mask[:, mask] = hits
+    out = torch.zeros_like(pts)
+    if not hits.any(): return out
 
-    ext_sdf_vals, ext_latent = self.sdf.from_pts(ext_pts)
-
-    ext_view = F.normalize(ext_pts - r_o[None,None,...], dim=-1)
+    fit = lambda x: None if x is None else x[None].expand(N, *x.shape)[hits]
+    ext_pts, dirs = ext_pts[hits], dirs[hits]
+    _, ext_latent = self.sdf.from_pts(ext_pts)
     ext_n = F.normalize(self.sdf.normals(ext_pts), dim=-1).detach()
 
-    fit = lambda x: x.unsqueeze(0).expand(N,-1,-1,-1,-1,-1)
-    # reflection at the intersection points from light incoming from the random directions
+    # reflection at the points from light incoming from the random directions
+    src, src_latent = fit(pts), fit(latent)
     first_step_bsdf = self.sdf.refl(
-      x=fit(pts), view=ext_view, normal=fit(n), light=-dirs, latent=fit(latent),
+      x=src, view=fit(view), normal=fit(n), light=dirs, latent=src_latent,
     )
     # compute transfer function (G) between ext_pts and pts (which is a proxy for the density).
     tf = self.transfer_fn(
-      torch.cat([ext_pts, pts.unsqueeze(0).expand_as(ext_pts)],dim=-1),
-      torch.cat([ext_latent, latent.unsqueeze(0).expand_as(ext_latent)], dim=-1),
+      torch.cat([ext_pts, src], dim=-1),
+      None if latent is None else torch.cat([ext_latent, src_latent], dim=-1),
     ).sigmoid()
-    first_step_bsdf = first_step_bsdf * tf
 
-    for light in self.sdf.refl.light.iter():
-      # compute direct lighting at each point (identical to direct)
-      light_dir, light_val = self.occ(pts, light, self.sdf.intersect_mask, latent=latent)
-      bsdf_val = self.sdf.refl(x=pts, view=view, normal=n, light=light_dir, latent=latent)
-      out = out + bsdf_val * light_val
-      # compute light contribution and bsdf at 2ndary points from this light
-      ext_light_dir, ext_light_val = \
-        self.occ(ext_pts, light, self.sdf.intersect_mask, latent=ext_latent)
-      path_bsdf = self.sdf.refl(
-        x=ext_pts, view=dirs, normal=ext_n, light=ext_light_dir, latent=ext_latent,
-      )
-      second_step = ext_light_val * path_bsdf
-      # sum over the contributions at each point adding with each secondary contribution
-      # Take the mean, so that adding in more samples does not cause an infinite increase in
-      # light.
-      secondary = (first_step_bsdf * second_step).mean(dim=0)
-      out = out + secondary
-
-    return out
+    # light leaving the secondary points towards the points, from lights and further bounces.
+    incoming = masked_direct(
+      self.sdf.refl, self.occ, self.sdf.intersect_mask, self.sdf.refl.light,
+      ext_pts, ext_mask, dirs, ext_n, ext_latent,
+    )
+    if bounces > 1:
+      incoming = incoming + self.bounce(ext_pts, dirs, ext_n, ext_latent, ext_mask, 1, bounces-1)
+
+    contrib = torch.zeros((N,) + pts.shape, device=pts.device, dtype=pts.dtype)
+    pdf = pdf[hits].clamp(min=1e-4)
+    contrib = contrib.masked_scatter(hits[..., None], first_step_bsdf * tf * incoming/pdf)
+    # Monte Carlo estimate of the integral over the hemisphere, so adding in more samples does not
+    # cause an infinite increase in light.
+    return contrib.mean(dim=0)
   def forward(self, rays):
+    near, far = self.near_far(rays)
     pts, self.ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
+      rays, near, far, self.steps, perturb = 1 if self.training else 0,
     )
     return self.from_pts(pts, self.ts, r_o, r_d)
 
   @property
   def intermediate_size(self): return self.sdf.latent_size
+  def density(self, pts):
+    scale = self.scale_act(self.scale)
+    return 1/scale * laplace_cdf(-self.sdf.from_pts(pts)[0], scale)
 
   def set_refl(self, refl): self.sdf.refl = refl
 
@@ -630,25 +703,45 @@ class VolSDF(CommonNeRF):
   def refl(self): return self.sdf.refl
 
   def from_pts(self, pts, ts, r_o, r_d):
+    latent, n, view = self.geometry(pts, ts, r_o, r_d)
+    if self.secondary is None:
+      with profiling.stage("bsdf"): rgb = self.sdf.refl(x=pts, view=view, normal=n, latent=latent)
+    else:
+      with profiling.stage("shading"): rgb = self.secondary(r_o, self.weights, pts, view, n, latent)
+
+    return volumetric_integrate(self.weights, rgb)
+  # the light independent part of rendering: weights, normals, latent and view directions.
+  def geometry(self, pts, ts, r_o, r_d):
     latent = self.curr_latent(pts.shape)
     mip_enc = self.mip_encoding(r_o, r_d, ts)
     if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
 
-    sdf_vals, latent = self.sdf.from_pts(pts)
+    with profiling.stage("density"): sdf_vals, latent = self.sdf.from_pts(pts)
     scale = self.scale_act(self.scale)
     self.scale_post_act = scale
     density = 1/scale * laplace_cdf(-sdf_vals, scale)
     self.alpha, self.weights = alpha_from_density(density, ts, r_d, softplus=False)
 
-    n = None
+    # kept so that regularizers can reuse samples and normals from rendering.
+    self.pts = pts
+    self.raw_n = n = None
     if self.sdf.refl.can_use_normal or self.secondary is not None:
-      self.n = n = F.normalize(self.sdf.normals(pts), dim=-1)
+      self.raw_n = self.sdf.normals(pts)
+      self.n = n = F.normalize(self.raw_n, dim=-1)
 
     view = r_d.unsqueeze(0).expand_as(pts)
-    if self.secondary is None: rgb = self.sdf.refl(x=pts, view=view, normal=n, latent=latent)
-    else: rgb = self.secondary(r_o, self.weights, pts, view, n, latent)
-
-    return volumetric_integrate(self.weights, rgb)
+    return latent, n, view
+  # renders the rays once under each set of lights, only computing geometry once.
+  def relight(self, rays, lights):
+    if self.secondary != self.direct:
+      raise NotImplementedError("Relighting is only supported with the direct integrator")
+    near, far = self.near_far(rays)
+    pts, self.ts, r_o, r_d = compute_pts_ts(rays, near, far, self.steps)
+    latent, n, view = self.geometry(pts, self.ts, r_o, r_d)
+    return [
+      volumetric_integrate(self.weights, self.direct(r_o, self.weights, pts, view, n, latent, l))
+      for l in lights
+    ]
   def set_sigmoid(self, kind="thin"):
     if not hasattr(self, "sdf"): return
     act = load_sigmoid(kind)
@@ -686,8 +779,9 @@ class RecurrentNeRF(CommonNeRF):
     )
 
   def forward(self, rays):
+    near, far = self.near_far(rays)
     pts, self.ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
+      rays, near, far, self.steps, perturb = 1 if self.training else 0,
     )
     return self.from_pts(pts, self.ts, r_o, r_d)
 
@@ -756,13 +850,33 @@ class AlternatingVolSDF(nn.Module):
       return direct(self.volsdf.sdf, self.volsdf.refl, self.volsdf.occ, rays, self.training)
 
 def one(*args, **kwargs): return 1
-# de_casteljau's algorithm for evaluating bezier splines without numerical instability..
+# binomial coefficients (N-1 choose k) for each k, cached since they are used every forward.
+binomials = {}
+def binomial_coeffs(N: int, device, dtype):
+  key = (N, device, dtype)
+  if key not in binomials:
+    binomials[key] = torch.tensor([math.comb(N-1, k) for k in range(N)], device=device, dtype=dtype)
+  return binomials[key]
+
+# Evaluates bezier splines with N control points in the first dimension of coeffs at t, which
+# must broadcast with coeffs[0]. Equivalent to de casteljau's algorithm, but evaluates the
+# bernstein basis in closed form instead of N-1 rounds of interpolation.
 def de_casteljau(coeffs, t, N: int):
-  betas = coeffs
-  m1t = 1 - t
-  # TODO some way to vectorize this?
-  for i in range(1, N): betas = betas[:-1] * m1t + betas[1:] * t
-  return betas.squeeze(0)
+  assert(coeffs.shape[0] == N), f"Expected {N} control points, got {coeffs.shape[0]}"
+  assert(t.dim() < coeffs.dim() or t.shape[0] == 1), \
+    f"t {tuple(t.shape)} must broadcast with a control point {tuple(coeffs.shape[1:])}"
+  if N == 1: return coeffs.squeeze(0)
+  t = t.unsqueeze(0)
+  ones = torch.ones_like(t)
+  rest = (N-1, *t.shape[1:])
+  # t^k and (1-t)^(N-1-k) for each k, cumprod is cheaper than pow.
+  t_k = torch.cat([ones, t.expand(rest)], dim=0).cumprod(dim=0)
+  m1t_k = torch.cat([ones, (1-t).expand(rest)], dim=0).cumprod(dim=0).flip(0)
+  shape = (N,) + (1,) * (t.dim()-1)
+  basis = binomial_coeffs(N, t.device, t.dtype).reshape(shape) * t_k * m1t_k
+  # same shape as interpolating N-1 times, which also broadcasts t against a control point.
+  out_shape = torch.broadcast_shapes(coeffs[:1].shape, t.shape[1:])
+  return torch.einsum("n...,n...->...", basis, coeffs).reshape(out_shape).squeeze(0)
 
 # de_moor's algorithm for evaluating bezier splines with a given knot vector
 def de_moors(coeffs, t, knots, N: int):
@@ -772,15 +886,64 @@ def cubic_bezier(coeffs, t, N: int):
   assert(N == 4), f"Must be cubic, got {N}"
   m1t = 1 - t
   m1t_sq, t_sq = m1t * m1t, t * t
-  k = torch.stack([m1t_sq * m1t, m1t_sq * t, t_sq * m1t, t_sq * t], dim=0)
+  k = torch.stack([m1t_sq * m1t, 3 * m1t_sq * t, 3 * t_sq * m1t, t_sq * t], dim=0)
   return (k * coeffs).sum(dim=0)
 
+# Caches the deformation of DynamicNeRF at fixed times on a dense grid in [-bound, bound]^3,
+# which is trilinearly sampled instead of evaluating the deformation for every sample.
+# Only used when rendering (not training), and keeps the `size` most recently used times.
+class DeformationCache:
+  def __init__(self, resolution: int = 128, bound: float = 1.5, size: int = 4):
+    assert(resolution > 1), "Must have at least 2 grid points along each axis"
+    self.resolution = resolution
+    self.bound = bound
+    self.size = size
+    self.grids = OrderedDict()
+  def clear(self): self.grids.clear()
+  # evaluates deformation, flow and rigidity over the grid, returns [1, 7, R, R, R].
+  def build(self, model, t: float, chunk: int = 1 << 16):
+    R = self.resolution
+    device = next(model.parameters()).device
+    coords = torch.linspace(-self.bound, self.bound, R, device=device)
+    pts = torch.stack(torch.meshgrid(coords, coords, coords, indexing="ij"), dim=-1).reshape(-1, 3)
+    out = []
+    with torch.no_grad():
+      for p in pts.split(chunk, dim=0):
+        deform = model.time_estim(p, torch.full_like(p[..., :1], t))
+        out.append(torch.cat([deform, model.dp, model.rigidity], dim=-1))
+    return torch.cat(out, dim=0).reshape(R, R, R, 7).permute(3, 0, 1, 2).unsqueeze(0)
+  def get(self, model, t: float):
+    if t in self.grids: self.grids.move_to_end(t)
+    else:
+      self.grids[t] = self.build(model, t)
+      if len(self.grids) > self.size: self.grids.popitem(last=False)
+    return self.grids[t]
+  # Returns the deformation of pts at time t, and sets the flow and rigidity on the model.
+  # Points outside of the grid are evaluated exactly.
+  def deform(self, model, pts, t: float):
+    grid = self.get(model, t)
+    flat = pts.reshape(-1, 3)
+    # grid is laid out as [x,y,z] but grid_sample expects coordinates in (z,y,x) order.
+    coords = (flat/self.bound).flip(-1)[None, :, None, None, :]
+    vals = F.grid_sample(grid, coords, mode="bilinear", align_corners=True)
+    deform, dp, rigidity = vals.reshape(7, -1).t().split([3, 3, 1], dim=-1)
+    outside = (flat.abs() > self.bound).any(dim=-1)
+    if outside.any():
+      out_pts = flat[outside]
+      deform[outside] = model.time_estim(out_pts, torch.full_like(out_pts[..., :1], t))
+      dp[outside] = model.dp
+      rigidity[outside] = model.rigidity
+    model.dp = dp.reshape_as(pts)
+    model.rigidity = rigidity.reshape(*pts.shape[:-1], 1)
+    return deform.reshape_as(pts)
+
 # Dynamic NeRF for multiple frams
 class DynamicNeRF(nn.Module):
   def __init__(self, canonical: CommonNeRF, spline:int=0):
     super().__init__()
     self.canonical = canonical
     self.spline = spline
+    self.deform_cache = None
 
     if spline > 0: self.set_spline_estim(spline)
     else: self.set_delta_estim()
@@ -799,7 +962,9 @@ class DynamicNeRF(nn.Module):
       in_size=3, out=(spline_points-1)*3+1, num_layers=6,
       hidden_size=324, init="xavier",
     )
-    self.spline_fn = cubic_bezier if spline_points == 4 else de_casteljau
+    # NOTE this used cubic_bezier for 4 points, which was missing the factor of 3 on its middle
+    # terms, but spline_interpolate could not run, so no existing models are affected.
+    self.spline_fn = de_casteljau
     self.spline_n = spline_points
     self.time_estim = self.spline_interpolate
 
@@ -812,9 +977,9 @@ class DynamicNeRF(nn.Module):
     # t is mostly expected to be between 0 and 1, but can be outside for fun.
     rigidity, ps = self.delta_estim(x).split([1, 3 * (self.spline_n-1)], dim=-1)
     self.rigidity = rigidity = upshifted_sigmoid(rigidity/2)
-    ps = torch.stack(ps.split([3] * self.spline_n-1, dim=-1), dim=0)
+    ps = torch.stack(ps.split([3] * (self.spline_n-1), dim=-1), dim=0)
     init_ps = ps[None, 0]
-    self.dp = dp = self.spline_fn(ps - init_ps, t, self.spline_n)
+    self.dp = dp = self.spline_fn(ps - init_ps, t, ps.shape[0])
     return dp * rigidity + init_ps.squeeze(0)
 
   @property
@@ -827,6 +992,12 @@ class DynamicNeRF(nn.Module):
   def intermediate_size(self): return self.canonical.intermediate_size
   def total_latent_size(self): return self.canonical.total_latent_size()
   def set_refl(self, refl): self.canonical.set_refl(refl)
+  def set_deform_cache(self, cache: DeformationCache): self.deform_cache = cache
+  # cached deformations are invalid once parameters change.
+  def train(self, mode: bool = True):
+    cache = getattr(self, "deform_cache", None)
+    if cache is not None: cache.clear()
+    return super().train(mode)
   def forward(self, rays_t):
     rays, t = rays_t
     pts, self.ts, r_o, r_d = compute_pts_ts(
@@ -834,8 +1005,12 @@ class DynamicNeRF(nn.Module):
       perturb = 1 if self.training else 0,
     )
     self.canonical.ts = self.ts
-    t = t[None, :, None, None, None].expand(*pts.shape[:-1], 1)
-    dp = self.time_estim(pts, t)
+    cache = getattr(self, "deform_cache", None)
+    if cache is not None and not self.training and (t == t[0]).all():
+      dp = cache.deform(self, pts, t[0].item())
+    else:
+      t = t[None, :, None, None, None].expand(*pts.shape[:-1], 1)
+      dp = self.time_estim(pts, t)
     return self.canonical.from_pts(pts + dp, self.ts, r_o, r_d)
 
 # Long Dynamic NeRF for computing arbitrary continuous sequences.
@@ -878,7 +1053,7 @@ class LongDynamicNeRF(nn.Module):
     )
     # Parameters in SE3, except 0 which is always 0
     self.global_spline = nn.Parameter(torch.randn(n_points, 6))
-    self.spline_fn = de_casteljeu if self.spline_n != 4 else cubic_bezier
+    self.spline_fn = de_casteljau
 
   def set_refl(self, refl): self.canonical.set_refl(refl)
   def total_latent_size(self): return self.canonical.total_latent_size()
@@ -917,7 +1092,7 @@ class LongDynamicNeRF(nn.Module):
 
     control_pts = torch.cat([starting, inner_points, end], dim=0)
     self.rigidity = rigidity = upshifted_sigmoid(self.global_rigidity(pts)/2)
-    self.dp = dp = self.spline_fn(control_pts, t.frac(), self.spline_n+1) * rigidity
+    self.dp = dp = self.spline_fn(control_pts, t.frac(), self.spline_n) * rigidity
     return self.canonical.from_pts(pts + dp, self.ts, r_o, r_d)
 
 # Dynamic NeRFAE for multiple frames with changing materials
@@ -1032,12 +1207,16 @@ class MPI(nn.Module):
   def from_pts(self, pts, ts, r_o, r_d):
     return self.canonical.from_pts(pts, ts, r_o, r_d)
 
-def load_dyn(args, model, device):
+# load is used to load the canonical model from a path if args.with_canon is set.
+def load_dyn(args, model, device, load=None):
   dyn_cons = dyn_model_kinds.get(args.dyn_model, None)
   if dyn_cons is None: raise NotImplementedError(f"Unknown dyn kind: {args.dyn_model}")
 
   if args.with_canon is not None:
-    model = torch.load(args.with_canon, map_location=device)
+    if load is None:
+      model = checkpoint.load(args.with_canon, map_location=device)
+      assert(not checkpoint.is_checkpoint(model)), "Checkpoints must be loaded with their config"
+    else: model = load(args.with_canon)
     assert(isinstance(model, CommonNeRF)), f"Can only use NeRF subtype, got {type(model)}"
     # TODO if dynae need to check that model is NeRFAE
   kwargs = { "canonical": model, "spline": args.spline }
@@ -168,7 +168,8 @@ class SkipConnMLP(nn.Module):
 
   def forward(self, p, latent: Optional[torch.Tensor]=None):
     batches = p.shape[:-1]
-    init = p.reshape(-1, p.shape[-1])
+    # inputs may have no features (e.g. refl.NoSpace without a latent), so -1 would be ambiguous.
+    init = p.reshape(-1, p.shape[-1]) if p.shape[-1] != 0 else p.flatten(end_dim=-2)
 
     if self.enc is not None: init = torch.cat([init, self.enc(init)], dim=-1)
     if self.latent_size != 0:
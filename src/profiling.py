@@ -0,0 +1,94 @@
+# Per-stage timing of the render pipeline.
+# Stages are named torch.profiler.record_function ranges, so they show up in Chrome traces,
+# and accumulate wall-clock time while enabled. When disabled a stage is a shared no-op.
+# Times are inclusive, so nested stages (i.e. marching inside occlusion) are counted in both.
+import functools
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import torch
+
+enabled = False
+# synchronize cuda at stage boundaries, otherwise only kernel launch time is measured.
+sync = False
+
+totals = defaultdict(float)
+counts = defaultdict(int)
+steps = 0
+step_time = 0
+_step_start = None
+
+_noop = nullcontext()
+
+class Stage:
+  def __init__(self, name):
+    self.name = name
+    self.record = torch.profiler.record_function(name)
+  def __enter__(self):
+    self.record.__enter__()
+    if sync: torch.cuda.synchronize()
+    self.start = time.perf_counter()
+    return self
+  def __exit__(self, *exc):
+    if sync: torch.cuda.synchronize()
+    totals[self.name] += time.perf_counter() - self.start
+    counts[self.name] += 1
+    return self.record.__exit__(*exc)
+
+def stage(name: str): return Stage(name) if enabled else _noop
+
+# decorator which wraps an entire function in a stage.
+def timed(name: str):
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with stage(name): return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def enable(with_sync: bool = torch.cuda.is_available()):
+  global enabled, sync
+  enabled = True
+  sync = with_sync
+  reset()
+
+def disable():
+  global enabled
+  enabled = False
+
+def reset():
+  global steps, step_time, _step_start
+  totals.clear()
+  counts.clear()
+  steps = 0
+  step_time = 0
+  _step_start = None
+
+# Steps delimit iterations, so stages can be reported relative to the time of a step.
+def begin_step():
+  global _step_start
+  if not enabled: return
+  if sync: torch.cuda.synchronize()
+  _step_start = time.perf_counter()
+
+def end_step():
+  global steps, step_time
+  if not enabled or _step_start is None: return
+  if sync: torch.cuda.synchronize()
+  step_time += time.perf_counter() - _step_start
+  steps += 1
+
+def summary() -> str:
+  n = max(steps, 1)
+  lines = [
+    f"[Profile ({steps} steps, {1e3 * step_time/n:.02f} ms/step)]:",
+    f"{'stage':<24}{'calls/step':>12}{'ms/step':>12}{'ms/call':>12}{'% step':>10}",
+  ]
+  for name, total in sorted(totals.items(), key=lambda kv: -kv[1]):
+    calls = counts[name]
+    pct = 100 * total/step_time if step_time > 0 else 0
+    lines.append(
+      f"{name:<24}{calls/n:>12.01f}{1e3 * total/n:>12.03f}{1e3 * total/calls:>12.03f}{pct:>10.01f}"
+    )
+  return "\n".join(lines)
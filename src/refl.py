@@ -8,6 +8,8 @@ from typing import Optional
 from .neural_blocks import ( SkipConnMLP, NNEncoder, FourierEncoder )
 from .utils import ( autograd, eikonal_loss, dir_to_elev_azim, rotate_vector, load_sigmoid )
 import src.lights as lights
+import src.profiling as profiling
+import src.sampling as sampling
 from .spherical_harmonics import eval_sh
 
 
@@ -63,7 +65,9 @@ class LightAndRefl(nn.Module):
   def forward(self, x, view=None, normal=None, light=None, latent=None, mask=None):
     # if no light is explicitly passed then recompute the direction.
     assert(light is not None), "Must use the stored light in order to compute lighting"
-    return self.refl(x, view, normal, light, latent)
+    with profiling.stage("bsdf"): return self.refl(x, view, normal, light, latent)
+  def sample(self, x, view, normal, latent=None, num_samples:int=1):
+    return self.refl.sample(x, view, normal, latent, num_samples)
 
 # Convert from arbitrary 3d space to a 2d encoding.
 class SurfaceSpace(nn.Module):
@@ -91,7 +95,7 @@ class IdentitySpace(nn.Module):
 # Do not encode the space whatsoever, only relying on other view-dependent features.
 class NoSpace(nn.Module):
   def __init__(self): super().__init__()
-  def forward(self, x): torch.empty((*x.shape[:-1], 0), device=x.device, dtype=torch.float)
+  def forward(self, x): return torch.empty((*x.shape[:-1], 0), device=x.device, dtype=x.dtype)
   @property
   def dims(self): return 0
 
@@ -116,6 +120,11 @@ class Reflectance(nn.Module):
     self.act = load_sigmoid(act)
 
   def forward(self, x, view,normal=None,light=None,latent=None): raise NotImplementedError()
+  # Samples incoming light directions [num_samples, ..., 3] at x, and their pdf [num_samples, ..., 1].
+  # Since the reflectance includes the cosine term, cosine weighted sampling is exact importance
+  # sampling for Diffuse, and reasonable for the others.
+  def sample(self, x, view, normal, latent=None, num_samples:int=1):
+    return cosine_sample(normal, num_samples)
   @property
   def can_use_normal(self): return False
   @property
@@ -174,7 +183,6 @@ class Basic(Reflectance):
     x = self.space(x)
     view = self.view_enc(view)
     normal = self.normal_enc(normal)
-    self.light_enc = empty
     light = self.light_enc(light)
     v = torch.cat([v for v in [x, view, normal, light] if v is not None], dim=-1)
     return self.act(self.mlp(v, latent))
@@ -455,65 +463,56 @@ class Rusin(Reflectance):
   def raw(self, rusin_params, latent=None):
     return self.act(self.rusin(rusin_params.cos(), latent))
 
+  # when not training, use a table of the reflectance instead of the MLP.
+  def set_lut(self, lut):
+    assert(self.space.dims == 0), "Can only tabulate Rusin reflectance without a space"
+    assert(self.latent_size == 0 or lut.latent is not None), \
+      "Must provide a fixed latent to tabulate Rusin reflectance with latents"
+    self.lut = lut
+  def train(self, mode: bool = True):
+    if mode and getattr(self, "lut", None) is not None: self.lut.clear()
+    return super().train(mode)
+
   def forward(self, x, view, normal, light, latent=None):
     # NOTE detach the normals since there is no grounding of them w/ Rusin reflectance
-    frame = coordinate_system(normal.detach())
-    # have to move view and light into basis of normal
-    wo = to_local(frame, F.normalize(view, dim=-1))
-    wi = to_local(frame, light)
-    rusin = rusin_params(wo, wi)
+    rusin = fused_rusin_params(normal.detach(), view, light)
+    lut = getattr(self, "lut", None)
+    if lut is not None and not self.training:
+      if lut.grid is None: lut.bake(self, rusin.device)
+      return lut.lookup(rusin)
     params = torch.cat([rusin, self.space(x)], dim=-1)
     return self.act(self.rusin(params, latent))
 
-# Helmholtz decomposition of the Rusin function.
-# I believe this allows for separately learning the diffuse component
-class RusinHelmholtz(Reflectance):
-  def __init__(
-    self,
-    space=None,
-    **kwargs,
-  ):
-    super().__init__(**kwargs)
-    assert(out_features==3), "RusinHelmholtz can only output RGB"
-    if space is None: space = IdentitySpace()
-    rusin_size = 3
-    self.space = space
-    in_size = rusin_size + space.dims
-    self.scalar_potential = SkipConnMLP(
-      in_size=in_size, out=1, latent_size=self.latent_size,
-      enc=FourierEncoder(input_dims=in_size), init="xavier",
-      num_layers=5, hidden_size=256,
-    )
-    self.solenoidal = SkipConnMLP(
-      in_size=in_size, out=3, latent_size=self.latent_size,
-      enc=FourierEncoder(input_dims=in_size), init="xavier",
-      num_layers=5, hidden_size=256,
-    )
-
-  @property
-  def can_use_normal(self): return True
-  @property
-  def can_use_light(self): return True
-
-  def forward(self, x, view, normal, light, latent=None):
-    # NOTE detach the normals since there is no grounding of them w/ Rusin reflectance
-    frame = coordinate_system(normal.detach())
-    # have to move view and light into basis of normal
-    wo = to_local(frame, F.normalize(view, dim=-1))
-    wi = to_local(frame, light)
-    rusin = rusin_params(wo, wi).requires_grad_()
-    pts = self.space(x)
-    params = torch.cat([rusin, pts], dim=-1)
-    scalar = self.scalar_potential(params, latent)
-    irrotational = autograd(rusin, scalar)
-    # TODO add in divergence-free component
-    vector = self.solenoidal(params, latent)
-    solenoidal = autograd(rusin, vector)
-    print(out.shape)
-    # TODO compute curl of solenoidal component.
-    exit()
-    return -irrotational
-
+# A table of a Rusin reflectance over a grid of (phi_d, theta_h, theta_d) in [0, pi]^3, looked
+# up with trilinear interpolation. Only valid for reflectance which does not depend on position,
+# and either has no latent or a single fixed latent for all points.
+class RusinLUT:
+  def __init__(self, resolution: int = 64, latent=None, chunk: int = 1 << 16):
+    assert(resolution > 1), "Must have at least 2 samples along each axis"
+    self.resolution = resolution
+    self.latent = latent
+    self.chunk = chunk
+    self.grid = None
+  # must be called if the reflectance changes.
+  def clear(self): self.grid = None
+  def bake(self, rusin, device="cpu"):
+    axis = torch.linspace(0, math.pi, self.resolution, device=device)
+    angles = torch.stack(torch.meshgrid(axis, axis, axis, indexing="ij"), dim=-1).reshape(-1, 3)
+    with torch.no_grad():
+      vals = torch.cat([
+        rusin.raw(a, None if self.latent is None else self.latent.to(device).expand(a.shape[0], -1))
+        for a in angles.split(self.chunk, dim=0)
+      ], dim=0)
+    # grid is laid out as [C, phi_d, theta_h, theta_d].
+    self.grid = vals.reshape((self.resolution,) * 3 + (-1,)).permute(3, 0, 1, 2)[None]
+  # rusin_params [..., 3] are cosines of the angles, as returned by rusin_params.
+  def lookup(self, rusin_params):
+    shape = rusin_params.shape[:-1]
+    angles = rusin_params.reshape(-1, 3).clamp(min=-1, max=1).acos()
+    # grid_sample expects coordinates in (theta_d, theta_h, phi_d) order.
+    coords = (angles * (2/math.pi) - 1).flip(-1)[None, :, None, None, :]
+    out = F.grid_sample(self.grid, coords.to(self.grid.dtype), mode="bilinear", align_corners=True)
+    return out.reshape(self.grid.shape[1], -1).T.reshape(*shape, -1)
 
 # The sum of an analytic and learned BRDF, intended to be the case that only one of them will
 # have their parameters with gradients at a time so that optimizing them will guarantee the
@@ -563,6 +562,8 @@ class AlternatingOptimization(nn.Module):
     if not hasattr(self, "blend"): self.add_blend()
     t = self.blend(x, latent).sigmoid()
     return t * learned + (1-t) * analytic
+  def sample(self, x, view, normal, latent=None, num_samples:int=1):
+    return self.analytic.sample(x, view, normal, latent, num_samples)
 
 def nonzero_eps(v, eps: float=1e-7):
   # in theory should also be copysign of eps, but so small it doesn't matter
@@ -574,8 +575,8 @@ def nonzero_eps(v, eps: float=1e-7):
 def rusin_params(wo, wi):
   wo = F.normalize(wo, eps=1e-6, dim=-1)
   wi = F.normalize(wi, eps=1e-6, dim=-1)
-  e_1 = torch.tensor([0,1,0], device=wo.device, dtype=torch.float).expand_as(wo)
-  e_2 = torch.tensor([0,0,1], device=wo.device, dtype=torch.float).expand_as(wo)
+  e_1 = torch.tensor([0,1,0], device=wo.device, dtype=wo.dtype).expand_as(wo)
+  e_2 = torch.tensor([0,0,1], device=wo.device, dtype=wo.dtype).expand_as(wo)
 
   H = F.normalize((wo + wi), eps=1e-6, dim=-1)
 
@@ -598,6 +599,44 @@ def rusin_params(wo, wi):
 
   return torch.stack([phi_d, cos_theta_h, cos_theta_d], dim=-1)
 
+# The same as rusin_params(to_local(frame, view), to_local(frame, light)) in the frame of normal,
+# but computed from dot products in world space: the two rotations of wi into the frame of the
+# half vector are written out in closed form, so no frame or rotated vectors are built.
+@torch.jit.script
+def fused_rusin_params(normal, view, light):
+  n = F.normalize(normal, eps=1e-6, dim=-1)
+  wo = F.normalize(view, eps=1e-6, dim=-1)
+  wi = F.normalize(light, eps=1e-6, dim=-1)
+  # the half vector is kept unnormalized, since wo + wi is small when they are nearly opposite,
+  # and the dot products below are more accurate in terms of it.
+  h = wo + wi
+  h_len = (h * h).sum(dim=-1, keepdim=True).sqrt().clamp(min=1e-6)
+  h_z = (h * n).sum(dim=-1, keepdim=True)
+  cos_theta_h = h_z/h_len
+  wz = (wi * n).sum(dim=-1, keepdim=True)
+
+  # rotate wi about n by -phi_h: components along H's projection onto the tangent plane,
+  # perpendicular to it, and along n. Since wo and wi are unit, h.wi = |h|^2/2 and
+  # h x wi = wo x wi, which stay accurate when wo ~ -wi.
+  h_t = h - h_z * n
+  r = ((h_t * h_t).sum(dim=-1, keepdim=True).sqrt()/h_len).clamp(min=1e-6)
+  a = (0.5 * h_len * h_len - h_z * wz)/(h_len * r)
+  b = (n * torch.cross(wo, wi, dim=-1)).sum(dim=-1, keepdim=True)/(h_len * r)
+  tmp = torch.cat([a, b, wz], dim=-1)
+  a, b, wz = F.normalize(tmp, dim=-1).split([1, 1, 1], dim=-1)
+
+  # rotate about the binormal, with the same angle as rusin_params.
+  c = cos_theta_h
+  s = -(1 - cos_theta_h).clamp(min=1e-6).sqrt()
+  diff = F.normalize(torch.cat([a * c + wz * s, b, wz * c - a * s], dim=-1), eps=1e-6, dim=-1)
+  cos_theta_d = diff[..., 2:]
+
+  x = nonzero_eps(diff[..., :1])
+  y = nonzero_eps(diff[..., 1:2])
+  # cos(atan2(y, x))
+  cos_phi_d = x/x.hypot(y)
+  return torch.cat([cos_phi_d, cos_theta_h, cos_theta_d], dim=-1)
+
 # https://github.com/mitsuba-renderer/mitsuba2/blob/main/include/mitsuba/core/vector.h#L116
 # had to be significantly modified in order to add numerical stability while back-propagating.
 # returns a frame to be used for normalization
@@ -622,6 +661,18 @@ def coordinate_system(n):
   s = F.normalize(n.cross(t, dim=-1), eps=1e-6, dim=-1)
   return torch.stack([s, t, n], dim=-1)
 
+# Cosine weighted directions in the hemisphere around normal [..., 3] in its local frame,
+# returns directions [num_samples, ..., 3] and their pdf cos/pi [num_samples, ..., 1].
+def cosine_sample(normal, num_samples:int=1):
+  frame = coordinate_system(normal)
+  uv = sampling.per_point(normal.shape[:-1], num_samples, 2, normal.device, stream="hemisphere")
+  u, v = uv.to(normal.dtype).unbind(-1)
+  r = u.sqrt()
+  phi = 2 * math.pi * v
+  local = torch.stack([r * phi.cos(), r * phi.sin(), (1 - u).clamp(min=0).sqrt()], dim=-1)
+  dirs = (frame[None] * local.unsqueeze(-2)).sum(dim=-1)
+  return dirs, local[..., 2:]/math.pi
+
 # https://www.pbr-book.org/3ed-2018/Geometry_and_Transformations/Vectors
 def coordinate_system2(n):
   n = F.normalize(n, eps=1e-6, dim=-1)
@@ -676,7 +727,6 @@ refl_kinds = {
   "basic": Basic,
   "diffuse": Diffuse,
   "rusin": Rusin,
-  "rusin_helmholtz": RusinHelmholtz,
   # classical models with some order mechanism
   "sph-har": SphericalHarmonic,
   "fourier": FourierBasis,
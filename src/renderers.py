@@ -7,6 +7,7 @@ import math
 from .neural_blocks import ( SkipConnMLP, NNEncoder, FourierEncoder )
 from .utils import ( autograd, eikonal_loss, dir_to_elev_azim, upshifted_sigmoid )
 from .refl import ( LightAndRefl )
+import src.profiling as profiling
 
 def load(args, shape, light_and_refl: LightAndRefl):
   assert(isinstance(light_and_refl, LightAndRefl)), "Need light and reflectance for integrator"
@@ -21,7 +22,12 @@ def load(args, shape, light_and_refl: LightAndRefl):
 
 
   occ = load_occlusion_kind(args, args.occ_kind, ls)
-  integ = cons(shape=shape, refl=light_and_refl.refl, occlusion=occ)
+  kwargs = {}
+  if cons == Path:
+    kwargs["bounces"] = args.path_bounces
+    kwargs["roulette"] = args.path_roulette
+    kwargs["samples"] = args.path_samples
+  integ = cons(shape=shape, refl=light_and_refl, occlusion=occ, **kwargs)
 
   return integ
 
@@ -36,7 +42,7 @@ class LightingWIsect(nn.Module):
   def forward(self, pts, lights, isect_fn, latent=None, mask=None):
     pts = pts if mask is None else pts[mask]
     dir, dist, spectrum = lights(pts, mask=mask)
-    far = dist.max().item() if mask.any() else 6
+    far = dist.max().item() if mask is None or mask.any() else 6
     visible, _, _ = isect_fn(pts, dir, near=0.1, far=far)
     spectrum = torch.where(
       visible[...,None],
@@ -59,7 +65,7 @@ class LearnedLighting(nn.Module):
   def forward(self, pts, lights, isect_fn, latent=None, mask=None):
     pts = pts if mask is None else pts[mask]
     dir, dist, spectrum = lights(pts, mask=mask)
-    far = dist.max().item() if mask.any() else 6
+    far = dist.max().item() if mask is None or mask.any() else 6
     # TODO why doesn't this isect fn seem to work?
     visible, _, _ = isect_fn(r_o=pts, r_d=dir, near=2e-3, far=far, eps=1e-3)
     elaz = dir_to_elev_azim(dir)
@@ -78,7 +84,7 @@ class LearnedConstantSoftLighting(nn.Module):
   def forward(self, pts, lights, isect_fn, latent=None, mask=None):
     pts = pts if mask is None else pts[mask]
     dir, dist, spectrum = lights(pts, mask=mask)
-    far = dist.max().item() if mask and mask.any() else 6
+    far = dist.max().item() if mask is None or mask.any() else 6
     visible, _, _ = isect_fn(r_o=pts, r_d=dir, near=1e-2, far=far, eps=1e-3)
     hit_att = visible + (~visible) * self.alpha.sigmoid()
     return dir, spectrum * hit_att.unsqueeze(-1)
@@ -133,9 +139,10 @@ class JointLearnedConstOcc(nn.Module):
   @property
   def all_learned_occ(self): return self.alo
   def forward(self, pts, lights, isect_fn, latent=None, mask=None):
-    if mask is not None: raise NotImplementedError("TODO did not implement handling mask")
+    pts = pts if mask is None else pts[mask]
     dir, dist, spectrum = lights(pts, mask=mask)
-    far = dist.max().item() if isinstance(dist, torch.Tensor) else dist
+    if not isinstance(dist, torch.Tensor): far = dist
+    else: far = dist.max().item() if mask is None or mask.any() else 6
     # only include the all learned occ if training.
     all_att = self.alo.encode(pts, dir, latent)
     visible, _, _ = isect_fn(r_o=pts, r_d=dir, near=1e-1, far=far, eps=1e-3)
@@ -173,65 +180,125 @@ class Renderer(nn.Module):
     self.occ = occlusion
 
   def forward(self, _rays): raise NotImplementedError()
-
-class Direct(Renderer):
-  def __init__(self, **kwargs):
-    super().__init__(**kwargs)
   @property
   def sdf(self): return self.shape
   def total_latent_size(self): return self.shape.latent_size
+  @property
+  def intermediate_size(self): return self.shape.latent_size
   def set_refl(self, refl): self.refl = refl
+
+class Direct(Renderer):
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
   def forward(s, rays): return direct(s.shape, s.refl, s.occ, rays, s.training)
+  # renders the rays once under each set of lights, only intersecting the surface once.
+  def relight(s, rays, lights):
+    geometry = direct_geometry(s.shape, rays)
+    return [direct_shade(s.shape, s.refl, s.occ, geometry, l) for l in lights]
 
 # Functional version of integration
 def direct(shape, refl, occ, rays, training=True):
-  r_o, r_d = rays.split([3, 3], dim=-1)
+  geometry = direct_geometry(shape, rays)
+  out = direct_shade(shape, refl, occ, geometry, refl.light)
+  if training: out = torch.cat([out, geometry[3]], dim=-1)
+  return out
 
-  pts, hits, tput, n = shape.intersect_w_n(r_o, r_d)
-  _, latent = shape.from_pts(pts[hits])
+# the light independent part of direct integration: surface points, normals and latent.
+def direct_geometry(shape, rays):
+  r_o, r_d = rays.split([3, 3], dim=-1)
+  with profiling.stage("intersect"): pts, hits, tput, n = shape.intersect_w_n(r_o, r_d)
+  with profiling.stage("density"): _, latent = shape.from_pts(pts[hits])
+  return r_d, pts, hits, tput, n, latent
 
+def direct_shade(shape, refl, occ, geometry, lights):
+  r_d, pts, hits, _, n, latent = geometry
   out = torch.zeros_like(r_d)
-  for light in refl.light.iter():
-    light_dir, light_val = occ(pts, light, shape.intersect_mask, mask=hits, latent=latent)
+  for light in lights.iter():
+    with profiling.stage("occlusion"):
+      light_dir, light_val = occ(pts, light, shape.intersect_mask, mask=hits, latent=latent)
     bsdf_val = refl(x=pts[hits], view=r_d[hits], normal=n[hits], light=light_dir, latent=latent)
     out[hits] = out[hits] + bsdf_val * light_val
-  if training: out = torch.cat([out, tput], dim=-1)
   return out
 
-def path(shape, refl, occ, rays, training=True):
-  r_o, r_d = rays.split([3, 3], dim=-1)
+# direct lighting at points [K, 3], which are where mask is true in some larger shape, since
+# lights and occlusion take points in the shape of mask.
+def masked_direct(refl, occ, isect_fn, lights, pts, mask, view, normal, latent):
+  out = torch.zeros_like(pts)
+  full = torch.zeros(mask.shape + (3,), device=pts.device, dtype=pts.dtype)
+  full = full.masked_scatter(mask[..., None], pts)
+  for light in lights.iter():
+    with profiling.stage("occlusion"):
+      light_dir, light_val = occ(full, light, isect_fn, mask=mask, latent=latent)
+    out = out + refl(x=pts, view=view, normal=normal, light=light_dir, latent=latent) * light_val
+  return out
 
-  pts, hits, tput, n = shape.intersect_w_n(r_o, r_d)
-  _, latent = shape.from_pts(pts[hits])
+# Path tracing from the first surface intersection. Each bounce samples a cosine weighted
+# direction, and all paths which are still active are intersected together. Lights are sampled
+# at every vertex, and after `roulette` bounces paths are randomly terminated with probability
+# based on their throughput, so that the expected value is unchanged.
+def path(shape, refl, occ, rays, bounces: int = 1, roulette: int = 1, samples: int = 1, training=True):
+  geometry = direct_geometry(shape, rays)
+  out = direct_shade(shape, refl, occ, geometry, refl.light)
+  if bounces > 0:
+    with profiling.stage("indirect"):
+      out = out + indirect(shape, refl, occ, geometry, bounces, roulette, samples)
+  if training: out = torch.cat([out, geometry[3]], dim=-1)
+  return out
 
-  out = torch.zeros_like(r_d)
-  for light in refl.light.iter():
-    light_dir, light_val = occ(pts, light, shape.intersect_mask, mask=hits, latent=latent)
-    bsdf_val = refl(x=pts[hits], view=r_d[hits], normal=n[hits], light=light_dir, latent=latent)
-    out[hits] = out[hits] + bsdf_val * light_val
+def indirect(shape, refl, occ, geometry, bounces: int, roulette: int, samples: int):
+  r_d, pts, hits, _, n, latent = geometry
+  # each pixel has `samples` paths, state is only kept for paths which are still active.
+  mask = hits[None].expand(samples, *hits.shape)
+  idx = mask.reshape(-1).nonzero().squeeze(-1)
+  fit = lambda v: None if v is None else v[None].expand(samples, *v.shape).reshape(-1, v.shape[-1])
+  x, view, latent = fit(pts[hits]), fit(r_d[hits]), fit(latent)
+  normal = F.normalize(fit(n[hits]), eps=1e-6, dim=-1)
+  beta = torch.ones_like(x)
+  radiance = torch.zeros(mask.numel(), 3, device=x.device, dtype=x.dtype)
+  for b in range(bounces):
+    if idx.numel() == 0: break
+    wi, pdf = refl.sample(x=x, view=view, normal=normal, latent=latent, num_samples=1)
+    wi, pdf = wi[0], pdf[0].clamp(min=1e-4)
+    beta = beta * refl(x=x, view=view, normal=normal, light=wi, latent=latent)/pdf
+    with torch.no_grad(), profiling.stage("secondary_isect"):
+      x, hit, _, _ = shape.isect(
+        shape.underlying, x + 1e-3 * normal, wi, near=1e-2, far=shape.far, iters=64,
+      )
+    idx, beta, x, view = idx[hit], beta[hit], x[hit], wi[hit]
+    if idx.numel() == 0: break
+    normal = F.normalize(shape.normals(x), eps=1e-6, dim=-1).detach()
+    _, latent = shape.from_pts(x)
+    vertex = torch.zeros(mask.numel(), dtype=torch.bool, device=x.device)
+    vertex[idx] = True
+    light = masked_direct(
+      refl, occ, shape.intersect_mask, refl.light, x, vertex.reshape(mask.shape), view, normal, latent,
+    )
+    radiance = radiance.index_add(0, idx, beta * light)
 
-  # TODO this should just be a random sample of pts in some range?
-  pts_2nd_ord = pts.reshape(-1, 3)
-  pts_2nd_ord = pts[torch.randint(high=pts_2nd_ord.shape[0], size=32, device=pts.device), :]
-  with torch.no_grad():
-    # compute light to set of points
-    light_dir, light_val = occ(pts_2nd_ord, shape.intersect_mask, latent=latent)
-    # compute dir from each of the 2nd order pts to the main points
-    dirs = pts_2nd_ord - pts
-    # TODO apply the learned occlusion here
-    att = occ.attenuation(torch.cat([pts_2nd_ord, dirs], dim=-1), latent=latent)
-    # TODO this should account for the BSDF when computing the reflected component
-    out[hits] = out[hits] + att * light_val
-  if training: out = torch.cat([out, tput], dim=-1)
-  return out
+    if b + 1 < roulette or b + 1 == bounces: continue
+    q = beta.detach().max(dim=-1)[0].clamp(min=0.05, max=1)
+    alive = torch.rand_like(q) < q
+    beta = beta/q[:, None]
+    idx, beta, x, view, normal = idx[alive], beta[alive], x[alive], view[alive], normal[alive]
+    latent = None if latent is None else latent[alive]
+  return radiance.reshape(samples, *hits.shape, 3).mean(dim=0)
 
 class Path(Renderer):
   def __init__(
     self,
     bounces:int=1,
+    # bounces before paths are randomly terminated
+    roulette:int=1,
+    # paths per pixel
+    samples:int=1,
     **kwargs,
   ):
     super().__init__(**kwargs)
     self.bounces = bounces
-  def forward(self, rays):
-    raise NotImplementedError()
+    self.roulette = roulette
+    self.samples = samples
+  def forward(s, rays):
+    return path(
+      s.shape, s.refl, s.occ, rays, bounces=s.bounces, roulette=s.roulette, samples=s.samples,
+      training=s.training,
+    )
@@ -0,0 +1,64 @@
+# Sources of uniform samples in [0, 1)^dims for stratified depth jitter, crop selection and
+# sphere/hemisphere directions. "sobol" draws from scrambled Sobol sequences, which cover the
+# unit cube more evenly than independent random draws, so estimates at the same sample count
+# have lower variance. Each stream (i.e. "depth", "crop") has its own sequence per dimension,
+# which continues across calls, so consecutive draws are stratified with respect to each other.
+import math
+
+import torch
+
+# draws from the global torch RNG, which is seeded and checkpointed elsewhere.
+class Random:
+  def __init__(self, seed: int = 0): ...
+  def uniform(self, n: int, dims: int, device="cpu", stream=None):
+    return torch.rand(n, dims, device=device)
+  def state(self): return {}
+  def set_state(self, state): ...
+
+class Sobol:
+  def __init__(self, seed: int = 0):
+    self.seed = seed
+    self.engines = {}
+  def engine(self, stream, dims: int):
+    key = (stream, dims)
+    engine = self.engines.get(key, None)
+    if engine is None:
+      from torch.quasirandom import SobolEngine
+      engine = SobolEngine(dims, scramble=True, seed=self.seed + len(self.engines))
+      self.engines[key] = engine
+    return engine
+  def uniform(self, n: int, dims: int, device="cpu", stream=None):
+    return self.engine(stream, dims).draw(n).to(device)
+  # # of points drawn from each sequence, in the order they were created since that determines
+  # their seeds, so that resuming continues each sequence where it left off.
+  def state(self): return { key: engine.num_generated for key, engine in self.engines.items() }
+  def set_state(self, state):
+    self.engines = {}
+    for (stream, dims), n in state.items(): self.engine(stream, dims).fast_forward(n)
+
+sampler_kinds = {
+  "random": Random,
+  "sobol": Sobol,
+}
+
+sampler = Random()
+
+def set_sampler(kind: str, seed: int = 0):
+  global sampler
+  if kind not in sampler_kinds: raise NotImplementedError(f"Unknown sampler {kind}, must be one of {list(sampler_kinds)}")
+  sampler = sampler_kinds[kind](seed)
+
+# state of the current sampler, stored in checkpoints with the other RNG states.
+def state(): return sampler.state()
+def set_state(state): sampler.set_state(state)
+
+# returns [n, dims] uniform samples from the current sampler.
+def uniform(n: int, dims: int, device="cpu", stream=None):
+  return sampler.uniform(n, dims, device=device, stream=stream)
+
+# returns [num_samples, *shape, dims] uniform samples for each of a batch of points. Each point
+# takes a consecutive block of the sequence, so its own samples are stratified.
+def per_point(shape, num_samples: int, dims: int, device="cpu", stream=None):
+  K = math.prod(shape)
+  u = uniform(K * num_samples, dims, device, stream=stream)
+  return u.reshape(K, num_samples, dims).transpose(0, 1).reshape(num_samples, *shape, dims)
@@ -10,6 +10,7 @@ from .utils import ( autograd, smooth_min, curl_divergence, elev_azim_to_dir )
 import src.refl as refl
 import src.march as march
 import src.renderers as renderers
+import src.profiling as profiling
 from tqdm import trange
 
 def load(args, with_integrator:bool):
@@ -40,6 +41,7 @@ class SDFModel(nn.Module):
     self.latent_size = latent_size
   def forward(self, _pts): raise NotImplementedError()
 
+  @profiling.timed("normals")
   def normals(self, pts, values = None):
     with torch.enable_grad():
       autograd_pts = pts if pts.requires_grad else pts.requires_grad_()
@@ -98,22 +100,48 @@ class SDF(nn.Module):
     self.near = t_near
     self.alpha = alpha
     self.isect=isect
+    self.accel = None
+    self.bounds = None
 
   @property
   def sdf(self): return self
 
   @property
   def latent_size(self): return self.underlying.latent_size
+  @property
+  def intermediate_size(self): return self.latent_size
 
   def normals(self, pts, values = None): return self.underlying.normals(pts, values)
+  # use an acceleration structure (i.e. accel.SDFGrid) for intersections when not training.
+  def set_accel(self, accel): self.accel = accel
+  @property
+  def use_accel(self): return getattr(self, "accel", None) is not None and not self.training
+  # tighten near and far per ray with an occupancy grid (i.e. accel.RayBounds) when not training.
+  def set_bounds(self, bounds): self.bounds = bounds
+  def train(self, mode=True):
+    # the SDF may change while training, so the acceleration structures must be rebuilt.
+    if mode and getattr(self, "accel", None) is not None: self.accel.clear()
+    if mode and getattr(self, "bounds", None) is not None: self.bounds.clear()
+    return super().train(mode)
+  # near and far for marching, either global or [..., 1] per ray.
+  def near_far(self, r_o, r_d):
+    bounds = getattr(self, "bounds", None)
+    if bounds is None or self.training: return self.near, self.far
+    if bounds.grid is None: bounds.from_sdf(self.underlying, r_o.device)
+    near, far = bounds.near_far(r_o, r_d, self.near, self.far)
+    return near[..., None], far[..., None]
   def from_pts(self, pts):
     raw = self.underlying(pts)
     latent = raw[..., 1:]
     return raw[..., 0], latent if latent.shape[-1] != 0 else None
 
   def intersect_w_n(self, r_o, r_d):
+    if self.use_accel:
+      pts, hit, _, _ = self.accel.intersect(self.underlying, r_o, r_d, self.near, self.far)
+      return pts, hit, None, self.normals(pts)
+    near, far = self.near_far(r_o, r_d)
     pts, hit, t, tput = self.isect(
-      self.underlying, r_o, r_d, near=self.near, far=self.far,
+      self.underlying, r_o, r_d, near=near, far=far,
       eps=5e-5, iters=128 if self.training else 256,
     )
     if self.training:
@@ -121,11 +149,15 @@ class SDF(nn.Module):
       else: tput = -self.alpha * tput
     return pts, hit, tput, self.normals(pts)
   def intersect_mask(self, r_o, r_d, near=None, far=None, eps=1e-3):
+    near = self.near if near is None else near
+    far = self.far if far is None else far
+    if self.use_accel:
+      _, hits, _, vals = self.accel.intersect(self.underlying, r_o, r_d, near, far)
+      return ~hits, vals, None
     with torch.no_grad():
       throughput, _, _, _ = march.throughput_with_sign_change(
         self.underlying, r_o, r_d,
-        near=self.near if near is None else near,
-        far=self.far if far is None else far,
+        near=near, far=far,
         # since this is just for intersection, alright to use fewer steps
         batch_size=32 if self.training else 196,
       )
@@ -133,10 +165,15 @@ class SDF(nn.Module):
       return ~hits, throughput, None
   def forward(self, rays, with_throughput=True):
     r_o, r_d = rays.split([3,3], dim=-1)
-    pts, hit, t, tput = self.isect(
-      self.underlying, r_o, r_d, near=self.near, far=self.far,
-      iters=128 if self.training else 192,
-    )
+    if self.use_accel:
+      pts, hit, _, _ = self.accel.intersect(self.underlying, r_o, r_d, self.near, self.far)
+      tput = None
+    else:
+      near, far = self.near_far(r_o, r_d)
+      pts, hit, t, tput = self.isect(
+        self.underlying, r_o, r_d, near=near, far=far,
+        iters=128 if self.training else 192,
+      )
     latent = None if self.latent_size == 0 else self.underlying(pts[hit])[..., 1:]
     out = torch.zeros_like(r_d)
     n = None
@@ -146,8 +183,7 @@ class SDF(nn.Module):
       self.n[hit] = n
     # use masking in order to speed up efficiency
     out[hit] = self.refl(
-      x=pts[hit], view=r_d[hit], normal=n,
-      latent=latent, mask=hit,
+      x=pts[hit], view=r_d[hit], normal=n, latent=latent,
     )
     if with_throughput and self.training:
       if tput is None: tput = self.throughput(r_o, r_d)
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 from PIL import Image
 import matplotlib.pyplot as plt
 
+import src.sampling as sampling
+
 def create_fourier_basis(batch_size, features=3, freq=40, device="cuda"):
   B = freq * torch.randn(batch_size, features, device=device).T
   return B
@@ -288,31 +290,15 @@ def rgb2xyz(v):
   xyz = torch.bmm(tf_mat, v.unsqueeze(-1)).squeeze(-1)/0.17697
   return xyz
 
+# cosine weighted directions in the hemisphere around each vector, returning
+# [num_samples, *around.shape]. Same as refl.cosine_sample, without the pdf.
 def sample_random_hemisphere(around, num_samples:int=32):
-  n = num_samples
-  u,v = torch.rand(n, 2, device=around.device).split([1,1], dim=-1)
-  sin_theta = (-u * (u-2)).clamp(min=1e-8).sqrt()
-  phi = 2 * math.pi * v
-
-  x = sin_theta * phi.cos()
-  y = sin_theta * phi.sin()
-
-  z = (1 - x.square() - y.square()).clamp(min=1e-8).sqrt()
-  # TODO how to apply this to around? Convert normals into coordinate systems then convert
-  # direction from local coordinate system? is there a cheaper way?
-  dirs = torch.cat([x,y,z], dim=-1)
-  basis = torch.tensor([0,0,1], dtype=torch.float, device=u.device)
-  ar_flat = around.reshape(-1, 3)
-  R = rot_from(ar_flat, basis.unsqueeze(0).expand_as(ar_flat), dim=-1)
-  R0 = R.shape[0]
-  R = R.repeat(n,1,1)
-  dirs = dirs.repeat(R0, 1)
-  return torch.bmm(R, dirs.unsqueeze(-1))\
-    .reshape((n, *around.shape))
+  from src.refl import cosine_sample
+  return cosine_sample(around, num_samples)[0]
 
 def sample_random_sphere(around, num_samples:int=32):
   n = num_samples
-  uv = (torch.rand(n, 2, device=around.device) - 0.5) * math.tau
+  uv = (sampling.uniform(n, 2, around.device, stream="sphere") - 0.5) * math.tau
   return elev_azim_to_dir(uv)\
     .unsqueeze(1)\
     .expand(n, np.prod(around.shape[:-1]), 3)\
@@ -362,9 +348,9 @@ def spherical_pose(elev, azim, rad):
     [0,1,0,0],
     [np.sin(th),0, np.cos(th),0],
     [0,0,0,1]]).float()
-  c2w = trans_t(radius)
-  c2w = rot_phi(phi/180.*np.pi) @ c2w
-  c2w = rot_theta(theta/180.*np.pi) @ c2w
+  c2w = trans_t(rad)
+  c2w = rot_phi(elev/180.*np.pi) @ c2w
+  c2w = rot_theta(azim/180.*np.pi) @ c2w
   c2w = torch.Tensor([[-1,0,0,0],[0,0,1,0],[0,1,0,0],[0,0,0,1]]) @ c2w
   return c2w
 
@@ -0,0 +1,141 @@
+# Writers which encode and save outputs on a background thread, so that the training and test
+# loops only pay for queueing device tensors rather than composing and encoding images.
+import queue
+import threading
+
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+from PIL import Image
+
+# Starts copying tensors to the host without blocking, returns an event to wait on (or None).
+# Tensors already on the host are cloned, so the caller may modify them after queueing.
+def to_host(items):
+  host = [
+    item.detach().clone() if item.device.type == "cpu" else item.detach().to("cpu", non_blocking=True)
+    for item in items
+  ]
+  event = None
+  if any(item.is_cuda for item in items):
+    event = torch.cuda.Event()
+    event.record()
+  return host, event
+
+class BackgroundWriter:
+  def __init__(self, background: bool = True, max_queued: int = 32):
+    self.background = background
+    self.error = None
+    if not background: return
+    # bounded so that a slow disk cannot make the queue grow without limit.
+    self.queue = queue.Queue(maxsize=max_queued)
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None: return
+        self.write(*item)
+      except Exception as e: self.error = e
+      finally: self.queue.task_done()
+
+  def write(self, *item): raise NotImplementedError()
+
+  def check(self):
+    if self.error is not None:
+      err, self.error = self.error, None
+      raise err
+
+  def submit(self, *item):
+    self.check()
+    if self.background: self.queue.put(item)
+    else: self.write(*item)
+
+  # waits for all queued items to be written.
+  def flush(self):
+    if self.background: self.queue.join()
+    self.check()
+
+  def close(self):
+    if self.background and self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+    self.check()
+
+# Converts a [H,W], [H,W,1], [H,W,3] or [H,W,4] image into RGBA, single channel images are
+# normalized and colored with cmap, same as plt.imshow.
+def to_rgba(img, cmap):
+  img = img.astype(np.float32)
+  if img.ndim == 3 and img.shape[-1] == 1: img = img[..., 0]
+  if img.ndim == 2:
+    lo, hi = img.min(), img.max()
+    return cmap((img - lo)/max(hi - lo, 1e-10))
+  img = img.clip(0, 1)
+  if img.shape[-1] == 3: img = np.concatenate([img, np.ones_like(img[..., :1])], axis=-1)
+  return img
+
+# Places RGBA images side by side over a white background, upsampling small images so that
+# they are visible (nearest neighbor, to not blur pixels).
+def compose_panels(imgs, min_height: int = 256, pad: int = 4):
+  height = max(max(img.shape[0] for img in imgs), min_height)
+  panels = []
+  for img in imgs:
+    img = Image.fromarray((img * 255).round().astype(np.uint8), mode="RGBA")
+    width = round(img.width * height/img.height)
+    panels.append(img.resize((width, height), resample=Image.NEAREST))
+  total = sum(p.width for p in panels) + pad * (len(panels) - 1)
+  out = Image.new("RGBA", (total, height), (255, 255, 255, 255))
+  x = 0
+  for p in panels:
+    out.alpha_composite(p, dest=(x, 0))
+    x += p.width + pad
+  return out.convert("RGB")
+
+class ImageWriter(BackgroundWriter):
+  # replacement for utils.save_plot, writes expected and got side by side.
+  def plot(self, name, expected, *got):
+    items, event = to_host([expected, *got])
+    # read here since rcParams may change on the main thread.
+    cmap = plt.get_cmap(plt.rcParams["image.cmap"])
+    self.submit("plot", name, items, event, cmap)
+
+  # replacement for utils.save_image.
+  def image(self, name, img):
+    items, event = to_host([img])
+    self.submit("image", name, items, event, None)
+
+  def write(self, kind, name, items, event, cmap):
+    if event is not None: event.synchronize()
+    items = [item.squeeze().numpy() for item in items]
+    if kind == "image":
+      img = (items[0].clip(0, 1) * 255).round().astype(np.uint8)
+      Image.fromarray(img).save(name)
+      return
+    assert(kind == "plot"), f"Unknown write kind {kind}"
+    compose_panels([to_rgba(item, cmap) for item in items]).save(name)
+
+# Streams frames into a video (or gif) with imageio, encoding on the background thread so the
+# next frame can be rendered while the previous one is encoded. Formats other than gif may need
+# imageio-ffmpeg.
+class VideoWriter(BackgroundWriter):
+  def __init__(self, path, fps: int = 30, background: bool = True, max_queued: int = 8):
+    import imageio
+    # must exist before the thread starts writing.
+    self.video = imageio.get_writer(path, fps=fps)
+    self.path = path
+    super().__init__(background=background, max_queued=max_queued)
+
+  def frame(self, img):
+    items, event = to_host([img])
+    self.submit(items[0], event)
+
+  def write(self, img, event):
+    if event is not None: event.synchronize()
+    img = img.squeeze().numpy()
+    if img.ndim == 2: img = img[..., None].repeat(3, axis=-1)
+    self.video.append_data((img[..., :3].clip(0, 1) * 255).round().astype(np.uint8))
+
+  def close(self):
+    try: super().close()
+    finally: self.video.close()